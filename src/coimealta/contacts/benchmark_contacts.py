@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+"""Time the contacts tools on synthetic contacts files.
+
+The files are made up of families several generations deep, with
+partners, children and siblings linked by ID (and sometimes by name,
+or in one direction only, as real files are), households sharing
+addresses, and the usual groups, flags and other details.  The same
+seed always gives the same file, so runs on different versions of
+the code can be compared; the timings are output as JSON."""
+
+import argparse
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import coimealta.contacts.contacts_data as contacts_data
+import coimealta.contacts.contacts_graph as contacts_graph
+import coimealta.contacts.contacts_stats as contacts_stats
+import coimealta.contacts.dedupe_contacts as dedupe_contacts
+import coimealta.contacts.family as family
+import coimealta.contacts.format_address_labels as format_address_labels
+import coimealta.contacts.link_contacts as link_contacts
+import coimealta.contacts.list_contacts as list_contacts
+import coimealta.contacts.search_contacts as search_contacts
+
+BENCHMARK_VERSION = 1
+
+GIVEN_NAMES = {
+    'm': ["Adam", "Alexander", "Andrew", "Benjamin", "Christopher", "Daniel", "David",
+          "Edward", "Francis", "George", "Henry", "James", "John", "Joseph", "Matthew",
+          "Michael", "Nicholas", "Patrick", "Peter", "Richard", "Robert", "Samuel",
+          "Stephen", "Thomas", "Timothy", "William"],
+    'f': ["Abigail", "Alice", "Ann", "Anna", "Catherine", "Charlotte", "Deborah",
+          "Eleanor", "Elizabeth", "Elspeth", "Emily", "Frances", "Grace", "Hannah",
+          "Helen", "Isabel", "Jane", "Joanna", "Katherine", "Lucy", "Margaret", "Mary",
+          "Rachel", "Rebecca", "Ruth", "Sarah"],
+}
+
+SURNAME_STARTS = ["Ash", "Black", "Bram", "Brook", "Cald", "Carr", "Dun", "Fair", "Gold",
+                  "Green", "Hal", "Hart", "Kings", "Lang", "Mar", "Mill", "New", "Oak",
+                  "Pen", "Ross", "Shel", "Stan", "Thorn", "Wood"]
+SURNAME_ENDS = ["ley", "ford", "ton", "well", "wood", "by", "field", "more", "ham", "stead",
+                "er", "wick"]
+
+STREETS = ["High Street", "Church Road", "Mill Lane", "Station Road", "Park Avenue",
+           "Victoria Road", "The Green", "Chapel Street", "Queens Road", "Manor Way"]
+CITIES = [("Cambridge", "CB"), ("Ely", "CB"), ("Oxford", "OX"), ("York", "YO"),
+          ("Norwich", "NR"), ("Bristol", "BS"), ("Leeds", "LS"), ("Durham", "DH")]
+NATIONALITIES = ["British", "British", "British", "Irish", "French", "German", "American",
+                 "Canadian", "Dutch", "Indian"]
+PLACES_MET = ["Cambridge", "school", "work", "church", "choir", "university", "neighbour",
+              "family", "conference", ""]
+GROUPS = ["Choir", "Church", "Walkers", "Chess Club", "Book Group", "Allotments",
+          "Bell Ringers", "Rowing", "Orchestra", "Quiz Team"]
+ORGANIZATIONS = ["Cambridge University Press", "Acme Ltd", "County Council", "NHS",
+                 "Oxfam", "Parish Church", "Marshall", "Arm", ""]
+JOBS = ["teacher", "engineer", "nurse", "printer", "priest", "doctor", "programmer",
+        "librarian", "farmer", "architect", "accountant", "retired", ""]
+FLAGS = "xcpbkw"
+
+class ContactsGenerator:
+
+    """Make up a contacts file of families.
+
+    Each family starts with a couple, whose children each have a
+    partner from outside the family (starting a family line of their
+    own), and so on down the generations, until there are enough
+    people."""
+
+    def __init__(self, seed=0, this_year=2025):
+        self.rng = random.Random(seed)
+        self.this_year = this_year
+        self.people = []
+        self.by_id = {}
+        self.names = set()
+
+    def new_id(self):
+        uid = None
+        while uid is None or uid in self.by_id:
+            uid = "%s%d%s%d" % (chr(ord('G') + self.rng.randrange(20)), self.rng.randrange(10),
+                                chr(ord('A') + self.rng.randrange(26)), self.rng.randrange(10))
+        return uid
+
+    def new_surname(self):
+        return self.rng.choice(SURNAME_STARTS) + self.rng.choice(SURNAME_ENDS)
+
+    def address(self):
+        city, area = self.rng.choice(CITIES)
+        return {'Street': "%d %s" % (self.rng.randrange(1, 200), self.rng.choice(STREETS)),
+                'City': city,
+                'Postal Code': "%s%d %d%s" % (area, self.rng.randrange(1, 30), self.rng.randrange(10),
+                                              "".join(self.rng.choice("ABDEFGHJLNPQRSTUWXYZ")
+                                                      for _ in range(2))),
+                'Country': "UK"}
+
+    def unique_name(self, gender, surname):
+        """Pick given and middle names that make a name nobody else has."""
+        rng = self.rng
+        for attempt in range(100):
+            given = rng.choice(GIVEN_NAMES[gender])
+            middles = [rng.choice(GIVEN_NAMES[gender]) for _ in range(attempt // 5)]
+            middles = [middle for middle in middles if middle != given]
+            name = contacts_data.make_name({'Given name': given,
+                                            'Middle names': " ".join(middles),
+                                            'Surname': surname})
+            if name not in self.names:
+                self.names.add(name)
+                return given, " ".join(middles)
+        raise ValueError("Could not make a new name with surname " + surname)
+
+    def new_person(self, gender, surname, born, address):
+        rng = self.rng
+        given, middles = self.unique_name(gender, surname)
+        uid = self.new_id()
+        person = {field: "" for field in contacts_data.FIELD_NAMES}
+        for multi in contacts_data.MULTI_FIELDS:
+            person[multi] = []
+        person.update(address)
+        person.update({
+            'ID': uid,
+            'Given name': given,
+            'Middle names': middles,
+            'Surname': surname,
+            'Gender': gender,
+            'Title': rng.choice(["Dr", "Revd", "Prof"]) if rng.random() < 0.08 else "",
+            'Nationality': rng.choice(NATIONALITIES),
+            'Place met': rng.choice(PLACES_MET),
+            'Flags': "".join(flag for flag in FLAGS if rng.random() < 0.15),
+            'Jobs': rng.choice(JOBS) if born < self.this_year - 20 else "",
+            'Primary email': "%s.%s.%s@example.org" % (given.lower(), surname.lower(), uid.lower()),
+        })
+        month, day = rng.randrange(1, 13), rng.randrange(1, 29)
+        person['Birthday'] = ("%04d-%02d-%02d" % (born, month, day) if rng.random() < 0.6
+                              else "--%02d-%02d" % (month, day) if rng.random() < 0.7
+                              else "")
+        if born < self.this_year - 90 and rng.random() < 0.7:
+            person['Died'] = str(rng.randrange(born + 60, self.this_year))
+        else:
+            if rng.random() < 0.5:
+                person['In touch'] = (datetime.date(self.this_year, 1, 1)
+                                      - datetime.timedelta(days=rng.randrange(1000))).isoformat()
+            if rng.random() < 0.5:
+                person['Primary phone Type'] = "Mobile"
+                person['Primary phone Value'] = "07700 %06d" % rng.randrange(1000000)
+        person['First contact'] = str(max(born, self.this_year - 60) + rng.randrange(0, 30))
+        if rng.random() < 0.3:
+            person['Group Membership'] = rng.sample(GROUPS, rng.randrange(1, 3))
+        if rng.random() < 0.2 and (organization := rng.choice(ORGANIZATIONS)):
+            person['Organizations'] = [organization]
+        if rng.random() < 0.05:
+            person['Notes'] = "Works in %s as a %s" % (rng.choice(CITIES)[0], rng.choice(JOBS) or "volunteer")
+        self.people.append(person)
+        self.by_id[uid] = person
+        return person
+
+    def link(self, person, field, other):
+        """Link one person to another, usually by ID but sometimes by name."""
+        if self.rng.random() < 0.05:
+            person[field].append(contacts_data.make_name(other))
+        else:
+            person[field].append(other['ID'])
+
+    def marry(self, one, other):
+        self.link(one, 'Partners', other)
+        if self.rng.random() < 0.9:
+            self.link(other, 'Partners', one)
+
+    def family(self, n_people):
+        """Add a family of up to n_people, descended from a couple born before 1940."""
+        rng = self.rng
+        surname = self.new_surname()
+        born = rng.randrange(1900, 1940)
+        home = self.address()
+        couples = [(self.new_person('m', surname, born, home),
+                    self.new_person('f', surname, born + rng.randrange(-3, 4), home),
+                    born)]
+        self.marry(*couples[0][:2])
+        added = 2
+        while couples and added < n_people:
+            father, mother, parents_born = couples.pop(0)
+            home = {field: father[field] for field in contacts_data.ADDRESS_FIELDS if field in father}
+            children = []
+            for _ in range(rng.choice([0, 1, 2, 2, 2, 3, 3, 4])):
+                if added >= n_people:
+                    break
+                born = parents_born + rng.randrange(22, 38)
+                if born > self.this_year:
+                    break
+                child_home = home if born > self.this_year - 20 else self.address()
+                child = self.new_person(rng.choice("mf"), father['Surname'], born, child_home)
+                added += 1
+                for parent in (father, mother):
+                    self.link(child, 'Parents', parent)
+                    if rng.random() < 0.8:
+                        self.link(parent, 'Offspring', child)
+                children.append(child)
+                if born < self.this_year - 22 and added < n_people and rng.random() < 0.7:
+                    partner_gender = 'f' if child['Gender'] == 'm' else 'm'
+                    partner = self.new_person(partner_gender,
+                                              (self.new_surname() if partner_gender == 'm' or rng.random() < 0.3
+                                               else child['Surname']),
+                                              born + rng.randrange(-4, 5), child_home)
+                    added += 1
+                    self.marry(child, partner)
+                    couples.append((child, partner, born) if child['Gender'] == 'm'
+                                   else (partner, child, born))
+            for child in children:
+                if rng.random() < 0.5:
+                    for sibling in children:
+                        if sibling is not child:
+                            self.link(child, 'Siblings', sibling)
+
+    def generate(self, n_people):
+        """Make up families until there are n_people people, and return them."""
+        while len(self.people) < n_people:
+            self.family(min(n_people - len(self.people), self.rng.randrange(2, 60)))
+        return self.people
+
+def write_people(filename, people):
+    """Write made-up people as a contacts file."""
+    with open(filename, 'w', newline='') as outstream:
+        writer = csv.writer(outstream)
+        writer.writerow(contacts_data.FIELD_NAMES)
+        for person in people:
+            writer.writerow(["; ".join(value) if isinstance(value, list) else value
+                             for value in (person[field] for field in contacts_data.FIELD_NAMES)])
+
+def generate_contacts(filename, n_people, seed=0):
+    """Write a synthetic contacts file of n_people people, made from the seed given."""
+    write_people(filename, ContactsGenerator(seed).generate(n_people))
+    return filename
+
+def time_call(function, repeat=3, setup=None):
+    """Time a function, returning the times of each run in seconds.
+    If setup is given, it is called (untimed) before each run, and
+    its result passed to the function.  Anything the function prints
+    is discarded."""
+    times = []
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function(*args)
+            times.append(time.perf_counter() - start)
+    return times
+
+def benchmarks(contacts, workdir):
+    """Return the benchmarks for a contacts file, as (name, function, setup) tuples.
+    Outputs go into workdir."""
+
+    def fresh():
+        return contacts_data.read_contacts(contacts, use_snapshot=False)
+
+    def fresh_by_id():
+        return fresh()[0]
+
+    def output(name):
+        return os.path.join(workdir, name)
+
+    loaded_by_id, loaded_by_name = fresh()
+    people = list(loaded_by_id.values())
+    graph = contacts_graph.RelationshipGraph(loaded_by_id)
+    starts = [person['_name_'] for person in people[::max(1, len(people) // 5)][:5]]
+    today = datetime.date(2025, 1, 1)
+    flag = FLAGS[0]
+    group = GROUPS[0]
+    surname = people[0]['Surname']
+
+    contacts_data.read_contacts(contacts)    # make the snapshot
+    return [
+        ("read_contacts", lambda: contacts_data.read_contacts(contacts, use_snapshot=False), None),
+        ("read_contacts_snapshot", lambda: contacts_data.read_contacts(contacts), None),
+        ("link_contacts", lambda loaded: link_contacts.link_contacts(*loaded), fresh),
+        ("write_contacts", lambda: contacts_data.write_contacts(output("written.csv"), loaded_by_name), None),
+        ("write_graph", lambda: link_contacts.write_graph(output("graph.gv"), loaded_by_id), None),
+        ("write_graph_parts", lambda: link_contacts.write_graph_parts(output("graph-parts"), loaded_by_id,
+                                                                      'component'), None),
+        ("relationship_graph", lambda: contacts_graph.RelationshipGraph(loaded_by_id), None),
+        ("graph_components", lambda: contacts_graph.RelationshipGraph(loaded_by_id).components(), None),
+        ("family_graph_main", lambda: [family.family_graph_main([start], False, contacts, output("family.gv"))
+                                       for start in starts], None),
+        ("family_members", lambda: [family.family_members(graph, graph.number(loaded_by_name[start]['ID']),
+                                                          up=2, down=2)
+                                    for start in starts], None),
+        ("contact_stats", lambda: contacts_stats.ContactStats(people), None),
+        ("stats_for", lambda: contacts_stats.stats_for(contacts, loaded_by_id), None),
+        ("contact_indexes", lambda: list_contacts.contact_indexes(loaded_by_id), None),
+        ("select_flag", lambda by_id: list_contacts.select_contacts(by_id, flag=flag), fresh_by_id),
+        ("select_group_and_surname", lambda by_id: list_contacts.select_contacts(by_id, require_all=True,
+                                                                                group=[group],
+                                                                                surname=[surname]),
+         fresh_by_id),
+        ("select_birthdays", lambda: contacts_data.ContactCalendar(people).birthdays_within(today, 30), None),
+        ("select_overdue", lambda: contacts_data.ContactCalendar(people).not_contacted_within(today, 365), None),
+        ("households", lambda: contacts_data.HouseholdIndex(loaded_by_id).households(people), None),
+        ("address_labels", lambda: format_address_labels.render_labels(
+            list_contacts.address_labels(contacts_data.HouseholdIndex(loaded_by_id).households(people)),
+            format_address_labels.default_layout(),
+            combined=output("labels.html")), None),
+        ("name_index", lambda: link_contacts.NameIndex(loaded_by_id), None),
+        ("search_index", lambda: search_contacts.SearchIndex().refresh(loaded_by_id), None),
+        ("find_duplicates", lambda: dedupe_contacts.find_duplicates(people), None),
+    ]
+
+def run_benchmarks(n_people, seed=0, repeat=3, only=None):
+    """Make a synthetic contacts file and time the benchmarks on it.
+    Returns a dictionary from benchmark name to its timings."""
+    workdir = tempfile.mkdtemp(prefix="contacts-benchmark-")
+    try:
+        contacts = generate_contacts(os.path.join(workdir, "contacts-%d.csv" % n_people), n_people, seed)
+        results = {}
+        for name, function, setup in benchmarks(contacts, workdir):
+            if only and name not in only:
+                continue
+            times = time_call(function, repeat, setup)
+            results[name] = {'best': min(times),
+                             'median': statistics.median(times),
+                             'runs': times}
+            print("%8d %-26s %9.4fs" % (n_people, name, min(times)), file=sys.stderr)
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare_results(old, new):
+    """Print how the best times of two runs compare, for the sizes and benchmarks in both."""
+    for size, results in new['sizes'].items():
+        old_results = old.get('sizes', {}).get(size, {})
+        for name, timings in results.items():
+            if name in old_results:
+                before, after = old_results[name]['best'], timings['best']
+                print("%8s %-26s %9.4fs -> %9.4fs  %6.2fx" % (size, name, before, after,
+                                                               before / after if after else float('inf')))
+
+def benchmark_contacts_main(people, seed, repeat, only, output, compare, generate):
+    if generate:
+        generate_contacts(generate, people[0], seed)
+        return None
+    only = set(only.split(',')) if only else None
+    report = {'version': BENCHMARK_VERSION,
+              'seed': seed,
+              'repeat': repeat,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'sizes': {str(n_people): run_benchmarks(n_people, seed, repeat, only)
+                        for n_people in people}}
+    if output:
+        with open(output, 'w') as outstream:
+            json.dump(report, outstream, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if compare:
+        with open(compare) as instream:
+            compare_results(json.load(instream), report)
+    return report
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--people", "-n", type=int, nargs='+', default=[1000, 10000],
+                        help="""The sizes of contacts file to time things on.""")
+    parser.add_argument("--seed", "-s", type=int, default=0,
+                        help="""The seed to make up the contacts from.""")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="""How many times to run each benchmark; the best time is reported.""")
+    parser.add_argument("--only",
+                        help="""Comma-separated names of the benchmarks to run.""")
+    parser.add_argument("--output", "-o",
+                        help="""File to write the JSON results to, instead of standard output.""")
+    parser.add_argument("--compare", "-c",
+                        help="""JSON results of an earlier run, to compare this run with.""")
+    parser.add_argument("--generate", "-g", metavar="FILE",
+                        help="""Just write a synthetic contacts file of the first size given.""")
+    return vars(parser.parse_args())
+
+if __name__ == "__main__":
+    benchmark_contacts_main(**get_args())
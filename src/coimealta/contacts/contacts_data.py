@@ -2,14 +2,19 @@
 
 The data is stored in a CSV file."""
 
+import bisect
+import collections.abc
 import csv
 import datetime
 import functools
+import hashlib
 import operator
 import os
+import pickle
 import random
 import re
 import shutil
+import sys
 import tempfile
 
 def count_grouped_titles(title_map, titles):
@@ -42,6 +47,145 @@ MULTI_FIELDS = ['Parents', 'Offspring', 'Siblings',
                 'Organizations',
                 'Other groups']
 
+# Fields that read_contacts works out from the others
+DERIVED_FIELDS = ['_name_', '_initialled_name_', '_groups_']
+
+PERSON_FIELDS = FIELD_NAMES + DERIVED_FIELDS
+PERSON_FIELD_INDEX = {field: index for index, field in enumerate(PERSON_FIELDS)}
+MULTI_FIELD_INDICES = frozenset(PERSON_FIELD_INDEX[multi] for multi in MULTI_FIELDS)
+
+# Shared by everyone who has nothing in a multi-field, until they get something
+EMPTY_SET = frozenset()
+
+_ABSENT = object()
+
+class Person(collections.abc.MutableMapping):
+
+    """The data about one person, stored compactly.
+
+    This behaves like the dictionary that csv.DictReader would give
+    for the person's row, but keeps the usual fields in a list in the
+    order of PERSON_FIELDS, with repeated strings interned, so the
+    many people who share a nationality or a group share one string
+    for it.  Any other fields go into a dictionary of extras, which
+    most people won't need.
+
+    A multi-field holding EMPTY_SET is given a set of its own when it
+    is first looked at, so that it can be added to in place.
+    """
+
+    __slots__ = ('_values', '_extras')
+
+    def __init__(self, fields=None):
+        self._values = [_ABSENT] * len(PERSON_FIELDS)
+        self._extras = None
+        if fields:
+            self.update(fields)
+
+    def __getitem__(self, key):
+        index = PERSON_FIELD_INDEX.get(key)
+        if index is None:
+            if self._extras is None:
+                raise KeyError(key)
+            return self._extras[key]
+        value = self._values[index]
+        if value is _ABSENT:
+            raise KeyError(key)
+        if value is EMPTY_SET and index in MULTI_FIELD_INDICES:
+            value = self._values[index] = set()
+        return value
+
+    def peek(self, key, default=None):
+        """Return a field, without giving an empty multi-field a set of its own.
+        The result must not be modified."""
+        index = PERSON_FIELD_INDEX.get(key)
+        if index is None:
+            return self._extras.get(key, default) if self._extras else default
+        value = self._values[index]
+        return default if value is _ABSENT else value
+
+    def __setitem__(self, key, value):
+        if type(value) is str:
+            value = sys.intern(value)
+        index = PERSON_FIELD_INDEX.get(key)
+        if index is None:
+            if self._extras is None:
+                self._extras = {}
+            self._extras[key] = value
+        else:
+            self._values[index] = value
+
+    def __delitem__(self, key):
+        index = PERSON_FIELD_INDEX.get(key)
+        if index is None:
+            if self._extras is None:
+                raise KeyError(key)
+            del self._extras[key]
+        elif self._values[index] is _ABSENT:
+            raise KeyError(key)
+        else:
+            self._values[index] = _ABSENT
+
+    def __contains__(self, key):
+        index = PERSON_FIELD_INDEX.get(key)
+        if index is None:
+            return self._extras is not None and key in self._extras
+        return self._values[index] is not _ABSENT
+
+    def __iter__(self):
+        for field, value in zip(PERSON_FIELDS, self._values):
+            if value is not _ABSENT:
+                yield field
+        if self._extras:
+            yield from self._extras
+
+    def __len__(self):
+        return (len(self._values) - self._values.count(_ABSENT)
+                + (len(self._extras) if self._extras else 0))
+
+    def __repr__(self):
+        return "Person(%r)" % dict(self)
+
+    def __getstate__(self):
+        return (tuple(None if value is _ABSENT else value for value in self._values),
+                tuple(index for index, value in enumerate(self._values) if value is _ABSENT),
+                self._extras)
+
+    def __setstate__(self, state):
+        values, absent, self._extras = state
+        self._values = [EMPTY_SET if type(value) is frozenset and not value else value
+                        for value in values]
+        for index in absent:
+            self._values[index] = _ABSENT
+
+    def extra_fields(self):
+        """Return the names of the fields this person has besides the usual ones."""
+        return self._extras.keys() if self._extras else ()
+
+    @classmethod
+    def from_cells(cls, header, cells):
+        """Make a person from a row of a contacts file.
+        Cells missing from the end of the row are taken as None, as
+        csv.DictReader does."""
+        person = cls()
+        n_cells = len(cells)
+        for column, field in enumerate(header):
+            person[field] = cells[column] if column < n_cells else None
+        return person
+
+def peek(person, key, default=None):
+    """Return a field of a Person (as Person.peek does) or of any other mapping."""
+    return person.peek(key, default) if isinstance(person, Person) else person.get(key, default)
+
+def linked_ids(person, field):
+    """Return the IDs in a link field of a person, without changing them.
+    The field may hold a set, as in a Person, or a string of IDs
+    separated by semicolons, as in a row straight from the file."""
+    value = peek(person, field) or ()
+    if isinstance(value, str):
+        return {item.strip() for item in value.split(';') if item.strip()}
+    return value
+
 def make_name(person):
     """Assemble a name from a person's fields."""
     first_name = (person.get('Given name', "") or "")
@@ -101,6 +245,175 @@ def make_address(person):
             person.get('Postal Code', ""),
             person.get('Country'))
 
+# Familiar forms of given names, and the names they are short for
+EXPANDED_NAMES = {
+    "Abi": "Abigail",
+    "Anne": "Ann",
+    "Ana": "Anna",
+    "Ander": "Alexander",
+    "Andy": "Andrew",
+    "Ben": "Benjamin",
+    "Bill": "William",
+    "Chris": "Christopher",
+    "Dan": "Daniel",
+    "Danny": "Daniel",
+    "Dave": "David",
+    "Debbie": "Deborah",
+    "Elpie": "Elspeth",
+    "Frank": "Francis",
+    "Ginny": "Virginia",
+    "Greg": "Gregory",
+    "Jen": "Jennifer",
+    "Jennie": "Jennifer",
+    "Jenny": "Jennifer",
+    "Jim": "James",
+    "Kate": "Catherine",
+    "Katherine": "Catherine",
+    "Liz": "Elizabeth",
+    "Lizzie": "Elizabeth",
+    "Mat": "Matthew",
+    "Mathew": "Matthew",
+    "Matt": "Matthew",
+    "Meg": "Margaret",
+    "Nick": "Nicholas",
+    "Ollie": "Oliver",
+    "Olly": "Oliver",
+    "Pete": "Peter",
+    "Phillip": "Philip",
+    "Pip": "Philip",
+    "Pippa": "Philippa",
+    "Rob": "Robert",
+    "Ros": "Rosalind",
+    "Sam": "Samuel",
+    "Steven": "Stephen",
+    "Stevn": "Stephen",
+    "Sue": "Susan",
+    "Tim": "Timothy",
+    "Tom": "Thomas",
+    "Tony": "Anthony",
+    "Vicky": "Victoria",
+    "Will": "William",
+}
+
+ADDRESS_FIELDS = ('Street', 'Village/District', 'City', 'County', 'State',
+                  'Postal Code', 'Country')
+
+# Last words of street names that are written both in full and abbreviated
+STREET_ABBREVIATIONS = {
+    'ave': 'avenue',
+    'cl': 'close',
+    'cres': 'crescent',
+    'ct': 'court',
+    'dr': 'drive',
+    'gdns': 'gardens',
+    'ln': 'lane',
+    'pl': 'place',
+    'rd': 'road',
+    'sq': 'square',
+    'st': 'street',
+    'tce': 'terrace',
+}
+
+def normalize_address_part(text):
+    """Reduce part of an address to a form for comparing with others."""
+    return " ".join(re.sub(r"[.,;]", " ", (text or "").casefold()).split())
+
+def canonical_postcode(text):
+    """Reduce a postcode to a form for comparing with others."""
+    return "".join((text or "").upper().split())
+
+def address_key(person):
+    """Return a key for a person's address, that other ways of writing it share.
+    If there is a postcode, the street, postcode and country identify
+    the address; otherwise all the address fields are used.
+    Returns None if the person has no address."""
+    street = normalize_address_part(person.get('Street'))
+    if street:
+        words = street.split()
+        words[-1] = STREET_ABBREVIATIONS.get(words[-1], words[-1])
+        street = " ".join(words)
+    postcode = canonical_postcode(person.get('Postal Code'))
+    country = normalize_address_part(person.get('Country'))
+    if postcode:
+        return (street, postcode, country)
+    key = (street,) + tuple(normalize_address_part(person.get(field))
+                            for field in ('Village/District', 'City', 'County', 'State')) + (country,)
+    return key if any(key) else None
+
+class HouseholdIndex:
+
+    """The people in the contacts, grouped by where they live.
+
+    People are put together by address_key, so that small differences
+    in how an address is written don't split a household.  People with
+    no address of their own join the household of a partner, or
+    failing that, of a parent (by either person's links), if they have
+    one.  The index is made in
+    one pass over everyone, and can then be used for any selection of
+    them."""
+
+    def __init__(self, by_id):
+        self.by_id = by_id
+        self.household_of = {}
+        self.members = collections.defaultdict(list)
+        homeless = []
+        listed_parents = collections.defaultdict(set)
+        for uid, person in by_id.items():
+            for child in linked_ids(person, 'Offspring'):
+                listed_parents[child].add(uid)
+            key = address_key(person)
+            if key is None:
+                homeless.append(uid)
+            else:
+                self.household_of[uid] = key
+                self.members[key].append(uid)
+        while homeless:
+            still_homeless = []
+            for uid in homeless:
+                person = by_id[uid]
+                key = next((self.household_of[relative]
+                            for relatives in (linked_ids(person, 'Partners'),
+                                              linked_ids(person, 'Parents'),
+                                              listed_parents.get(uid, ()))
+                            for relative in sorted(relatives)
+                            if relative in self.household_of),
+                           None)
+                if key is None:
+                    still_homeless.append(uid)
+                else:
+                    self.household_of[uid] = key
+                    self.members[key].append(uid)
+            if len(still_homeless) == len(homeless):
+                break
+            homeless = still_homeless
+
+    def __len__(self):
+        return len(self.members)
+
+    def address(self, key):
+        """Return the address tuple (as from make_address) for a household."""
+        return make_address(self.by_id[self.members[key][0]])
+
+    def household(self, uid):
+        """Return the IDs of the people who live with a person, including them."""
+        key = self.household_of.get(uid)
+        return list(self.members[key]) if key else [uid]
+
+    def households(self, people=None):
+        """Group people by household.
+        Returns a list of (address tuple, list of people) pairs, in order
+        of the first person of each household among the people given
+        (or everyone).  People whose whereabouts aren't known are each
+        in a group of their own, with their own (empty) address."""
+        groups = {}
+        for person in (self.by_id.values() if people is None else people):
+            uid = person['ID']
+            key = self.household_of.get(uid) or ('', uid)
+            if key not in groups:
+                groups[key] = (self.address(key) if key in self.members else make_address(person), [])
+            groups[key][1].append(person)
+        return list(groups.values())
+
 def make_ID():
     """Make a letter-digit-letter-digit random ID that is not a valid hex string."""
     return (str(chr(random.randint(0, 19) + ord('G')))
@@ -114,14 +427,15 @@ def age_in_year(person, year):
     match = re.match("[0-9][0-9][0-9][0-9]", bday)
     return (year - int(match.group(0))) if match else None
 
-def birthday(person, this_year):
-    """Return this year's birthday of a person, as a datetime.date.
+def birthday_month_day(person):
+    """Return the month and day of a person's birthday, as a tuple.
     Returns None if their birthday is unknown or not in a recognised format."""
     bday_string = person.get('Birthday', "") or ""
     if bday_string == "":
         return None
     try:
-        return datetime.date.fromisoformat(bday_string).replace(year=this_year)
+        bday = datetime.date.fromisoformat(bday_string)
+        return bday.month, bday.day
     except ValueError:          # not a full ISOdate, try some subsets:
         match = re.search("-([0-9][0-9])-([0-9][0-9])", bday_string)
         if match:
@@ -131,9 +445,17 @@ def birthday(person, this_year):
             day = int(match.group(2))
             if day == 0:
                 return None
-            return datetime.date(year=this_year, month=month, day=day).replace(year=this_year)
+            return month, day
         return None
 
+def birthday(person, this_year):
+    """Return this year's birthday of a person, as a datetime.date.
+    Returns None if their birthday is unknown or not in a recognised format."""
+    month_day = birthday_month_day(person)
+    if month_day is None:
+        return None
+    return datetime.date(year=this_year, month=month_day[0], day=month_day[1])
+
 def birthday_soon(person, this_year, today, within_days=30):
     """Return whether a person has a birthday soon."""
     bday = birthday(person, this_year)
@@ -167,12 +489,116 @@ def contact_soon(person, today, days_since_last_contact=90):
     # TODO: have a contact frequency field in the data for each person
     return cday and (today - cday).days > days_since_last_contact
 
-def record_contact(person, date=None):
-    """Record that I have contacted someone on a given date."""
+def record_contact(person, date=None, calendar=None, contacts_file=None, keep_in_touch=False):
+    """Record that I have contacted someone on a given date.
+    Their 'In touch' date is updated if they have one, or if
+    keep_in_touch is given, and so is their 'Last contact' date if the
+    file has that column.  If a ContactCalendar is given, it is
+    updated to match.  If the contacts file is given, the contact is
+    added to its event log, so that it will be there when the file is
+    next read, without the file having to be rewritten."""
     if date is None:
         date = datetime.date.today()
-    set_field_if_greater(person, "last-contacted", date)
-    set_field_if_not_empty(person, "keep-in-touch", date)
+    if 'Last contact' in person:
+        set_field_if_greater(person, 'Last contact', date.isoformat())
+    if keep_in_touch or person.get('In touch'):
+        set_field_if_greater(person, 'In touch', date.isoformat())
+    if calendar is not None:
+        calendar.update(person)
+    if contacts_file is not None:
+        append_contact_event(contacts_file, person['ID'], date, keep_in_touch)
+
+class ContactCalendar:
+
+    """An index of people's birthdays and when I was last in touch with them.
+
+    The dates are parsed once, when the calendar is made, and kept in
+    sorted lists, so finding whose birthdays are coming up, or whom I
+    haven't contacted for a while, takes a binary search rather than a
+    look at everyone.  Use update (or pass the calendar to
+    record_contact) when someone's dates change."""
+
+    def __init__(self, people):
+        self.people = {}
+        self.birthday_of = {}   # ID -> (month, day)
+        self.contacted_on = {}  # ID -> day ordinal
+        for person in people:
+            self._note(person)
+        self.birthdays = sorted(month_day + (key,)
+                                for key, month_day in self.birthday_of.items())
+        self.contacts = sorted((ordinal, key)
+                               for key, ordinal in self.contacted_on.items())
+
+    def __len__(self):
+        return len(self.people)
+
+    def _note(self, person):
+        """Record a person's dates in the dictionaries, returning their key."""
+        key = person['ID']
+        self.people[key] = person
+        month_day = birthday_month_day(person)
+        if month_day is None:
+            self.birthday_of.pop(key, None)
+        else:
+            self.birthday_of[key] = month_day
+        cday = last_contacted(person)
+        if cday:
+            self.contacted_on[key] = cday.toordinal()
+        else:
+            self.contacted_on.pop(key, None)
+        return key
+
+    @staticmethod
+    def _remove(entries, entry):
+        index = bisect.bisect_left(entries, entry)
+        if index < len(entries) and entries[index] == entry:
+            del entries[index]
+
+    def update(self, person):
+        """Bring the calendar up to date with a person's dates."""
+        key = person['ID']
+        old_birthday = self.birthday_of.get(key)
+        old_contact = self.contacted_on.get(key)
+        self._note(person)
+        new_birthday = self.birthday_of.get(key)
+        new_contact = self.contacted_on.get(key)
+        if new_birthday != old_birthday:
+            if old_birthday is not None:
+                self._remove(self.birthdays, old_birthday + (key,))
+            if new_birthday is not None:
+                bisect.insort(self.birthdays, new_birthday + (key,))
+        if new_contact != old_contact:
+            if old_contact is not None:
+                self._remove(self.contacts, (old_contact, key))
+            if new_contact is not None:
+                bisect.insort(self.contacts, (new_contact, key))
+
+    def birthdays_within(self, today, days=30):
+        """Return the people whose birthdays fall in the given number of days from today.
+        Today is included, and the people are in order of their birthdays,
+        continuing into next year if the interval crosses the new year."""
+        if days <= 0:
+            return []
+        start = (today.month, today.day)
+        end_date = today + datetime.timedelta(days=days)
+        end = (end_date.month, end_date.day)
+        low = bisect.bisect_left(self.birthdays, start)
+        if end_date.year == today.year:
+            entries = self.birthdays[low:bisect.bisect_left(self.birthdays, end, low)]
+        elif end_date.year > today.year + 1 or end >= start:
+            # the interval covers the whole year
+            entries = self.birthdays[low:] + self.birthdays[:low]
+        else:
+            entries = self.birthdays[low:] + self.birthdays[:bisect.bisect_left(self.birthdays, end)]
+        return [self.people[entry[2]] for entry in entries]
+
+    def not_contacted_within(self, today, days=90):
+        """Return the people I have not been in touch with for more than the given number of days.
+        The people whose last contact is longest ago come first; people
+        with no recorded contact are not included."""
+        cutoff = (today - datetime.timedelta(days=days)).toordinal()
+        return [self.people[key]
+                for _, key in self.contacts[:bisect.bisect_left(self.contacts, (cutoff,))]]
 
 def age_string(person, year):
     """Return a person's age, as a string."""
@@ -197,13 +623,13 @@ def set_field_if_not_empty(person, field, value):
     return False
 
 def set_field_if_greater(person, field, value):
-    """Set a field of a person dictionary if the new value is greater than the old one."""
-    if (person
-        and (field not in person
-             or person[field] == ""
-             or value > person[field])):
-        person[field] = value
-        return True
+    """Set a field of a person dictionary if the new value is greater than the old one.
+    A missing, empty or None old value counts as less than anything."""
+    if person:
+        old = person.get(field)
+        if old is None or old == "" or value > old:
+            person[field] = value
+            return True
     return False
 
 def set_field(person, field, value):
@@ -214,18 +640,144 @@ def set_field(person, field, value):
         return True
     return False
 
-def read_contacts(filename):
+# The snapshot, the stats and the search index are all caches kept in
+# hidden files beside the contacts file, each labelled with the
+# contacts_signature it was made from, and written with write_atomically.
+
+def cache_filename(filename, kind):
+    """Return the name of the hidden file to keep a kind of cache of a contacts file in."""
+    directory, basename = os.path.split(os.path.expandvars(filename))
+    return os.path.join(directory, "." + basename + "." + kind)
+
+def contacts_signature(filename, with_events=True):
+    """Return something that changes when a contacts file changes.
+    With with_events, it also changes when the file's event log does."""
+    filename = os.path.expandvars(filename)
+    signature = []
+    for part in (filename, event_log_filename(filename)) if with_events else (filename,):
+        try:
+            stat = os.stat(part)
+            signature += [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            signature += [None, None]
+    return signature
+
+def fingerprint(texts):
+    """Return a short digest of some strings, to tell whether any of them has changed."""
+    return hashlib.blake2b("\x1f".join(texts).encode(), digest_size=8).hexdigest()
+
+def write_atomically(filename, write, binary=False):
+    """Write a file by calling write on a new file beside it, then renaming
+    that over the old one, so that the file is replaced in one step.
+    If write fails, the old file is left as it was."""
+    handle, tempname = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                        prefix=os.path.basename(filename))
+    try:
+        with os.fdopen(handle, 'wb' if binary else 'w') as outstream:
+            write(outstream)
+        os.replace(tempname, filename)
+    finally:
+        if os.path.exists(tempname):
+            os.unlink(tempname)
+
+# Change this when the form of the parsed data changes, so old snapshots get ignored
+SNAPSHOT_VERSION = 2
+
+def snapshot_filename(filename):
+    """Return the name of the file to keep a parsed snapshot of a contacts file in."""
+    return cache_filename(filename, "snapshot")
+
+def file_hash(filename):
+    """Return a hash of the contents of a file."""
+    with open(filename, 'rb') as instream:
+        return hashlib.file_digest(instream, 'sha256').hexdigest()
+
+def read_snapshot(filename):
+    """Return the saved snapshot for a contacts file, or None if there isn't a usable one."""
+    try:
+        with open(snapshot_filename(filename), 'rb') as instream:
+            snapshot = pickle.load(instream)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    return snapshot if snapshot.get('version') == SNAPSHOT_VERSION else None
+
+def write_snapshot(filename, snapshot):
+    """Save a snapshot for a contacts file, replacing any previous one in one step.
+    It doesn't matter if this can't be done, as the snapshot is only a cache."""
+    try:
+        write_atomically(snapshot_filename(filename),
+                         lambda outstream: pickle.dump(snapshot, outstream,
+                                                       protocol=pickle.HIGHEST_PROTOCOL),
+                         binary=True)
+    except OSError as problem:
+        print("Could not save snapshot of", filename, "because of", problem)
+
+def read_contacts(filename, use_snapshot=True, fold_events=True):
     """Read a contacts file and return a tuple of dictionaries.
-    The first one lists contacts by ID, and the second by name."""
+    The first one lists contacts by ID, and the second by name.
+
+    The parsed data is saved in a snapshot file alongside the contacts
+    file, and used instead of parsing the file again for as long as the
+    file's size and modification time, or failing that its hash, stay
+    the same.  The snapshot also keeps the IDs given to people who
+    didn't have one, so that they keep the same IDs when the file is
+    parsed again.
+
+    Unless fold_events is false, any contacts recorded in the event
+    log since it was last compacted are applied to the people read."""
+    filename = os.path.expandvars(filename)
+    people_by_id, people_by_name = read_contacts_file(filename, use_snapshot)
+    if fold_events:
+        fold_contact_events(filename, people_by_id)
+    return people_by_id, people_by_name
+
+def read_contacts_file(filename, use_snapshot=True):
+    """Read a contacts file, or its snapshot, without applying the event log."""
+    if not use_snapshot:
+        people_by_id, people_by_name, _ = parse_contacts(filename)
+        return people_by_id, people_by_name
+    signature = contacts_signature(filename, with_events=False)
+    snapshot = read_snapshot(filename)
+    if snapshot and snapshot['signature'] == signature:
+        return snapshot['people_by_id'], snapshot['people_by_name']
+    contents_hash = file_hash(filename)
+    if snapshot and snapshot['hash'] == contents_hash:
+        snapshot['signature'] = signature
+        write_snapshot(filename, snapshot)
+        return snapshot['people_by_id'], snapshot['people_by_name']
+    people_by_id, people_by_name, assigned_ids = parse_contacts(
+        filename,
+        snapshot['assigned_ids'] if snapshot else None)
+    write_snapshot(filename, {'version': SNAPSHOT_VERSION,
+                              'signature': signature,
+                              'hash': contents_hash,
+                              'assigned_ids': assigned_ids,
+                              'people_by_id': people_by_id,
+                              'people_by_name': people_by_name})
+    return people_by_id, people_by_name
+
+def parse_contacts(filename, assigned_ids=None):
+    """Parse a contacts file, returning dictionaries of people by ID and by name.
+
+    People without an ID are given the one they have in assigned_ids
+    (a dictionary from name to ID), if it isn't in use, or a new random
+    one otherwise; the third result is the dictionary of IDs given."""
     people_by_id = {}
     people_by_name = {}
     without_id = []
     with open(os.path.expandvars(filename)) as instream:
-        for row in csv.DictReader(instream):
+        contacts_reader = csv.reader(instream)
+        header = next(contacts_reader, [])
+        for cells in contacts_reader:
+            if not cells:
+                continue
+            row = Person.from_cells(header, cells)
             name = make_name(row)
             short_name = make_short_name(row)
             row['_name_'] = name
             row['_initialled_name_'] = make_initialled_name(row)
+            if name in people_by_name:
+                print("More than one person called", name, "in", filename)
             people_by_name[name] = row
             # if short_name != name:
             #     people_by_name[short_name] = row
@@ -234,54 +786,187 @@ def read_contacts(filename):
                 people_by_id[uid] = row
             else:
                 without_id.append(row)
+            multis = {}
             for multi in MULTI_FIELDS:
-                row[multi] = set(
-                    item.strip()
+                multis[multi] = set(
+                    sys.intern(item.strip())
                     for item in
                     (row.get(multi, "") or "").split(';')
                     if item
                 )
-            row['_groups_'] = row['Group Membership'].union(row['Organizations'],
-                                                            row['Other groups'])
+                row[multi] = multis[multi] or EMPTY_SET
+            row['_groups_'] = multis['Group Membership'].union(multis['Organizations'],
+                                                               multis['Other groups']) or EMPTY_SET
 
+    assigned_ids = assigned_ids or {}
+    now_assigned = {}
     for person in without_id:
-        uid = make_ID()
-        while uid in people_by_id:
+        uid = assigned_ids.get(person['_name_'])
+        while uid is None or uid in people_by_id:
             uid = make_ID()
         person['ID'] = uid
         people_by_id[uid] = person
+        now_assigned[person['_name_']] = uid
 
-    return people_by_id, people_by_name
+    return people_by_id, people_by_name, now_assigned
+
+WRITTEN_MULTI_FIELDS = frozenset(MULTI_FIELDS)
+
+def extra_fields(people):
+    """Return the fields, other than the usual ones, that any of some people have."""
+    found = set()
+    for person in people:
+        if isinstance(person, Person):
+            found.update(person.extra_fields())
+        else:
+            found.update(field for field in person
+                         if field not in PERSON_FIELD_INDEX)
+    found.discard('')
+    return found
+
+def contact_cells(person, fieldnames):
+    """Return the cells of the CSV row for a person, leaving the person unchanged."""
+    cells = []
+    for field in fieldnames:
+        value = peek(person, field)
+        if value is None:
+            cells.append("")
+        elif field in WRITTEN_MULTI_FIELDS and not isinstance(value, str):
+            cells.append('; '.join(sorted(value)))
+        else:
+            cells.append(value)
+    return cells
 
 def write_contacts(filename, people_by_name):
     """Write a dictionary of contacts-by-name to a file.
 
+    The people are not changed by this, so they can go on being used
+    afterwards.  Any fields besides the usual ones are written in
+    extra columns after them.
+
     The data is written to a temporary file, and only copied to the
-    specified file if there were no unwritable entries.
+    specified file if there were no unwritable entries.  If the file
+    is a symbolic link, the file it points to is replaced, keeping the
+    link.
     """
-    all_found_fields = set().union(*[set(row.keys()) for row in people_by_name.values()])
-    if all_found_fields != set(FIELD_NAMES):
-        print("These extra fields were found:", all_found_fields - set(FIELD_NAMES))
-    with open(tempfile.NamedTemporaryFile(delete_on_close=False, suffix='.csv'), 'w') as output:
-        tempname = output.name
+    extras = extra_fields(people_by_name.values())
+    if extras:
+        print("These extra fields were found:", extras)
+    fieldnames = FIELD_NAMES + sorted(extras)
+    filename = os.path.realpath(os.path.expandvars(filename))
+    handle, tempname = tempfile.mkstemp(dir=os.path.dirname(filename) or ".", suffix='.csv')
+    with os.fdopen(handle, 'w', newline='') as output:
         fails = 0
-        contacts_writer = csv.DictWriter(output, FIELD_NAMES)
-        contacts_writer.writeheader()
+        contacts_writer = csv.writer(output)
+        contacts_writer.writerow(fieldnames)
         for name in sorted(people_by_name.keys()):
             row = people_by_name[name]
-            # print row
-            for multi in MULTI_FIELDS:
-                # print("converting", multi, row[multi])
-                row[multi] = '; '.join(sorted(list(row[multi])))
-                # print("converted", multi, row[multi])
-            for deledend in ('', '_name_', '_initialled_name_', '_groups_'):
-                if deledend in row:
-                    del row[deledend]
             try:
-                contacts_writer.writerow(row)
-            except ValueError as ve:
+                contacts_writer.writerow(contact_cells(row, fieldnames))
+            except (csv.Error, TypeError) as problem:
                 fails += 1
-                print("Unwritable row:", row, "because of", ve)
+                print("Unwritable row:", row, "because of", problem)
     if fails == 0:
-        shutil.copyfile(tempname, os.path.expandvars(filename))
+        if os.path.exists(filename):
+            shutil.copymode(filename, tempname)
+        os.replace(tempname, filename)
+    else:
         os.unlink(tempname)
+    return fails == 0
+
+# Contacts recorded since the contacts file was last rewritten.  This
+# is kept as a CSV file of date, ID and event, which can be appended
+# to without reading or rewriting anything else.
+
+CONTACT_EVENTS = ('contact', 'keep-in-touch')
+
+# How big the event log can get before the contact script compacts it
+COMPACT_EVENT_LOG_SIZE = 8192
+
+def event_log_filename(filename):
+    """Return the name of the event log for a contacts file."""
+    return os.path.expandvars(filename) + ".events"
+
+def event_history_filename(filename):
+    """Return the name of the file that compacted events are kept in."""
+    return os.path.expandvars(filename) + ".history"
+
+def append_contact_event(filename, person_id, date, keep_in_touch=False):
+    """Add a contact to the event log of a contacts file."""
+    with open(event_log_filename(filename), 'a', newline='') as outstream:
+        csv.writer(outstream).writerow([date.isoformat(), person_id,
+                                        'keep-in-touch' if keep_in_touch else 'contact'])
+
+def read_contact_events(*event_files):
+    """Return the events from some event logs, as (date, ID, event) tuples.
+    Missing files are taken as empty, and malformed lines are skipped."""
+    events = []
+    for event_file in event_files:
+        try:
+            with open(event_file, newline='') as instream:
+                for row in csv.reader(instream):
+                    if len(row) != 3 or row[2] not in CONTACT_EVENTS:
+                        continue
+                    try:
+                        events.append((datetime.date.fromisoformat(row[0]), row[1], row[2]))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+    return events
+
+def fold_contact_events(filename, people_by_id):
+    """Apply the events in a contacts file's event log to the people read from it.
+    This includes the events from a compaction that didn't finish."""
+    log_file = event_log_filename(filename)
+    for date, person_id, event in read_contact_events(log_file + ".compacting", log_file):
+        person = people_by_id.get(person_id)
+        if person is None:
+            print("Contact event for unknown person", person_id)
+            continue
+        record_contact(person, date, keep_in_touch=(event == 'keep-in-touch'))
+
+def contact_history(filename, person_id=None):
+    """Return the recorded contacts, compacted or not, for someone or for everyone.
+    The result is a list of (date, ID, event) tuples in date order."""
+    log_file = event_log_filename(filename)
+    events = read_contact_events(event_history_filename(filename),
+                                 log_file + ".compacting", log_file)
+    return sorted(event for event in events
+                  if person_id is None or event[1] == person_id)
+
+def event_log_due_for_compaction(filename):
+    """Return whether a contacts file's event log has got big enough to compact."""
+    try:
+        return os.path.getsize(event_log_filename(filename)) >= COMPACT_EVENT_LOG_SIZE
+    except OSError:
+        return False
+
+def compact_contacts(filename):
+    """Merge the event log into a contacts file.
+    The log is moved aside first, so that contacts recorded while
+    this is happening go into a fresh log, and after the contacts file
+    has been rewritten, its events are added to the history file."""
+    filename = os.path.expandvars(filename)
+    log_file = event_log_filename(filename)
+    compacting_file = log_file + ".compacting"
+    if os.path.exists(log_file):
+        if os.path.exists(compacting_file):
+            # left from a compaction that didn't finish; keep its events first
+            with open(log_file) as instream, open(compacting_file, 'a') as outstream:
+                outstream.write(instream.read())
+            os.unlink(log_file)
+        else:
+            os.replace(log_file, compacting_file)
+    if not os.path.exists(compacting_file):
+        return False
+    people_by_id, people_by_name = read_contacts_file(filename)
+    for date, person_id, event in read_contact_events(compacting_file):
+        if person_id in people_by_id:
+            record_contact(people_by_id[person_id], date, keep_in_touch=(event == 'keep-in-touch'))
+    if not write_contacts(filename, people_by_name):
+        return False
+    with open(compacting_file) as instream, open(event_history_filename(filename), 'a') as outstream:
+        outstream.write(instream.read())
+    os.unlink(compacting_file)
+    return True
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""Answer questions about how people in the contacts file are related.
+
+The relationships are taken from the link fields once, into compact
+adjacency arrays, one set for each kind of relationship, so that
+questions like how two people are related don't have to go back
+through everyone's rows."""
+
+import argparse
+import array
+import collections
+import os
+
+import coimealta.contacts.contacts_data as contacts_data
+
+# The kinds of relationship, and the field each comes from
+RELATION_FIELDS = {
+    'parent': 'Parents',
+    'offspring': 'Offspring',
+    'sibling': 'Siblings',
+    'partner': 'Partners',
+    'knows': 'Knows',
+}
+
+RELATIONS = tuple(RELATION_FIELDS)
+
+# If y is x's parent, x is y's offspring; the rest go both ways
+INVERSE_RELATIONS = {
+    'parent': 'offspring',
+    'offspring': 'parent',
+    'sibling': 'sibling',
+    'partner': 'partner',
+    'knows': 'knows',
+}
+
+FAMILY_RELATIONS = ('parent', 'offspring', 'sibling', 'partner')
+
+def ordinal(n):
+    """Return an English ordinal for a small number."""
+    return {1: "first", 2: "second", 3: "third",
+            4: "fourth", 5: "fifth"}.get(n, "%dth" % n)
+
+def greats(n):
+    """Return the prefix for n generations beyond grand-."""
+    return "great-" * n
+
+def kinship_term(up, down):
+    """Describe someone reached by going up then down the given numbers of generations.
+    For example, up 2 and down 2 is a first cousin."""
+    if up == 0 and down == 0:
+        return "self"
+    if up == 0:
+        return ("child" if down == 1
+                else greats(down - 2) + "grandchild")
+    if down == 0:
+        return ("parent" if up == 1
+                else greats(up - 2) + "grandparent")
+    if up == 1 and down == 1:
+        return "sibling"
+    if up == 1:
+        return greats(down - 2) + "niece or nephew"
+    if down == 1:
+        return greats(up - 2) + "aunt or uncle"
+    degree = min(up, down) - 1
+    removed = abs(up - down)
+    return ordinal(degree) + " cousin" + (
+        "" if removed == 0
+        else " once removed" if removed == 1
+        else " twice removed" if removed == 2
+        else " %d times removed" % removed)
+
+class RelationshipGraph:
+
+    """The relationships between people, as adjacency arrays.
+
+    People are numbered in the order of by_id, and for each kind of
+    relationship there is an array of offsets into an array of the
+    numbers of the people at the other end of the links, so the
+    people related to person n in that way are
+    targets[offsets[n]:offsets[n+1]].
+
+    Links are made to go both ways whichever way round they are given
+    in the file, and links to IDs not in the file are left out (see
+    dangling)."""
+
+    def __init__(self, by_id):
+        self.by_id = by_id
+        self.ids = list(by_id)
+        self.index = {uid: n for n, uid in enumerate(self.ids)}
+        self.dangling = []
+        links = {relation: set() for relation in RELATIONS}
+        for uid, person in by_id.items():
+            here = self.index[uid]
+            for relation, field in RELATION_FIELDS.items():
+                for other in person.get(field) or ():
+                    there = self.index.get(other)
+                    if there is None:
+                        self.dangling.append((uid, relation, other))
+                        continue
+                    links[relation].add((here, there))
+                    links[INVERSE_RELATIONS[relation]].add((there, here))
+        self.offsets = {}
+        self.targets = {}
+        for relation, pairs in links.items():
+            self.offsets[relation], self.targets[relation] = self._compress(pairs)
+        self._components = {}
+        self._component_numbers = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _compress(self, pairs):
+        """Turn a set of (from, to) pairs into offset and target arrays."""
+        counts = [0] * (len(self.ids) + 1)
+        for here, _ in pairs:
+            counts[here + 1] += 1
+        for n in range(len(self.ids)):
+            counts[n + 1] += counts[n]
+        offsets = array.array('l', counts)
+        targets = array.array('l', bytes(offsets.itemsize * len(pairs)))
+        filled = counts[:-1]
+        for here, there in sorted(pairs):
+            targets[filled[here]] = there
+            filled[here] += 1
+        return offsets, targets
+
+    def related(self, n, relation):
+        """Return the numbers of the people related to person n in a given way."""
+        offsets = self.offsets[relation]
+        return self.targets[relation][offsets[n]:offsets[n + 1]]
+
+    def number(self, who):
+        """Return the number of a person given by ID."""
+        if who not in self.index:
+            raise KeyError("Could not find " + who)
+        return self.index[who]
+
+    def path(self, from_id, to_id, relations=RELATIONS):
+        """Find a shortest chain of relationships from one person to another.
+        Searches from both ends at once.  Returns a list of (ID, relation)
+        pairs, where each relation says what that person is to the one
+        before them (None for the first), or None if there is no chain."""
+        start, goal = self.number(from_id), self.number(to_id)
+        if start == goal:
+            return [(from_id, None)]
+        # each side maps a person to (previous person, relation between them)
+        forward = {start: None}
+        backward = {goal: None}
+        forward_frontier = [start]
+        backward_frontier = [goal]
+        meeting = None
+        while forward_frontier and backward_frontier and meeting is None:
+            expanding_forward = len(forward_frontier) <= len(backward_frontier)
+            frontier = forward_frontier if expanding_forward else backward_frontier
+            seen = forward if expanding_forward else backward
+            other_side = backward if expanding_forward else forward
+            next_frontier = []
+            for here in frontier:
+                for relation in relations:
+                    for there in self.related(here, relation):
+                        if there in seen:
+                            continue
+                        seen[there] = (here, relation)
+                        if there in other_side:
+                            meeting = there
+                            break
+                        next_frontier.append(there)
+                    if meeting is not None:
+                        break
+                if meeting is not None:
+                    break
+            if expanding_forward:
+                forward_frontier = next_frontier
+            else:
+                backward_frontier = next_frontier
+        if meeting is None:
+            return None
+        chain = []
+        here = meeting
+        while forward[here] is not None:
+            previous, relation = forward[here]
+            chain.append((here, relation))
+            here = previous
+        chain.append((start, None))
+        chain.reverse()
+        here = meeting
+        while backward[here] is not None:
+            following, relation = backward[here]
+            # the link was found going towards the start, so turn it round
+            chain.append((following, INVERSE_RELATIONS[relation]))
+            here = following
+        return [(self.ids[n], relation) for n, relation in chain]
+
+    def describe_path(self, chain):
+        """Describe a chain from path, such as "John Smith's partner's offspring"."""
+        if not chain:
+            return "unrelated"
+        words = [self.by_id[chain[0][0]]['_name_']]
+        for uid, relation in chain[1:]:
+            words.append("'s " + relation)
+        return "".join(words) + (" (" + self.by_id[chain[-1][0]]['_name_'] + ")"
+                                 if len(chain) > 1 else "")
+
+    def ancestors(self, who):
+        """Return a dictionary of the numbers of a person's ancestors, and the person, to generations up."""
+        start = self.number(who) if isinstance(who, str) else who
+        generations = {start: 0}
+        frontier = [start]
+        while frontier:
+            next_frontier = []
+            for here in frontier:
+                for parent in self.related(here, 'parent'):
+                    if parent not in generations:
+                        generations[parent] = generations[here] + 1
+                        next_frontier.append(parent)
+            frontier = next_frontier
+        return generations
+
+    def lowest_common_ancestors(self, one_id, other_id):
+        """Return the nearest common ancestors of two people.
+        These are the common ancestors none of whose offspring are also
+        common ancestors, as a list of (ID, generations above the first
+        person, generations above the second) tuples, nearest first.
+        Either person may be the ancestor."""
+        one_up = self.ancestors(one_id)
+        other_up = self.ancestors(other_id)
+        common = one_up.keys() & other_up.keys()
+        lowest = [ancestor for ancestor in common
+                  if not any(child in common
+                             for child in self.related(ancestor, 'offspring'))]
+        return sorted(((self.ids[ancestor], one_up[ancestor], other_up[ancestor])
+                       for ancestor in lowest),
+                      key=lambda found: (found[1] + found[2], found[0]))
+
+    def kinship(self, one_id, other_id):
+        """Describe what the second person is to the first, by descent.
+        Returns None if they have no common ancestor in the file."""
+        lowest = self.lowest_common_ancestors(one_id, other_id)
+        if not lowest:
+            return None
+        _, up, down = lowest[0]
+        return kinship_term(up, down)
+
+    def generations_between(self, one_id, other_id):
+        """Return how many generations the second person is above the first.
+        Partners and siblings count as the same generation, and the
+        result is negative for someone in a younger generation.
+        Returns None if they are not connected by family links."""
+        chain = self.path(one_id, other_id, relations=FAMILY_RELATIONS)
+        if chain is None:
+            return None
+        return sum(1 if relation == 'parent' else -1 if relation == 'offspring' else 0
+                   for _, relation in chain[1:])
+
+    def components(self, relations=FAMILY_RELATIONS):
+        """Label everyone with the number of the group of people they are linked to.
+        Returns an array giving each person's component number, in
+        order of size, largest first.  The result is cached for each
+        set of relations."""
+        key = tuple(relations)
+        if key in self._components:
+            return self._components[key]
+        label = array.array('l', [-1]) * len(self.ids)
+        sizes = []
+        for start in range(len(self.ids)):
+            if label[start] >= 0:
+                continue
+            component = len(sizes)
+            label[start] = component
+            stack = [start]
+            size = 0
+            while stack:
+                here = stack.pop()
+                size += 1
+                for relation in relations:
+                    for there in self.related(here, relation):
+                        if label[there] < 0:
+                            label[there] = component
+                            stack.append(there)
+            sizes.append(size)
+        renumbering = {old: new
+                       for new, old in enumerate(sorted(range(len(sizes)),
+                                                        key=lambda c: -sizes[c]))}
+        for n, component in enumerate(label):
+            label[n] = renumbering[component]
+        self._components[key] = label
+        return label
+
+    def component_numbers(self, relations=FAMILY_RELATIONS):
+        """Return lists of the numbers of the people in each component, largest first.
+        The result is cached for each set of relations."""
+        key = tuple(relations)
+        if key in self._component_numbers:
+            return self._component_numbers[key]
+        members = collections.defaultdict(list)
+        for n, component in enumerate(self.components(relations)):
+            members[component].append(n)
+        numbers = [members[component] for component in range(len(members))]
+        self._component_numbers[key] = numbers
+        return numbers
+
+    def component_members(self, relations=FAMILY_RELATIONS):
+        """Return lists of the IDs in each component, largest first."""
+        return [[self.ids[n] for n in numbers]
+                for numbers in self.component_numbers(relations)]
+
+    def same_component(self, one_id, other_id, relations=FAMILY_RELATIONS):
+        """Return whether two people are linked, however distantly."""
+        label = self.components(relations)
+        return label[self.number(one_id)] == label[self.number(other_id)]
+
+def find_person(who, by_id, by_name):
+    """Return the ID of a person given by name or ID."""
+    person = by_name.get(who, by_id.get(who))
+    if person is None:
+        raise ValueError("Could not find " + who)
+    return person['ID']
+
+def contacts_graph_main(contacts, components, people):
+    by_id, by_name = contacts_data.read_contacts(contacts)
+    graph = RelationshipGraph(by_id)
+    if components:
+        for members in graph.component_members():
+            if len(members) > 1:
+                print(len(members), contacts_data.names_string([by_id[member] for member in members]))
+    for one, other in zip(people[::2], people[1::2]):
+        one_id = find_person(one, by_id, by_name)
+        other_id = find_person(other, by_id, by_name)
+        print(graph.describe_path(graph.path(one_id, other_id)))
+        if (kinship := graph.kinship(one_id, other_id)):
+            print("  by descent:", kinship)
+        if (generations := graph.generations_between(one_id, other_id)) is not None:
+            print("  generations up:", generations)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contacts", "-c",
+                        default=os.path.expandvars("$ORG/contacts.csv"),
+                        help="""Name of contacts file.""")
+    parser.add_argument("--components", action='store_true',
+                        help="""List the groups of people linked by family relationships.""")
+    parser.add_argument("people", nargs='*',
+                        help="""Pairs of names or IDs of people to relate to each other.""")
+    return vars(parser.parse_args())
+
+if __name__ == "__main__":
+    contacts_graph_main(**get_args())
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+"""Keep statistics about the people in a contacts file.
+
+The counts are kept up to date person by person, as people are added,
+changed or removed, and saved beside the contacts file, so a report
+only has to read them."""
+
+import argparse
+import collections
+import json
+import re
+
+import coimealta.contacts.contacts_data as contacts_data
+
+# The fields counted by their values, and the names of their counters
+ASPECTS = {
+    'nationality': 'Nationality',
+    'gender': 'Gender',
+    'title': 'Title',
+    'place_met': 'Place met',
+}
+
+# Date fields counted by year
+YEAR_ASPECTS = {
+    'first_contact_year': 'First contact',
+    'in_touch_year': 'In touch',
+}
+
+# All the fields that person_contributions looks at
+COUNTED_FIELDS = (list(ASPECTS.values()) + ['Flags', 'Given name', 'Gender']
+                  + list(YEAR_ASPECTS.values()))
+
+ORDAINED_TITLES = ["Revd", "Revd Dr", "Revd Prof", "RtRevd"]
+DOCTORED_TITLES = ["Dr", "Revd Dr", "Prof", "Revd Prof", "MD"]
+
+STATS_VERSION = 2
+
+def year_of(date_string):
+    """Return the year at the start of a date string, or None."""
+    match = re.match("[0-9][0-9][0-9][0-9]", date_string or "")
+    return match.group(0) if match else None
+
+def fingerprint(person):
+    """Return a digest of the fields of a person that are counted."""
+    return contacts_data.fingerprint(person.get(field) or "" for field in COUNTED_FIELDS)
+
+def person_contributions(person):
+    """Return what a person adds to the counts, as (counter name, key) pairs."""
+    contributions = [(aspect, person.get(field) or "")
+                     for aspect, field in ASPECTS.items()]
+    contributions += [('flag', flag) for flag in sorted(set(person.get('Flags', "") or ""))]
+    given = person.get('Given name') or ""
+    contributions.append(('given:' + (person.get('Gender') or ""),
+                          contacts_data.EXPANDED_NAMES.get(given, given)))
+    for aspect, field in YEAR_ASPECTS.items():
+        if (year := year_of(person.get(field))):
+            contributions.append((aspect, year))
+    return tuple(contributions)
+
+class ContactStats:
+
+    """Counts of people by nationality, gender, title, place met, flag,
+    given name (by gender), and year of first and latest contact.
+
+    The contributions of each person are remembered, so that when
+    someone is changed, only the difference is applied to the counts,
+    and so is a fingerprint of the fields they were worked out from,
+    so that people who haven't changed can be passed over."""
+
+    def __init__(self, people=()):
+        self.counters = collections.defaultdict(collections.Counter)
+        self.contributions = {}
+        self.fingerprints = {}
+        self.signature = None
+        for person in people:
+            self.update(person)
+
+    def __len__(self):
+        return len(self.contributions)
+
+    def _apply(self, contributions, step):
+        for counter_name, key in contributions:
+            counter = self.counters[counter_name]
+            counter[key] += step
+            if counter[key] <= 0:
+                del counter[key]
+
+    def update(self, person):
+        """Add a person, or bring the counts up to date with changes to them."""
+        digest = fingerprint(person)
+        if self.fingerprints.get(person['ID']) == digest:
+            return
+        self.fingerprints[person['ID']] = digest
+        contributions = person_contributions(person)
+        old = self.contributions.get(person['ID'])
+        if old == contributions:
+            return
+        if old is not None:
+            self._apply(old, -1)
+        self._apply(contributions, 1)
+        self.contributions[person['ID']] = contributions
+
+    def remove(self, person_id):
+        """Take a person out of the counts."""
+        old = self.contributions.pop(person_id, None)
+        self.fingerprints.pop(person_id, None)
+        if old is not None:
+            self._apply(old, -1)
+
+    def counts(self, aspect):
+        """Return the counter for an aspect, such as 'nationality' or 'flag'."""
+        return self.counters.get(aspect, collections.Counter())
+
+    def given_names(self):
+        """Return a dictionary of counters of expanded given names, by gender."""
+        return {counter_name[len('given:'):]: counter
+                for counter_name, counter in self.counters.items()
+                if counter_name.startswith('given:')}
+
+    def by_year(self, aspect='first_contact_year'):
+        """Return a list of (year, count) pairs for a date aspect, in order of year."""
+        return sorted(self.counts(aspect).items())
+
+    def count_titles(self, titles):
+        title_counts = self.counts('title')
+        return sum(title_counts[title] for title in titles)
+
+    def as_json(self):
+        """Return the counts (without the per-person contributions) as JSON-ready data."""
+        return {
+            'n_people': len(self),
+            'ordained': self.count_titles(ORDAINED_TITLES),
+            'doctored': self.count_titles(DOCTORED_TITLES),
+            'counts': {name: dict(counter) for name, counter in sorted(self.counters.items())},
+        }
+
+    def save(self, filename):
+        """Save the stats, including what each person contributed, to a JSON file."""
+        contacts_data.write_atomically(
+            filename,
+            lambda outstream: json.dump({'version': STATS_VERSION,
+                                         'signature': self.signature,
+                                         'counters': self.counters,
+                                         'fingerprints': self.fingerprints,
+                                         'contributions': {uid: [list(pair) for pair in contributions]
+                                                           for uid, contributions in self.contributions.items()}},
+                                        outstream))
+
+    @classmethod
+    def load(cls, filename):
+        """Load stats saved by save, or return None if there aren't any usable ones."""
+        try:
+            with open(filename) as instream:
+                saved = json.load(instream)
+        except (OSError, ValueError):
+            return None
+        if saved.get('version') != STATS_VERSION:
+            return None
+        stats = cls()
+        stats.signature = saved.get('signature')
+        for counter_name, counts in saved['counters'].items():
+            stats.counters[counter_name] = collections.Counter(counts)
+        stats.fingerprints = saved['fingerprints']
+        stats.contributions = {uid: tuple(tuple(pair) for pair in contributions)
+                               for uid, contributions in saved['contributions'].items()}
+        return stats
+
+def stats_filename(filename):
+    """Return the name of the file to keep the stats for a contacts file in."""
+    return contacts_data.cache_filename(filename, "stats.json")
+
+def stats_for(filename, by_id=None):
+    """Return the stats for a contacts file.
+    Saved stats are used if the file hasn't changed since they were
+    saved; otherwise the saved ones are brought up to date from the
+    people in the file (read if not given), and saved again.  Only the
+    people whose counted fields have changed, and those who have gone,
+    make any difference to the counts."""
+    stats_file = stats_filename(filename)
+    signature = contacts_data.contacts_signature(filename)
+    stats = ContactStats.load(stats_file)
+    if stats is not None and stats.signature == signature:
+        return stats
+    if by_id is None:
+        by_id, _ = contacts_data.read_contacts(filename)
+    if stats is None:
+        stats = ContactStats()
+    for uid in [uid for uid in stats.contributions if uid not in by_id]:
+        stats.remove(uid)
+    for person in by_id.values():
+        stats.update(person)
+    stats.signature = signature
+    try:
+        stats.save(stats_file)
+    except OSError as problem:
+        print("Could not save stats for", filename, "because of", problem)
+    return stats
+
+def print_counts(counter, label):
+    """Print a counter's keys grouped by how often they occur, most frequent first."""
+    print(label, "; ".join("%s(%d)" % (key, count)
+                           for key, count in sorted(counter.items(),
+                                                    key=lambda item: (-item[1], item[0]))))
+
+def print_report(stats):
+    n_people = len(stats)
+    print(n_people, "people")
+    if n_people == 0:
+        return
+    print_counts(stats.counts('nationality'), "nationalities:")
+    print_counts(stats.counts('gender'), "genders:")
+    print_counts(stats.counts('title'), "titles:")
+    print_counts(stats.counts('place_met'), "places met:")
+    ordained = stats.count_titles(ORDAINED_TITLES)
+    print("%d ordained (%d%% of the people you know)" % (ordained, ordained * 100 / n_people))
+    doctored = stats.count_titles(DOCTORED_TITLES)
+    print("%d with doctorates (%d%% of the people you know)" % (doctored, doctored * 100 / n_people))
+
+def contacts_stats_main(contacts, json_output, by_year):
+    stats = stats_for(contacts)
+    if json_output:
+        print(json.dumps(stats.as_json(), indent=2, sort_keys=True))
+    elif by_year:
+        for year, count in stats.by_year(by_year):
+            print(year, count)
+    else:
+        print_report(stats)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", dest='json_output', action='store_true',
+                        help="""Output all the counts as JSON.""")
+    parser.add_argument("--by-year", choices=list(YEAR_ASPECTS),
+                        help="""List how many people there are for each year.""")
+    parser.add_argument("contacts")
+    return vars(parser.parse_args())
+
+if __name__ == "__main__":
+    contacts_stats_main(**get_args())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""Find people who may be in a contacts file more than once.
+
+Rather than compare everyone with everyone, people are put into
+blocks by keys that duplicates are likely to share (given name and
+how the surname sounds, email address, phone number), and only people
+in the same block are compared and scored."""
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import re
+import sys
+
+import coimealta.contacts.contacts_data as contacts_data
+
+# Blocks bigger than this are probably a common key such as a shared
+# family phone number, and comparing all their pairs would take too long
+MAX_BLOCK = 50
+
+SOUNDEX_CODES = {letter: str(code)
+                 for code, letters in enumerate(["aeiouyhw", "bfpv", "cgjkqsxz", "dt",
+                                                 "l", "mn", "r"])
+                 for letter in letters}
+
+def soundex(name):
+    """Return the Soundex code of a name, such as R163 for Robert."""
+    letters = [letter for letter in (name or "").casefold() if letter in SOUNDEX_CODES]
+    if not letters:
+        return ""
+    code = letters[0].upper()
+    previous = SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES[letter]
+        if digit != '0' and digit != previous:
+            code += digit
+        if letter not in "hw":
+            previous = digit
+    return (code + "000")[:4]
+
+def expanded_given_name(person):
+    given = (person.get('Given name') or "").strip()
+    return contacts_data.EXPANDED_NAMES.get(given, given).casefold()
+
+def email_addresses(person):
+    addresses = [person.get('Primary email') or ""]
+    addresses += re.split("[;, ]+", person.get('Other emails') or "")
+    return {address.strip().casefold() for address in addresses if '@' in address}
+
+def phone_numbers(person):
+    """Return the phone numbers of a person, reduced to their last nine digits.
+    That makes numbers match whether or not they are written with a
+    country code."""
+    numbers = set()
+    for field in ('Primary phone Value', 'Secondary phone Value'):
+        digits = re.sub("[^0-9]", "", person.get(field) or "")
+        if len(digits) >= 7:
+            numbers.add(digits[-9:])
+    return numbers
+
+def blocking_keys(person):
+    """Return the keys of the blocks a person goes in."""
+    keys = []
+    surname_code = soundex(person.get('Surname'))
+    if surname_code:
+        keys.append(('name', expanded_given_name(person), surname_code))
+    for old_name in re.split("[;,]", person.get('Old name') or ""):
+        if (old_code := soundex(old_name.strip())):
+            keys.append(('name', expanded_given_name(person), old_code))
+    keys += [('email', address) for address in email_addresses(person)]
+    keys += [('phone', number) for number in phone_numbers(person)]
+    return keys
+
+def candidate_pairs(people, sources=None):
+    """Return the pairs of positions in a list of people that share a block.
+    If sources is given (a list parallel to people), only pairs of
+    people from different sources are returned; people with the same
+    ID in both sources are one person, so they are not compared with
+    themselves, nor their pairs with other people found twice.  Also
+    returns the keys of any blocks that were too big to compare."""
+    blocks = collections.defaultdict(list)
+    for position, person in enumerate(people):
+        for key in blocking_keys(person):
+            blocks[key].append(position)
+    pairs = set()
+    id_pairs = set()
+    skipped = []
+    for key, members in blocks.items():
+        if len(members) < 2:
+            continue
+        if len(members) > MAX_BLOCK:
+            skipped.append(key)
+            continue
+        for one, other in itertools.combinations(members, 2):
+            if sources is None:
+                pairs.add((one, other))
+            elif sources[one] != sources[other]:
+                one_id, other_id = people[one].get('ID'), people[other].get('ID')
+                if one_id and other_id:
+                    if one_id == other_id or frozenset((one_id, other_id)) in id_pairs:
+                        continue
+                    id_pairs.add(frozenset((one_id, other_id)))
+                pairs.add((one, other))
+    return pairs, skipped
+
+def score_pair(one, other):
+    """Score how likely two people are to be the same person.
+    Returns the score and a list of the reasons for it."""
+    score = 0
+    reasons = []
+    one_surname = (one.get('Surname') or "").casefold()
+    other_surname = (other.get('Surname') or "").casefold()
+    if one.get('_name_') and one.get('_name_') == other.get('_name_'):
+        score += 3
+        reasons.append("same name")
+    elif expanded_given_name(one) == expanded_given_name(other):
+        if one_surname == other_surname:
+            score += 2
+            reasons.append("same given name and surname")
+        elif soundex(one_surname) == soundex(other_surname):
+            score += 1
+            reasons.append("same given name, similar surname")
+    if email_addresses(one) & email_addresses(other):
+        score += 3
+        reasons.append("same email")
+    if phone_numbers(one) & phone_numbers(other):
+        score += 2
+        reasons.append("same phone")
+    one_birthday = contacts_data.birthday_month_day(one)
+    other_birthday = contacts_data.birthday_month_day(other)
+    if one_birthday and other_birthday:
+        if one_birthday == other_birthday:
+            score += 2
+            reasons.append("same birthday")
+        else:
+            score -= 2
+            reasons.append("different birthdays")
+    one_address = contacts_data.address_key(one)
+    if one_address and one_address == contacts_data.address_key(other):
+        score += 1
+        reasons.append("same address")
+    one_gender = one.get('Gender')
+    other_gender = other.get('Gender')
+    if one_gender and other_gender and one_gender != other_gender:
+        score -= 3
+        reasons.append("different genders")
+    return score, reasons
+
+def filled_fields(person):
+    return sum(1 for field in contacts_data.FIELD_NAMES if person.get(field))
+
+def find_duplicates(people, sources=None, threshold=3):
+    """Return suggested merges among a list of people, best first.
+    Each suggestion is a (score, reasons, keep, merge) tuple, where keep
+    is the person with more filled-in fields and merge the other one.
+    Also returns the keys of any blocks too big to compare."""
+    pairs, skipped = candidate_pairs(people, sources)
+    suggestions = []
+    for one, other in pairs:
+        score, reasons = score_pair(people[one], people[other])
+        if score >= threshold:
+            keep, merge = ((people[one], people[other])
+                           if filled_fields(people[one]) >= filled_fields(people[other])
+                           else (people[other], people[one]))
+            suggestions.append((score, reasons, keep, merge))
+    suggestions.sort(key=lambda suggestion: (-suggestion[0],
+                                             suggestion[2].get('_name_') or "",
+                                             suggestion[3].get('_name_') or ""))
+    return suggestions, skipped
+
+def describe(person):
+    return "%s (%s)" % (person.get('_name_') or contacts_data.make_name(person), person.get('ID') or "no ID")
+
+def dedupe_contacts_main(contacts, against, threshold, json_output):
+    by_id, _ = contacts_data.read_contacts(contacts)
+    people = list(by_id.values())
+    sources = None
+    if against:
+        other_by_id, _ = contacts_data.read_contacts(against)
+        sources = [contacts] * len(people) + [against] * len(other_by_id)
+        people += list(other_by_id.values())
+        if (already_known := len(by_id.keys() & other_by_id.keys())):
+            print(already_known, "people are already in both files, with the same IDs", file=sys.stderr)
+    suggestions, skipped = find_duplicates(people, sources, threshold)
+    if json_output:
+        json.dump([{'score': score, 'reasons': reasons,
+                    'keep': keep.get('ID'), 'keep_name': keep.get('_name_'),
+                    'merge': merge.get('ID'), 'merge_name': merge.get('_name_')}
+                   for score, reasons, keep, merge in suggestions],
+                  sys.stdout, indent=2)
+        print()
+    else:
+        for score, reasons, keep, merge in suggestions:
+            print("%3d  merge %s into %s: %s" % (score, describe(merge), describe(keep), ", ".join(reasons)))
+    for key in skipped:
+        print("Not compared, too many people with", key[0], " ".join(key[1:]), file=sys.stderr)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--against", "-a",
+                        help="""Another contacts file to check against, such as one to be imported.
+                        Only people in different files are compared.""")
+    parser.add_argument("--threshold", "-t", type=int, default=3,
+                        help="""The lowest score to suggest a merge for.""")
+    parser.add_argument("--json", dest='json_output', action='store_true',
+                        help="""Output the suggestions as JSON.""")
+    parser.add_argument("contacts",
+                        nargs='?',
+                        default=os.path.expandvars("$ORG/contacts.csv"),
+                        help="""The contacts file to check.""")
+    return vars(parser.parse_args())
+
+if __name__ == "__main__":
+    dedupe_contacts_main(**get_args())
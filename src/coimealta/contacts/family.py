@@ -5,76 +5,119 @@ import collections
 import os
 
 import coimealta.contacts.contacts_data as contacts_data
+import coimealta.contacts.contacts_graph as contacts_graph
+
+# How many generations up each kind of link goes
+GENERATION_STEPS = {
+    'parent': 1,
+    'offspring': -1,
+    'partner': 0,
+    'sibling': 0,
+}
+
+DEFAULT_RELATIONS = ('parent', 'offspring', 'partner')
 
 def gv_people_list(people):
     return "{" + ",".join(people) + "}"
 
-def family_graph_main(person, across, contacts, output):
+def family_members(graph, start, relations=DEFAULT_RELATIONS, up=None, down=None):
+    """Return the numbers of the people to include in a family chart.
+    These are the people reachable from the starting person (a
+    number) through the given kinds of link, going no more than up
+    generations above them or down generations below them.  Without
+    any bounds, that is the whole component, which is taken from the
+    graph's cached component index rather than walked again."""
+    if up is None and down is None:
+        return list(graph.component_numbers(relations)[graph.components(relations)[start]])
+    highest = float('inf') if up is None else up
+    lowest = -float('inf') if down is None else -down
+    generation = {start: 0}
+    queue = collections.deque([start])
+    while queue:
+        here = queue.popleft()
+        for relation in relations:
+            there_generation = generation[here] + GENERATION_STEPS[relation]
+            if not lowest <= there_generation <= highest:
+                continue
+            for there in graph.related(here, relation):
+                if there not in generation:
+                    generation[there] = there_generation
+                    queue.append(there)
+    return list(generation)
+
+def family_graph_dot(graph, members, relations=DEFAULT_RELATIONS, across=False):
+    """Return the graphviz text for a family chart of the given people (by number)."""
+    by_id = graph.by_id
+    ids = graph.ids
+    included = set(members)
+    links = {}
+    couples = collections.defaultdict(set)
+    singles = []
 
-    """Update the connections between people, in the contacts file.
-    Fills in the other direction for any that are given in only
-    one direction."""
+    def link(from_n, to_n, style):
+        link_key = (from_n, to_n) if from_n < to_n else (to_n, from_n)
+        if link_key not in links:
+            links[link_key] = f"      {ids[from_n]} -> {ids[to_n]} {style}\n"
 
-    by_id, by_name = contacts_data.read_contacts(contacts)
+    def person_line(n, margin="  "):
+        person = by_id[ids[n]]
+        shape = "hexagon" if person.get('Gender') == 'm' else "octagon"
+        dashed = "style=dashed" if person.get('Died') else ""
+        return f"""{margin}{ids[n]} [label="{person['_initialled_name_']}" shape={shape} {dashed}]\n"""
 
-    starting_person = by_name.get(person, by_id.get(person))
-    if not starting_person:
-        raise ValueError("Could not find " + person)
+    for n in members:
+        if 'offspring' in relations or 'parent' in relations:
+            for offspring in graph.related(n, 'offspring'):
+                if offspring in included:
+                    link(n, offspring, "[style=solid]")
+        if 'sibling' in relations:
+            for sibling in graph.related(n, 'sibling'):
+                if sibling in included:
+                    link(n, sibling, "[style=dashed arrowhead=none]")
+        partners = ([partner for partner in graph.related(n, 'partner') if partner in included]
+                    if 'partner' in relations
+                    else [])
+        if partners:
+            couples["_".join(sorted(ids[who] for who in [n] + partners))].add(n)
+            for partner in partners:
+                link(n, partner, "[style=bold arrowhead=none]")
+        else:
+            singles.append(n)
 
-    already_seen = set()
-    already_linked = {}
-    couples = collections.defaultdict(set)
-    singles = set()
-    queue = [starting_person['ID']]
-
-    def add(p_id):
-        if p_id not in already_seen:
-            queue.append(p_id)
-
-    def link(from_id, to_id, style):
-        link_key = (from_id, to_id) if from_id < to_id else (to_id, from_id)
-        if link_key not in already_linked:
-            already_linked[link_key] = f"      {from_id} -> {to_id} {style}\n"
-
-    def write_person(uid, person, margin="  "):
-        outstream.write(f"""{margin}{uid} [label="{person['_initialled_name_']}" shape={("hexagon" if person['Gender'] == 'm' else "octagon")} {"style=dashed" if person['Died'] else ""}]\n""")
-
-    with open(output or (person + ".gv"), "w") as outstream:
-        outstream.write("digraph {\n")
-        if across:
-            outstream.write("  rankdir=LR\n")
-        while queue:
-            uid = queue.pop()
-            person = by_id[uid]
-            already_seen.add(uid)
-            their_offspring = person['Offspring'] or []
-            for offspring in their_offspring:
-                link(uid, offspring, "[style=solid]")
-                add(offspring)
-            their_parents = person['Parents'] or []
-            for parent in their_parents:
-                link(parent, uid, "[style=solid]")
-                add(parent)
-            their_partners = person['Partners']
-            if their_partners:
-                for partner in their_partners:
-                    couple_id = "_".join(sorted([uid] + list(their_partners)))
-                    couples[couple_id].add(uid)
-                    link(uid, partner, "[style=bold arrowhead=none]")
-                    add(partner)
-            else:
-                singles.add(uid)
-        for who in singles:
-            write_person(who, by_id[who])
-        for couple_key, couple_members in couples.items():
-            outstream.write(f"  subgraph cluster_{couple_key}" + " {\n")
-            for member in couple_members:
-                write_person(member, by_id[member], margin="    ")
-            outstream.write("  }\n")
-            # outstream.write("    {rank=same " + uid + " " + gv_people_list(their_partners) + "}\n")
-        for link in already_linked.values():
-            outstream.write(link)
-        outstream.write("}\n")
+    lines = ["digraph {\n"]
+    if across:
+        lines.append("  rankdir=LR\n")
+    lines.extend(person_line(who) for who in singles)
+    for couple_key, couple_members in couples.items():
+        lines.append(f"  subgraph cluster_{couple_key}" + " {\n")
+        lines.extend(person_line(member, margin="    ") for member in couple_members)
+        lines.append("  }\n")
+    lines.extend(links.values())
+    lines.append("}\n")
+    return "".join(lines)
+
+def family_graph_main(people, across, contacts, output, up=None, down=None, relations=None):
+
+    """Write graphviz family charts for people in the contacts file.
+    Each chart goes to a file named after the person, or to the output
+    file if there is only one person."""
+
+    by_id, by_name = contacts_data.read_contacts(contacts)
+    relations = tuple(relations.split(',')) if relations else DEFAULT_RELATIONS
+    for relation in relations:
+        if relation not in GENERATION_STEPS:
+            raise ValueError("Unknown relation " + relation)
+    graph = contacts_graph.RelationshipGraph(by_id)
+
+    for person in people:
+        starting_person = by_name.get(person, by_id.get(person))
+        if not starting_person:
+            raise ValueError("Could not find " + person)
+        members = family_members(graph, graph.number(starting_person['ID']),
+                                 relations=relations, up=up, down=down)
+        text = family_graph_dot(graph, members, relations=relations, across=across)
+        with open((output if output and len(people) == 1 else None) or (person + ".gv"), "w") as outstream:
+            outstream.write(text)
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -82,10 +125,18 @@ def get_args():
                         default=os.path.expandvars("$ORG/contacts.csv"),
                         help="""Name of contacts file.""")
     parser.add_argument("--output", "-o",
-                        help="""Name of output file.""")
+                        help="""Name of output file, if there is only one person.""")
     parser.add_argument("--across", action='store_true')
-    parser.add_argument("person",
-                        help="""Name or ID of person to start from.""")
+    parser.add_argument("--up", "-u", type=int,
+                        help="""How many generations above each person to go.""")
+    parser.add_argument("--down", "-d", type=int,
+                        help="""How many generations below each person to go.""")
+    parser.add_argument("--relations", "-r",
+                        help="""Comma-separated kinds of link to follow,
+                        from parent, offspring, partner, and sibling.
+                        The default is parent,offspring,partner.""")
+    parser.add_argument("people", nargs='+',
+                        help="""Names or IDs of people to start from.""")
     return vars(parser.parse_args())
 
 if __name__ == "__main__":
@@ -1,129 +1,255 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
+import concurrent.futures
+import itertools
+import os
+from xml.sax.saxutils import escape
 
-def read_labels(input_file):
+def iter_labels(input_file):
+    """Read labels from a file lazily, yielding each as a list of lines.
+    Labels are separated by blank lines."""
     with open(input_file) as instream:
-        all_lines = instream.readlines()
-        labels = []
         lines = []
-        for line in all_lines:
+        for line in instream:
             line = line.strip()
             if line == "":
-                labels.append(lines)
+                if lines:
+                    yield lines
                 lines = []
             else:
                 lines.append(line)
-        labels.append(lines)
-    return labels
+        if lines:
+            yield lines
 
 def labels_to_pages(labels, n_per_page):
-    return [labels[i:i + n_per_page] for i in range(0, len(labels), n_per_page)]
-    
-def begin_page(outstream, w, h):
-    outstream.write('<svg width="%gmm" height="%gmm" viewBox="0 0 %g %g">\n' % (w, h, w, h))
+    """Group labels into pages, lazily."""
+    labels = iter(labels)
+    while (page := list(itertools.islice(labels, n_per_page))):
+        yield page
 
-def end_page(outstream):
-    outstream.write('</svg>\n')
-
-def write_label_at(x, y, config, label_lines, outstream):
+def label_svg(x, y, config, label_lines):
+    """Return the SVG for a label placed at a given position."""
     leading = config['leading']
     fontsize = config['label-height'] / ((len(label_lines) + 1) * leading)
     if config['verbose']:
         print("placing", label_lines[0], "at", x, y, "using fontsize", fontsize)
-    outstream.write('  <g transform="translate(%g,%g)">\n' % (x, y))
+    parts = ['  <g transform="translate(%g,%g)">\n' % (x, y)]
     if config['outline']:
-        outstream.write('    <rect x="0" y="0" width="%g" height="%g" fill="white" stroke="green"/>\n' % (config['label-width'], config['label-height']))
-    outstream.write('    <g transform="translate(%g,%g)">\n' % (config['label-left-margin'], config['label-top-margin']))
-    outstream.write('      <text font-size="%g">\n' % fontsize)
+        parts.append('    <rect x="0" y="0" width="%g" height="%g" fill="white" stroke="green"/>\n' % (config['label-width'], config['label-height']))
+    parts.append('    <g transform="translate(%g,%g)">\n' % (config['label-left-margin'], config['label-top-margin']))
+    parts.append('      <text font-size="%g">\n' % fontsize)
     for iline, line in enumerate(label_lines):
-        outstream.write('        <tspan x="0" y="%gem">%s</tspan>\n' % ((iline+1) * leading, line))
-    outstream.write('      </text>\n')
-    outstream.write('    </g>\n')
-    outstream.write('  </g>\n')
+        parts.append('        <tspan x="0" y="%gem">%s</tspan>\n' % ((iline+1) * leading, escape(line)))
+    parts.append('      </text>\n')
+    parts.append('    </g>\n')
+    parts.append('  </g>\n')
+    return "".join(parts)
 
-def main():
-    parser = argparse.ArgumentParser()
-    # the defaults are for labelplanet's LP12/99 label sheet
-    parser.add_argument("-x", "--across",
-                        type=int, default=2,
+# The label sheet used unless another is described: labelplanet's LP12/99
+DEFAULT_SHEET = {
+    'columns': 2,
+    'rows': 6,
+    'width': 99.1,
+    'height': 42.3,
+    'top_margin': 21.6,
+    'left_margin': 4.65,
+    'horizontal_gap': 2.5,
+    'vertical_gap': 2.5,
+}
+
+def label_config(width, height, horizontal_gap, vertical_gap, outline=False, verbose=False):
+    """Return the settings that label_svg uses for each label."""
+    return {
+        'outline': outline,
+        'leading': 1.2,
+        'label-width': width,
+        'label-height': height,
+        'vertical-gap': vertical_gap,
+        'horizontal-gap': horizontal_gap,
+        'label-left-margin': 5,
+        'label-top-margin': 0,
+        'verbose': verbose
+    }
+
+class SheetLayout:
+
+    """The layout of a sheet of labels, worked out once for all the pages.
+
+    The labels go down each column, then on to the next column.  Any
+    measurement not given is taken from DEFAULT_SHEET, and without a
+    config, the labels are drawn with the settings from label_config."""
+
+    def __init__(self, columns=None, rows=None, width=None, height=None,
+                 top_margin=None, left_margin=None, horizontal_gap=None, vertical_gap=None,
+                 config=None):
+        columns = DEFAULT_SHEET['columns'] if columns is None else columns
+        rows = DEFAULT_SHEET['rows'] if rows is None else rows
+        width = DEFAULT_SHEET['width'] if width is None else width
+        height = DEFAULT_SHEET['height'] if height is None else height
+        top_margin = DEFAULT_SHEET['top_margin'] if top_margin is None else top_margin
+        left_margin = DEFAULT_SHEET['left_margin'] if left_margin is None else left_margin
+        horizontal_gap = DEFAULT_SHEET['horizontal_gap'] if horizontal_gap is None else horizontal_gap
+        vertical_gap = DEFAULT_SHEET['vertical_gap'] if vertical_gap is None else vertical_gap
+        self.config = config or label_config(width, height, horizontal_gap, vertical_gap)
+        label_width_with_gap = width + horizontal_gap
+        label_height_with_gap = height + vertical_gap
+        self.page_width = left_margin + label_width_with_gap * columns + left_margin
+        self.page_height = top_margin + label_height_with_gap * rows + top_margin
+        self.positions = [(left_margin + column * label_width_with_gap,
+                           top_margin + row * label_height_with_gap)
+                          for column in range(columns)
+                          for row in range(rows)]
+        self.page_start = ('<svg width="%gmm" height="%gmm" viewBox="0 0 %g %g">\n'
+                           % (self.page_width, self.page_height, self.page_width, self.page_height))
+        self.page_end = '</svg>\n'
+
+    @property
+    def labels_per_page(self):
+        return len(self.positions)
+
+    def render_page(self, labels):
+        """Return the SVG for a page of labels."""
+        return "".join([self.page_start]
+                       + [label_svg(x, y, self.config, label)
+                          for (x, y), label in zip(self.positions, labels)]
+                       + [self.page_end])
+
+def render_page_file(layout, labels, filename):
+    """Write a page of labels to a file of its own, returning the filename."""
+    with open(filename, 'w') as outstream:
+        outstream.write(layout.render_page(labels))
+    return filename
+
+def write_combined_start(outstream):
+    outstream.write('<!DOCTYPE html>\n<html>\n<head>\n'
+                    '<style>svg { display: block; page-break-after: always; }'
+                    ' @page { margin: 0; }</style>\n'
+                    '</head>\n<body>\n')
+
+def write_combined_end(outstream):
+    outstream.write('</body>\n</html>\n')
+
+def render_labels(labels, layout, output="labels-%d.svg", combined=None, workers=None):
+    """Lay out labels (an iterable of lists of lines) on pages, in parallel.
+
+    Each page goes to a file named by output % page number, or, if
+    combined is given, all the pages go one after another into that
+    file, as an HTML document that prints one page per sheet.  Only a
+    few pages are held in memory at a time, however many labels there
+    are.  Returns the number of pages."""
+    n_pages = 0
+    combined_stream = open(combined, 'w') if combined else None
+    try:
+        if combined_stream:
+            write_combined_start(combined_stream)
+
+        def finish(result):
+            if combined_stream:
+                combined_stream.write(result)
+
+        pages = labels_to_pages(labels, layout.labels_per_page)
+        if workers == 1:
+            for ipage, page in enumerate(pages):
+                finish(layout.render_page(page) if combined_stream
+                       else render_page_file(layout, page, output % ipage))
+                n_pages += 1
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                window = 2 * (workers or os.cpu_count() or 1)
+                pending = collections.deque()
+                for ipage, page in enumerate(pages):
+                    pending.append(pool.submit(layout.render_page, page)
+                                   if combined_stream
+                                   else pool.submit(render_page_file, layout, page, output % ipage))
+                    n_pages += 1
+                    if len(pending) >= window:
+                        finish(pending.popleft().result())
+                while pending:
+                    finish(pending.popleft().result())
+        if combined_stream:
+            write_combined_end(combined_stream)
+    finally:
+        if combined_stream:
+            combined_stream.close()
+    return n_pages
+
+def add_layout_arguments(parser, short_options=True, output_options=True):
+    """Add the arguments that describe the label sheet and the output.
+    Programs with short options of their own can leave out the short
+    forms of these, and programs that choose their own output files
+    can leave out the output options."""
+
+    def names(short, *long):
+        return ([short] if short_options else []) + list(long)
+
+    parser.add_argument(*names("-x", "--across"),
+                        type=int, default=DEFAULT_SHEET['columns'],
                         help="""How many labels fit across the page.""")
-    parser.add_argument("-y", "--down",
-                        type=int, default=6,
+    parser.add_argument(*names("-y", "--down"),
+                        type=int, default=DEFAULT_SHEET['rows'],
                         help="""How many labels fit down the page.""")
-    parser.add_argument("-H", "--height",
-                        type=float, default=42.3,
+    parser.add_argument(*names("-H", "--height"),
+                        type=float, default=DEFAULT_SHEET['height'],
                         help="""The height of each label (excluding gap, margins etc)""")
-    parser.add_argument("-W", "--width",
-                        type=float, default=99.1,
+    parser.add_argument(*names("-W", "--width"),
+                        type=float, default=DEFAULT_SHEET['width'],
                         help="""The width of each label (excluding gap, margins etc)""")
-    parser.add_argument("-t", "--top-margin", "--top",
-                        type=float, default=21.6,
+    parser.add_argument(*names("-t", "--top-margin", "--top"),
+                        type=float, default=DEFAULT_SHEET['top_margin'],
                         help="""The top margin of the page.""")
-    parser.add_argument("-l", "--left-margin", "--left",
-                        type=float, default=4.65,
+    parser.add_argument(*names("-l", "--left-margin", "--left"),
+                        type=float, default=DEFAULT_SHEET['left_margin'],
                         help="""The left margin of the page.""")
-    parser.add_argument("-g", "--horizontal-gap",
-                        type=float, default=2.5,
+    parser.add_argument(*names("-g", "--horizontal-gap"),
+                        type=float, default=DEFAULT_SHEET['horizontal_gap'],
                         help="""The horizontal gap between labels.""")
-    parser.add_argument("-V", "--vertical-gap",
-                        type=float, default=2.5,
+    parser.add_argument(*names("-V", "--vertical-gap"),
+                        type=float, default=DEFAULT_SHEET['vertical_gap'],
                         help="""The vertical gap between labels.""")
-    parser.add_argument("-v", "--verbose",
-                        action='store_true',
-                        help="""Produce explanatory output.""")
-    parser.add_argument("-b", "--box",
+    parser.add_argument(*names("-b", "--box"),
                         action='store_true',
                         help="""Draw a box around each label.""")
-    parser.add_argument("-o", "--output",
-                        default="labels-%d.svg",
-                        help="""The file to write the formatted labels into.""")
+    if output_options:
+        parser.add_argument(*names("-v", "--verbose"),
+                            action='store_true',
+                            help="""Produce explanatory output.""")
+        parser.add_argument(*names("-o", "--output"),
+                            default="labels-%d.svg",
+                            help="""The file to write the formatted labels into.""")
+        parser.add_argument(*names("-c", "--combined"),
+                            help="""Write all the pages into this one HTML file, instead of a file per page.""")
+        parser.add_argument(*names("-w", "--workers"),
+                            type=int,
+                            help="""How many processes to render pages with.""")
+
+def layout_from_args(args):
+    """Make the sheet layout described by the arguments added by add_layout_arguments."""
+    return SheetLayout(args.across, args.down, args.width, args.height,
+                       args.top_margin, args.left_margin,
+                       args.horizontal_gap, args.vertical_gap,
+                       label_config(args.width, args.height,
+                                    args.horizontal_gap, args.vertical_gap,
+                                    outline=args.box,
+                                    verbose=getattr(args, 'verbose', False)))
+
+def default_layout(verbose=False):
+    """Return the layout for the default label sheet."""
+    return SheetLayout(config=label_config(DEFAULT_SHEET['width'], DEFAULT_SHEET['height'],
+                                           DEFAULT_SHEET['horizontal_gap'], DEFAULT_SHEET['vertical_gap'],
+                                           verbose=verbose))
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_layout_arguments(parser)
     parser.add_argument("input_file")
     args = parser.parse_args()
 
-    columns = args.across
-    rows = args.down
-
-    left_margin = args.left_margin
-    top_margin = args.top_margin
-    right_margin = left_margin
-    bottom_margin = top_margin
-    label_width_with_gap = args.width + args.horizontal_gap
-    label_height_with_gap = args.height + args.vertical_gap 
-    page_width = left_margin + label_width_with_gap * columns + right_margin
-    page_height = top_margin + label_height_with_gap * rows + bottom_margin
+    n_pages = render_labels(iter_labels(args.input_file), layout_from_args(args),
+                            output=args.output, combined=args.combined, workers=args.workers)
+    if args.verbose:
+        print("wrote", n_pages, "pages")
 
-    config = {
-        'outline': args.box,
-        'leading': 1.2,
-        'label-width': args.width,
-        'label-height': args.height,
-        'vertical-gap': args.vertical_gap,
-        'horizontal-gap': args.horizontal_gap,
-        'label-left-margin': 5,
-        'label-top-margin': 0,
-        'verbose': args.verbose
-    }
-    
-    for ipage, page in enumerate(labels_to_pages(read_labels(args.input_file), rows * columns)):
-        with open(args.output % ipage, 'w') as outstream:
-            row = 0
-            column = 0
-            begin_page(outstream, page_width, page_height)
-            for label in page:
-                write_label_at(left_margin + column * label_width_with_gap,
-                               top_margin + row * label_height_with_gap,
-                               config,
-                               label,
-                               outstream)
-                row += 1
-                if row == rows:
-                    if args.verbose:
-                        print("next label below the last would be at", top_margin + row * label_height_with_gap)
-                    row = 0
-                    column += 1
-            end_page(outstream)
-    
 if __name__ == "__main__":
     main()
-    
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+"""Import contacts exported from elsewhere into a contacts file.
+
+vCard files, and the CSV files that Google Contacts and Outlook
+export, are read an entry at a time.  Each entry is matched against
+the people already there by email address, phone number and name,
+using dictionaries keyed by them, so each entry costs about the same
+however many people there are; a matching person gets any details
+they didn't have, and anyone else is added.  The contacts file is
+written once, at the end."""
+
+import argparse
+import csv
+import os
+import quopri
+import re
+
+import coimealta.contacts.contacts_data as contacts_data
+import coimealta.contacts.dedupe_contacts as dedupe_contacts
+
+# Columns of foreign CSV files, and the fields they go into.  Both
+# Google's and Outlook's column names are here; they don't clash.
+CSV_COLUMNS = {
+    # Google, old and new
+    'Given Name': 'Given name',
+    'Additional Name': 'Middle names',
+    'Family Name': 'Surname',
+    'Name Prefix': 'Title',
+    'Nickname': 'AKA',
+    'Birthday': 'Birthday',
+    'Gender': 'Gender',
+    'Notes': 'Notes',
+    'Group Membership': 'Group Membership',
+    'Labels': 'Group Membership',
+    'Organization 1 - Name': 'Organizations',
+    'Organization 1 - Title': 'Jobs',
+    'Organization Name': 'Organizations',
+    'Organization Title': 'Jobs',
+    'Address 1 - Street': 'Street',
+    'Address 1 - City': 'City',
+    'Address 1 - Region': 'State',
+    'Address 1 - Postal Code': 'Postal Code',
+    'Address 1 - Country': 'Country',
+    'Address 1 - Extended Address': 'Extended Address',
+    # Outlook (and the newer Google format)
+    'First Name': 'Given name',
+    'Middle Name': 'Middle names',
+    'Last Name': 'Surname',
+    'Title': 'Title',
+    'Company': 'Organizations',
+    'Job Title': 'Jobs',
+    'Categories': 'Group Membership',
+    'Home Street': 'Street',
+    'Home City': 'City',
+    'Home State': 'State',
+    'Home Postal Code': 'Postal Code',
+    'Home Country/Region': 'Country',
+}
+
+# Outlook's email and phone columns, with the types of the phones
+OUTLOOK_EMAIL_COLUMNS = ['E-mail Address', 'E-mail 2 Address', 'E-mail 3 Address']
+OUTLOOK_PHONE_COLUMNS = {'Mobile Phone': 'Mobile',
+                         'Home Phone': 'Home',
+                         'Business Phone': 'Work',
+                         'Other Phone': 'Other'}
+
+GOOGLE_EMAIL_COLUMN = re.compile(r"E-mail [0-9]+ - Value")
+GOOGLE_PHONE_COLUMN = re.compile(r"Phone ([0-9]+) - Value")
+
+# Google puts several values in a cell with this between them
+GOOGLE_SEPARATOR = " ::: "
+
+# Fields that are filled in from the first of several values, and
+# those that the later values go into
+EMAIL_FIELDS = ('Primary email', 'Other emails')
+PHONE_FIELDS = (('Primary phone Type', 'Primary phone Value'),
+                ('Secondary phone Type', 'Secondary phone Value'))
+
+def new_entry():
+    """Return an empty imported entry.
+    Entries are dictionaries of fields, with lists for the emails,
+    phones (as (type, number) pairs) and the multi-fields."""
+    return {'emails': [], 'phones': []}
+
+def add_value(entry, field, value):
+    value = (value or "").strip()
+    if not value:
+        return
+    if field in contacts_data.MULTI_FIELDS:
+        entry.setdefault(field, []).append(value)
+    elif not entry.get(field):
+        entry[field] = value
+
+def normalize_birthday(text):
+    """Return a birthday in the ISO form used in the contacts file.
+    A missing year is written as --MM-DD.  Anything not recognised is
+    returned as it is."""
+    text = (text or "").strip()
+    if (match := re.fullmatch(r"([0-9]{4})-?([0-9]{2})-?([0-9]{2})(T.*)?", text)):
+        return "%s-%s-%s" % match.group(1, 2, 3)
+    if (match := re.fullmatch(r"--([0-9]{2})-?([0-9]{2})", text)):
+        return "--%s-%s" % match.group(1, 2)
+    if (match := re.fullmatch(r"([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})", text)):
+        # Outlook writes dates month first
+        month, day, year = (int(part) for part in match.group(1, 2, 3))
+        return "%04d-%02d-%02d" % (year, month, day) if month and day else ""
+    return text
+
+def split_full_name(entry, full_name):
+    """Fill in the given name and surname from a full name, if they are missing."""
+    words = full_name.split()
+    if words and not entry.get('Given name') and not entry.get('Surname'):
+        entry['Given name'] = " ".join(words[:-1]) if len(words) > 1 else words[0]
+        if len(words) > 1:
+            entry['Surname'] = words[-1]
+
+# vCard
+
+def unfolded_lines(instream):
+    """Yield the logical lines of a vCard file, joining continuation lines.
+    Quoted-printable values continued with a trailing '=' are joined too."""
+    current = None
+    for line in instream:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if (current is not None
+            and current.endswith("=")
+            and "QUOTED-PRINTABLE" in current.split(":", 1)[0].upper()):
+            current = current[:-1] + line
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+def vcard_unescape(text):
+    return re.sub(r"\\(.)", lambda match: "\n" if match.group(1) in "nN" else match.group(1), text)
+
+def vcard_components(text):
+    """Split a structured vCard value on unescaped semicolons."""
+    return [vcard_unescape(part) for part in re.split(r"(?<!\\);", text)]
+
+def vcard_property(line):
+    """Split a vCard line into its name, its parameters, and its value."""
+    head, _, value = line.partition(":")
+    name, *params = head.split(";")
+    name = name.rsplit(".", 1)[-1].upper()      # drop any group prefix
+    parameters = {}
+    for param in params:
+        key, has_value, param_value = param.partition("=")
+        if has_value:
+            parameters.setdefault(key.upper(), []).extend(param_value.upper().split(","))
+        else:                   # vCard 2.1 style bare TYPE
+            parameters.setdefault('TYPE', []).append(key.upper())
+    if 'QUOTED-PRINTABLE' in parameters.get('ENCODING', []):
+        charset = (parameters.get('CHARSET') or ['UTF-8'])[0]
+        value = quopri.decodestring(value.encode()).decode(charset, errors='replace')
+    return name, parameters, value
+
+def vcard_phone_type(parameters):
+    types = [kind for kind in parameters.get('TYPE', []) if kind not in ('VOICE', 'PREF')]
+    if 'CELL' in types:
+        return "Mobile"
+    return types[0].capitalize() if types else ""
+
+def vcard_entries(instream):
+    """Yield the entries in a vCard file, one at a time."""
+    entry = None
+    full_name = ""
+    for line in unfolded_lines(instream):
+        if not line.strip():
+            continue
+        name, parameters, value = vcard_property(line)
+        if name == 'BEGIN' and value.upper() == 'VCARD':
+            entry, full_name = new_entry(), ""
+        elif entry is None:
+            continue
+        elif name == 'END':
+            split_full_name(entry, full_name)
+            yield entry
+            entry = None
+        elif name == 'N':
+            parts = vcard_components(value) + [""] * 5
+            add_value(entry, 'Surname', parts[0])
+            add_value(entry, 'Given name', parts[1])
+            add_value(entry, 'Middle names', parts[2].replace(",", " "))
+            add_value(entry, 'Title', parts[3])
+        elif name == 'FN':
+            full_name = vcard_unescape(value)
+        elif name == 'NICKNAME':
+            add_value(entry, 'AKA', vcard_unescape(value))
+        elif name == 'EMAIL':
+            entry['emails'].append(value.strip())
+        elif name == 'TEL':
+            entry['phones'].append((vcard_phone_type(parameters), value.strip()))
+        elif name == 'ADR':
+            parts = vcard_components(value) + [""] * 7
+            add_value(entry, 'Extended Address', parts[1])
+            add_value(entry, 'Street', parts[2].replace("\n", "; "))
+            add_value(entry, 'City', parts[3])
+            add_value(entry, 'State', parts[4])
+            add_value(entry, 'Postal Code', parts[5])
+            add_value(entry, 'Country', parts[6])
+        elif name == 'BDAY':
+            add_value(entry, 'Birthday', normalize_birthday(value))
+        elif name == 'ORG':
+            add_value(entry, 'Organizations', vcard_components(value)[0])
+        elif name in ('TITLE', 'ROLE'):
+            add_value(entry, 'Jobs', vcard_unescape(value))
+        elif name == 'NOTE':
+            add_value(entry, 'Notes', vcard_unescape(value).replace("\n", " "))
+        elif name == 'CATEGORIES':
+            for category in re.split(r"(?<!\\),", value):
+                add_value(entry, 'Group Membership', vcard_unescape(category))
+        elif name == 'GENDER':
+            add_value(entry, 'Gender', vcard_components(value)[0])
+
+# CSV
+
+def google_values(cell):
+    return [value.strip() for value in (cell or "").split(GOOGLE_SEPARATOR) if value.strip()]
+
+def csv_entries(instream):
+    """Yield the entries in a CSV file exported by Google or Outlook, one at a time.
+    A file in the form of the contacts file itself can be imported too."""
+    reader = csv.reader(instream)
+    header = next(reader, [])
+    own_columns = [(column, field) for column, field in enumerate(header)
+                   if field in contacts_data.FIELD_NAMES and field not in CSV_COLUMNS]
+    mapped_columns = [(column, CSV_COLUMNS[field]) for column, field in enumerate(header)
+                      if field in CSV_COLUMNS]
+    email_columns = [column for column, field in enumerate(header)
+                     if field in OUTLOOK_EMAIL_COLUMNS or GOOGLE_EMAIL_COLUMN.fullmatch(field)]
+    phone_columns = []
+    for column, field in enumerate(header):
+        if field in OUTLOOK_PHONE_COLUMNS:
+            phone_columns.append((None, OUTLOOK_PHONE_COLUMNS[field], column))
+        elif (match := GOOGLE_PHONE_COLUMN.fullmatch(field)):
+            type_column = "Phone %s - Type" % match.group(1)
+            phone_columns.append((header.index(type_column) if type_column in header else None,
+                                  "", column))
+    full_name_column = next((column for column, field in enumerate(header)
+                             if field in ('Name', 'Display Name')), None)
+    for cells in reader:
+        if not any(cells):
+            continue
+        cells += [""] * (len(header) - len(cells))
+        entry = new_entry()
+        for column, field in own_columns:
+            if field in contacts_data.MULTI_FIELDS:
+                for value in cells[column].split(";"):
+                    add_value(entry, field, value)
+            elif field in EMAIL_FIELDS:
+                entry['emails'] += [address for address in re.split("[;, ]+", cells[column]) if address]
+            else:
+                add_value(entry, field, cells[column])
+        for column, field in mapped_columns:
+            for value in google_values(cells[column]):
+                if field == 'Group Membership' and value.startswith("* "):
+                    continue    # Google's own groups, such as "* myContacts"
+                add_value(entry, field, normalize_birthday(value) if field == 'Birthday' else value)
+        for column in email_columns:
+            entry['emails'] += google_values(cells[column])
+        for type_column, phone_type, column in phone_columns:
+            if type_column is not None:
+                phone_type = cells[type_column].lstrip("* ")
+            entry['phones'] += [(phone_type, number) for number in google_values(cells[column])]
+        if full_name_column is not None:
+            split_full_name(entry, cells[full_name_column])
+        yield entry
+
+def import_entries(filename, file_format=None):
+    """Yield the entries in an exported file, reading it as it goes.
+    The format is worked out from the file name or its first line if
+    not given."""
+    if file_format is None:
+        if os.path.splitext(filename)[1].lower() in ('.vcf', '.vcard'):
+            file_format = 'vcard'
+        else:
+            with open(filename, encoding='utf-8-sig') as instream:
+                file_format = 'vcard' if instream.readline().strip().upper() == "BEGIN:VCARD" else 'csv'
+    with open(filename, encoding='utf-8-sig', newline='' if file_format == 'csv' else None) as instream:
+        yield from (vcard_entries(instream) if file_format == 'vcard' else csv_entries(instream))
+
+# Matching and merging
+
+def name_keys(person):
+    """Return the keys a person can be found by name with."""
+    surname = (person.get('Surname') or "").casefold()
+    if not surname:
+        return []
+    keys = [((person.get('Given name') or "").casefold(), surname),
+            (dedupe_contacts.expanded_given_name(person), surname)]
+    return list(dict.fromkeys(keys))
+
+class MatchIndex:
+
+    """Dictionaries from email addresses, phone numbers and names to
+    the IDs of the people who have them, for matching imported
+    entries against the people already known."""
+
+    def __init__(self, by_id):
+        self.by_id = by_id
+        self.by_email = {}
+        self.by_phone = {}
+        self.by_name = {}
+        for person in by_id.values():
+            self.add(person)
+
+    def add(self, person):
+        """Index a person, or index them again after they have changed."""
+        uid = person['ID']
+        for key, table in ([(address, self.by_email) for address in dedupe_contacts.email_addresses(person)]
+                           + [(number, self.by_phone) for number in dedupe_contacts.phone_numbers(person)]
+                           + [(key, self.by_name) for key in name_keys(person)]):
+            table.setdefault(key, set()).add(uid)
+
+    def match(self, entry):
+        """Return the ID of the person an entry is for, or None if there is nobody.
+        An email address is enough to match; a phone number matches
+        only someone with the same given name, as families share
+        phones; a name matches only if just one person has it.
+        If the entry could be several different people, the second
+        result is the set of their IDs."""
+        probe = entry_person(entry)
+        for address in dedupe_contacts.email_addresses(probe):
+            if (found := self.by_email.get(address)):
+                return self.single(found)
+        given = dedupe_contacts.expanded_given_name(probe)
+        for number in dedupe_contacts.phone_numbers(probe):
+            found = {uid for uid in self.by_phone.get(number, ())
+                     if dedupe_contacts.expanded_given_name(self.by_id[uid]) == given}
+            if found:
+                return self.single(found)
+        for key in name_keys(probe):
+            if (found := self.by_name.get(key)):
+                return self.single(found)
+        return None, None
+
+    @staticmethod
+    def single(found):
+        return (next(iter(found)), None) if len(found) == 1 else (None, found)
+
+def entry_person(entry):
+    """Return a dictionary for an entry in the form of a contacts file row,
+    with the multi-fields still as lists."""
+    person = {field: value for field, value in entry.items()
+              if field not in ('emails', 'phones')}
+    emails = list(dict.fromkeys(entry['emails']))
+    if emails:
+        person['Primary email'] = emails[0]
+        if emails[1:]:
+            person['Other emails'] = "; ".join(emails[1:])
+    for (type_field, value_field), (phone_type, number) in zip(PHONE_FIELDS, entry['phones']):
+        person[type_field] = phone_type
+        person[value_field] = number
+    return person
+
+def new_person(entry, by_id):
+    """Make a person for the contacts file from an imported entry, with a new ID."""
+    person = contacts_data.Person(entry_person(entry))
+    for multi in contacts_data.MULTI_FIELDS:
+        person[multi] = set(person.get(multi) or ()) or contacts_data.EMPTY_SET
+    person['_name_'] = contacts_data.make_name(person)
+    person['_initialled_name_'] = contacts_data.make_initialled_name(person)
+    person['_groups_'] = person.peek('Group Membership').union(person.peek('Organizations'),
+                                                              person.peek('Other groups')) or contacts_data.EMPTY_SET
+    uid = None
+    while uid is None or uid in by_id:
+        uid = contacts_data.make_ID()
+    person['ID'] = uid
+    return person
+
+def merge_entry(person, entry):
+    """Add what an imported entry says about a person to what they already have.
+    Fields they already have are left as they are, except that the
+    multi-fields gain any new values, and new email addresses and
+    phone numbers are added where there is room.  Returns the names
+    of the fields that were changed."""
+    changed = []
+    for field, value in entry.items():
+        if field in ('emails', 'phones'):
+            continue
+        if field in contacts_data.MULTI_FIELDS:
+            new_values = set(value) - person.peek(field, contacts_data.EMPTY_SET)
+            if new_values:
+                person[field].update(new_values)
+                changed.append(field)
+        elif contacts_data.set_field_if_empty(person, field, value):
+            changed.append(field)
+    known_emails = dedupe_contacts.email_addresses(person)
+    for address in entry['emails']:
+        if address.casefold() in known_emails:
+            continue
+        if contacts_data.set_field_if_empty(person, 'Primary email', address):
+            changed.append('Primary email')
+        else:
+            others = person.get('Other emails') or ""
+            person['Other emails'] = others + "; " + address if others else address
+            changed.append('Other emails')
+        known_emails.add(address.casefold())
+    for phone_type, number in entry['phones']:
+        if dedupe_contacts.phone_numbers({'Primary phone Value': number}) <= dedupe_contacts.phone_numbers(person):
+            continue
+        for type_field, value_field in PHONE_FIELDS:
+            if contacts_data.set_field_if_empty(person, value_field, number):
+                person[type_field] = phone_type
+                changed.append(value_field)
+                break
+    if changed:
+        person['_groups_'] = person.peek('Group Membership').union(person.peek('Organizations'),
+                                                                  person.peek('Other groups')) or contacts_data.EMPTY_SET
+    return sorted(set(changed))
+
+def import_contacts(by_id, by_name, entries, verbose=False):
+    """Merge imported entries into the people read from a contacts file.
+    Each entry either fills in details of the person it matches, or
+    is added as a new person (who later entries can match).  Entries
+    with no name, or that could be any of several people, are left
+    out.  Returns counts of what happened to the entries."""
+    index = MatchIndex(by_id)
+    counts = {'entries': 0, 'merged': 0, 'unchanged': 0, 'added': 0, 'ambiguous': 0, 'unnamed': 0}
+    for entry in entries:
+        counts['entries'] += 1
+        uid, candidates = index.match(entry)
+        if candidates:
+            counts['ambiguous'] += 1
+            print("Not imported, could be any of",
+                  ", ".join(sorted(by_id[candidate]['_name_'] for candidate in candidates)))
+            continue
+        if uid is not None:
+            person = by_id[uid]
+            changed = merge_entry(person, entry)
+            if changed:
+                counts['merged'] += 1
+                index.add(person)
+                if verbose:
+                    print("Updated", person['_name_'] + ":", ", ".join(changed))
+            else:
+                counts['unchanged'] += 1
+            continue
+        if not (entry.get('Given name') or entry.get('Surname')):
+            counts['unnamed'] += 1
+            continue
+        person = new_person(entry, by_id)
+        if person['_name_'] in by_name:
+            counts['ambiguous'] += 1
+            print("Not imported, already someone else called", person['_name_'])
+            continue
+        by_id[person['ID']] = person
+        by_name[person['_name_']] = person
+        index.add(person)
+        counts['added'] += 1
+        if verbose:
+            print("Added", person['_name_'])
+    return counts
+
+def import_contacts_main(contacts, output, file_format, dry_run, verbose, files):
+    contacts = os.path.expandvars(contacts)
+    by_id, by_name = contacts_data.read_contacts(contacts, fold_events=False)
+    counts = import_contacts(by_id, by_name,
+                             (entry
+                              for filename in files
+                              for entry in import_entries(filename, file_format)),
+                             verbose)
+    print("%(entries)d entries: %(merged)d merged, %(added)d added, %(unchanged)d already known,"
+          " %(ambiguous)d ambiguous, %(unnamed)d without names" % counts)
+    if not dry_run and (counts['merged'] or counts['added']):
+        contacts_data.write_contacts(output or contacts, by_name)
+    return counts
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contacts", "-c",
+                        default=os.path.expandvars("$ORG/contacts.csv"),
+                        help="""The contacts file to import into.""")
+    parser.add_argument("--output", "-o",
+                        help="""Write the merged contacts here instead of back into the contacts file.""")
+    parser.add_argument("--format", "-f", dest='file_format', choices=['vcard', 'csv'],
+                        help="""The format of the files to import, if it can't be told from them.""")
+    parser.add_argument("--dry-run", "-n", action='store_true',
+                        help="""Report what would be imported, without writing anything.""")
+    parser.add_argument("--verbose", "-v", action='store_true')
+    parser.add_argument("files", nargs='+',
+                        help="""vCard files, or CSV files exported from Google or Outlook.""")
+    return vars(parser.parse_args())
+
+if __name__ == "__main__":
+    import_contacts_main(**get_args())
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import os
 import re
 import coimealta.contacts.contacts_data as contacts_data
-from collections import defaultdict, Counter
+import coimealta.contacts.contacts_graph as contacts_graph
+import coimealta.contacts.contacts_stats as contacts_stats
+from collections import defaultdict
 
 def offspring(person):
     return person['Offspring']
@@ -17,151 +21,181 @@ def partners(person):
 def siblings(person):
     return person['Siblings']
 
-def name_to_ID(name, by_name):
-    name = name.replace('_', ' ')
-    if name not in by_name:
-        print("Name", name, "not found")
-    return by_name[name]['ID'] if name in by_name else "Z0Z0"
-
-def normalize_to_IDs(people, by_name):
-    return set([(person
-                 if re.match("[G-Z][0-9][A-Z][0-9]", person)
-                 else name_to_ID(person, by_name))
-                for person in people])
-
-def find_siblings(person, by_id):
-    sibs = person['Siblings']
-    more = True
-    if len(sibs) > 0:
-        while more:
-            try:
-                for sib in list(person['Siblings']):
-                    sibsibs = by_id[sib]['Siblings']
-                    more = False
-                    for sibsib in sibsibs:
-                        if sibsib not in sibs:
-                            sibs.add(sibsib)
-                            more = True
-            except KeyError:
-                print("Missing key in looking for sibling", sib, "of person", person)
-                break
-    yourself = person['ID']
-    if yourself in sibs:
-        sibs.remove(yourself)
-    return sibs
+def sibling_groups(by_id, from_parents=True):
+    """Work out all the groups of siblings at once.
+    Siblings of siblings are siblings, and with from_parents, so are
+    people who have the same parents as each other.
+    Returns a list of sets of IDs, one for each group of two or more
+    siblings, and a list of (person ID, sibling ID) pairs for siblings
+    that are not in by_id."""
+    leader = {}
+    size = {}
+
+    def find(who):
+        if who not in leader:
+            leader[who] = who
+            size[who] = 1
+            return who
+        while leader[who] != who:
+            leader[who] = leader[leader[who]]
+            who = leader[who]
+        return who
+
+    def union(one, other):
+        one, other = find(one), find(other)
+        if one != other:
+            if size[one] < size[other]:
+                one, other = other, one
+            leader[other] = one
+            size[one] += size[other]
+
+    dangling = []
+    by_parentage = {}
+    for person_id, person in by_id.items():
+        find(person_id)
+        for sibling_id in person.get('Siblings') or ():
+            if sibling_id in by_id:
+                union(person_id, sibling_id)
+            else:
+                dangling.append((person_id, sibling_id))
+        if from_parents and (parentage := frozenset(person.get('Parents') or ())):
+            if parentage in by_parentage:
+                union(by_parentage[parentage], person_id)
+            else:
+                by_parentage[parentage] = person_id
+
+    groups = defaultdict(set)
+    for who in leader:
+        groups[find(who)].add(who)
+    return [group for group in groups.values() if len(group) > 1], dangling
 
 def name(person):
     # return person['_name_']
     return person.get('_name_', person.get('Given name') + " " + person.get('Surname'))
 
-def print_summary(by_aspect, label):
-    by_frequency = {}
-    for k, v in by_aspect.items():
-        frequency = len(v)
-        if frequency not in by_frequency:
-            by_frequency[frequency] = []
-        by_frequency[frequency].append(k)
-    print(label, "; ".join(
-        [ "; ".join(
-            ["%s(%d)" % (bf, freq)
-             for bf in sorted(by_frequency[freq], key=lambda x: x if x else "")])
-          for freq in reversed(sorted(by_frequency.keys()))]))
-
-EXPANDED_NAMES = {
-    "Abi": "Abigail",
-    "Anne": "Ann",
-    "Ana": "Anna",
-    "Ander": "Alexander",
-    "Andy": "Andrew",
-    "Ben": "Benjamin",
-    "Bill": "William",
-    "Chris": "Christopher",
-    "Dan": "Daniel",
-    "Danny": "Daniel",
-    "Dave": "David",
-    "Debbie": "Deborah",
-    "Elpie": "Elspeth",
-    "Frank": "Francis",
-    "Ginny": "Virginia",
-    "Greg": "Gregory",
-    "Jen": "Jennifer",
-    "Jennie": "Jennifer",
-    "Jenny": "Jennifer",
-    "Jim": "James",
-    "Kate": "Catherine",
-    "Katherine": "Catherine",
-    "Liz": "Elizabeth",
-    "Lizzie": "Elizabeth",
-    "Mat": "Matthew",
-    "Mathew": "Matthew",
-    "Matt": "Matthew",
-    "Meg": "Margaret",
-    "Nick": "Nicholas",
-    "Ollie": "Oliver",
-    "Olly": "Oliver",
-    "Pete": "Peter",
-    "Phillip": "Philip",
-    "Pip": "Philip",
-    "Pippa": "Philippa",
-    "Rob": "Robert",
-    "Ros": "Rosalind",
-    "Sam": "Samuel",
-    "Steven": "Stephen",
-    "Stevn": "Stephen",
-    "Sue": "Susan",
-    "Tim": "Timothy",
-    "Tom": "Thomas",
-    "Tony": "Anthony",
-    "Vicky": "Victoria",
-    "Will": "William",
-}
-
-def analyze_contacts(by_id):
-    by_nationality = defaultdict(list)
-    by_gender = defaultdict(list)
-    by_title = defaultdict(list)
-    by_place_met = defaultdict(list)
-    flagged = defaultdict(list)
-    given_names_by_gender = defaultdict(lambda:defaultdict(list))
-
-    def accumulate(person, aspect, by_aspect):
-        by_aspect[person[aspect]].append(person['ID'])
-
-    def expand_name(as_given):
-        return EXPANDED_NAMES.get(as_given, as_given)
-
-    for id, person in by_id.items():
-        accumulate(person, 'Nationality', by_nationality)
-        accumulate(person, 'Gender', by_gender)
-        accumulate(person, 'Title', by_title)
-        accumulate(person, 'Place met', by_place_met)
-        for flag in person.get('Flags', "") or "":
-            flagged[flag].append(person['ID'])
-        given_names_by_gender[person['Gender']][expand_name(person['Given name'])].append(person)
-    return {
-        "n_people": len(by_id),
-        "by_gender": by_gender,
-        "by_nationality": by_nationality,
-        "by_place_met": by_place_met,
-        "by_title": by_title,
-        "by_given_names": given_names_by_gender,
-        "ordained": contacts_data.count_grouped_titles(by_title, ["Revd", "Revd Dr", "Revd Prof", "RtRevd"]),
-        "doctored": contacts_data.count_grouped_titles(by_title, ["Dr", "Revd Dr", "Prof", "Revd Prof", "MD"]),
-        "flagged": flagged
-    }
+EXPANDED_NAMES = contacts_data.EXPANDED_NAMES
+
+EXPANDED_NAMES_FOLDED = {short.casefold(): full.casefold()
+                         for short, full in EXPANDED_NAMES.items()}
+
+# The fields that link people to each other by ID
+RELATIONSHIP_FIELDS = ('Parents', 'Offspring', 'Siblings', 'Partners', 'Ex-partners', 'Knows')
+
+ID_PATTERN = re.compile("[G-Z][0-9][A-Z][0-9]$")
+
+def name_key(name, expand=False):
+    """Reduce a name to the form used for looking it up.
+    With expand, a familiar form of the given name is replaced by the full one."""
+    words = name.replace('_', ' ').casefold().split()
+    if expand and words:
+        words[0] = EXPANDED_NAMES_FOLDED.get(words[0], words[0])
+    return " ".join(words)
+
+def name_forms(person):
+    """Return the names by which a person may be referred to.
+    These are their full, short and initialled names, any names in
+    their AKA field, and their names with their old surname."""
+    forms = {person['_name_'],
+             person.get('_initialled_name_') or "",
+             contacts_data.make_short_name(person)}
+    given = person.get('Given name', "") or ""
+    surname = person.get('Surname', "") or ""
+    for aka in re.split("[;,]", person.get('AKA', "") or ""):
+        if aka := aka.strip():
+            forms.add(aka if ' ' in aka else aka + " " + surname)
+    for old_name in re.split("[;,]", person.get('Old name', "") or ""):
+        if old_name := old_name.strip():
+            forms.add(old_name if ' ' in old_name else given + " " + old_name)
+    return [form for form in forms if form.strip()]
+
+class NameIndex:
+
+    """An index for turning the names used in relationship fields into IDs.
+
+    It is built once, from everyone's names (see name_forms), in three
+    tiers, which are tried in turn: people's full names as in the file,
+    then any of their names, then any of their names with familiar given
+    names expanded (so "Bill Jones" finds William Jones).  A name is
+    only ambiguous if it matches more than one person in the first tier
+    it matches at all, so "John Smith" is John Smith, even if John Henry
+    Smith is also known as that.  Lookups are remembered, as the same
+    names tend to come up repeatedly."""
+
+    def __init__(self, by_id):
+        self.by_id = by_id
+        self.full = defaultdict(set)
+        self.forms = defaultdict(set)
+        self.expanded = defaultdict(set)
+        for person_id, person in by_id.items():
+            self.full[name_key(person['_name_'])].add(person_id)
+            for form in name_forms(person):
+                self.forms[name_key(form)].add(person_id)
+                self.expanded[name_key(form, expand=True)].add(person_id)
+        self.resolved = {}
+
+    def resolve(self, name):
+        """Find the IDs of the people a name could refer to.
+        Anything that looks like an ID is taken as one."""
+        if name in self.resolved:
+            return self.resolved[name]
+        if ID_PATTERN.match(name):
+            candidates = {name}
+        else:
+            key = name_key(name)
+            candidates = (self.full.get(key)
+                          or self.forms.get(key)
+                          or self.expanded.get(name_key(name, expand=True))
+                          or set())
+        self.resolved[name] = candidates
+        return candidates
+
+def normalize_relationships(by_id, index=None):
+    """Convert the names in everyone's relationship fields to IDs, in one pass.
+    Names that don't match anyone, or that match more than one
+    person, are left as they are, and returned as lists of
+    (person ID, field, name) and (person ID, field, name, candidate IDs)
+    respectively."""
+    if index is None:
+        index = NameIndex(by_id)
+    unknown = []
+    ambiguous = []
+    for person_id, person in by_id.items():
+        for field in RELATIONSHIP_FIELDS:
+            entries = person.get(field)
+            if not entries or all(ID_PATTERN.match(entry) for entry in entries):
+                continue
+            normalized = set()
+            for entry in entries:
+                candidates = index.resolve(entry)
+                if len(candidates) == 1:
+                    normalized.add(next(iter(candidates)))
+                else:
+                    normalized.add(entry)
+                    if candidates:
+                        ambiguous.append((person_id, field, entry, sorted(candidates)))
+                    else:
+                        unknown.append((person_id, field, entry))
+            person[field] = normalized
+    return unknown, ambiguous
+
+def print_resolution_report(by_id, unknown, ambiguous):
+    """Describe the names that normalize_relationships couldn't convert."""
+    for person_id, field, entry, candidates in ambiguous:
+        print("Ambiguous name %s in %s of %s could be %s" % (
+            entry, field, name(by_id[person_id]),
+            " or ".join("%s (%s)" % (name(by_id[candidate]), candidate)
+                        for candidate in candidates)))
+    if unknown:
+        print("Names not found:", "; ".join("%s in %s of %s" % (entry, field, name(by_id[person_id]))
+                                           for person_id, field, entry in unknown))
 
 def link_contacts(by_id, by_name):
     """Update the connections between people, in memory.
     Fills in the other direction for any that are given in only
     one direction."""
 
-    for person in by_id.values():
-        try:
-            for field in ('Parents', 'Offspring', 'Siblings', 'Partners', 'Knows'):
-                if person.get(field):
-                    person[field] = normalize_to_IDs(person[field], by_name)
-        except KeyError:
-            print("missing key while processing", person)
+    unknown, ambiguous = normalize_relationships(by_id)
+    print_resolution_report(by_id, unknown, ambiguous)
 
     for person_id, person in by_id.items():
         partner_ids = person['Partners']
@@ -190,51 +224,160 @@ def link_contacts(by_id, by_name):
             if person_id not in child['Parents']:
                 print("Adding", name(child), "to parents of", name(person))
                 child['Parents'].add(person_id)
-        for sibling_id in find_siblings(person, by_id):
-            if sibling_id not in by_id:
-                print(name(person), "has an unlisted sibling", sibling_id)
-                continue
-            sibling = by_id[sibling_id]
-            if person_id not in sibling['Siblings']:
-                print("Adding", name(sibling), "to siblings of", name(person))
-                sibling['Siblings'].add(person_id)
         # todo: mutualize contacts
 
+    groups, dangling = sibling_groups(by_id)
+    for group in groups:
+        for person_id in group:
+            person = by_id[person_id]
+            sibs = person['Siblings']
+            for sibling_id in group - sibs:
+                if sibling_id != person_id:
+                    print("Adding", name(by_id[sibling_id]), "to siblings of", name(person))
+                    sibs.add(sibling_id)
+    if dangling:
+        print("Unlisted siblings:", "; ".join("%s of %s" % (sibling_id, name(by_id[person_id]))
+                                             for person_id, sibling_id in dangling))
+
     return by_name
 
-def write_graph(graph, people_by_id):
+def graph_text(people, others=None):
+    """Return graphviz text for the people in a dictionary by ID.
+    People mentioned in their links are labelled from people or
+    others, and left unlabelled if they are in neither."""
     at_least_partners = 2   # don't list couples, but list any more complex arrangements
+    others = others or {}
     mentioned = set()
+    lines = ["digraph {\n", "  rankdir=LR\n"]
+    for uid, person in people.items():
+        their_partners = person['Partners']
+        their_offspring = person['Offspring']
+        their_parents = person['Parents']
+        if len(their_partners) >= at_least_partners or their_offspring or their_parents:
+            lines.append("    %s -> {%s}\n" % (uid, ",".join(their_partners)))
+            mentioned.add(uid)
+            mentioned |= their_partners
+        if their_offspring:
+            lines.append("    %s -> {%s} [style=dotted]\n" % (uid, ",".join(their_offspring)))
+            lines.append("    {rank=same %s}\n" % " ".join(their_offspring))
+            mentioned.add(uid)
+            mentioned |= their_offspring
+        if their_parents:
+            lines.append("    %s -> {%s} [style=dashed]\n" % (uid, ",".join(their_parents)))
+            mentioned.add(uid)
+            mentioned |= their_parents
+    for who in mentioned:
+        person = people.get(who) or others.get(who)
+        if person is None:
+            continue
+        lines.append('  %s [label="%s" shape="%s"]\n' % (who,
+                                                         name(person),
+                                                         ("box" if person['Gender'] == 'm' else "diamond")))
+        if (partners := person.get('Partners')):
+            lines.append("    {rank=same %s %s}\n" % (who, " ".join(partners)))
+    lines.append("}")
+    return "".join(lines)
+
+def write_graph(graph, people_by_id):
     with open(graph, 'w') as g:
-        g.write("digraph {\n")
-        g.write("  rankdir=LR\n")
+        g.write(graph_text(people_by_id))
+
+# The fields that graph_text uses, which are all that is copied for a part
+GRAPH_FIELDS = ('_name_', 'Given name', 'Surname', 'Gender', 'Partners', 'Offspring', 'Parents')
+
+GRAPH_RELATIONS = ('parent', 'offspring', 'partner')
+
+def has_graph_links(person):
+    return bool(person['Partners'] or person['Offspring'] or person['Parents'])
+
+def graph_partitions(people_by_id, split, part_size=200):
+    """Divide the people with family links into groups to be graphed separately.
+    With split='component', families that are linked are kept
+    together, and small ones are packed into parts of up to part_size
+    people; with split='surname', there is a part for each surname.
+    Returns a list of (label, list of IDs) pairs."""
+    if split == 'surname':
+        by_surname = defaultdict(list)
         for uid, person in people_by_id.items():
-            their_partners = person['Partners']
-            their_offspring = person['Offspring']
-            their_parents = person['Parents']
-            if len(their_partners) >= at_least_partners or their_offspring or their_parents:
-                g.write("    %s -> {%s}\n" % (uid, ",".join(their_partners)))
-                mentioned.add(uid)
-                mentioned |= their_partners
-            if their_offspring:
-                g.write("    %s -> {%s} [style=dotted]\n" % (uid, ",".join(their_offspring)))
-                g.write("    {rank=same %s}\n" % " ".join(their_offspring))
-                mentioned.add(uid)
-                mentioned |= their_offspring
-            if their_parents:
-                g.write("    %s -> {%s} [style=dashed]\n" % (uid, ",".join(their_parents)))
-                mentioned.add(uid)
-                mentioned |= their_parents
-        for who in mentioned:
-            person = people_by_id[who]
-            g.write('  %s [label="%s" shape="%s"]\n' % (who,
-                                                        name(person),
-                                                        ("box" if person['Gender'] == 'm' else "diamond")))
-            if (partners := person.get('partners')):
-                g.write("    {rank=same %s %s}\n" % (who, " ".join(partners)))
-        g.write("}")
-
-def link_contacts_main(input_file, analyze, graph, output_file):
+            if has_graph_links(person):
+                by_surname[person.get('Surname') or "unknown"].append(uid)
+        return sorted(by_surname.items())
+    if split != 'component':
+        raise ValueError("Unknown way to split graph: " + split)
+    graph = contacts_graph.RelationshipGraph(people_by_id)
+    parts = []
+    packing = []
+    for members in graph.component_members(GRAPH_RELATIONS):
+        if len(members) < 2:
+            continue
+        if len(members) >= part_size:
+            parts.append(members)
+            continue
+        if len(packing) + len(members) > part_size:
+            parts.append(packing)
+            packing = []
+        packing += members
+    if packing:
+        parts.append(packing)
+    return [("part %d" % n, members) for n, members in enumerate(parts)]
+
+def graph_slice(people_by_id, uids):
+    """Copy the graph fields for some people, and for the people they mention."""
+    people = {uid: {field: people_by_id[uid].get(field) for field in GRAPH_FIELDS}
+              for uid in uids}
+    others = {}
+    for person in people.values():
+        for who in person['Partners'] | person['Offspring'] | person['Parents']:
+            if who not in people and who not in others and who in people_by_id:
+                others[who] = {field: people_by_id[who].get(field) for field in GRAPH_FIELDS}
+    return people, others
+
+# The people being graphed, in each process writing graph parts
+graph_people_by_id = None
+
+def set_graph_people(people_by_id):
+    global graph_people_by_id
+    graph_people_by_id = people_by_id
+
+def write_graph_part(filename, uids):
+    """Write one part of a split graph, returning its filename.
+    The people are taken from graph_people_by_id, which the pool's
+    initializer sets, so only their IDs are sent to each process."""
+    with open(filename, 'w') as g:
+        g.write(graph_text(*graph_slice(graph_people_by_id, uids)))
+    return filename
+
+def write_graph_parts(directory, people_by_id, split, part_size=200, workers=None):
+    """Write the graph as separate files in a directory, in parallel.
+    Each process is given all the people once, when it starts (which
+    costs nothing where processes are forked), and then just the IDs
+    for each part, which it slices out and formats itself.
+    The directory also gets an index.tsv file listing each part's file,
+    the number of people in it, and its label.
+    Returns the list of filenames written."""
+    os.makedirs(directory, exist_ok=True)
+    partitions = graph_partitions(people_by_id, split, part_size)
+    used = set()
+    index_lines = []
+    with concurrent.futures.ProcessPoolExecutor(workers,
+                                                initializer=set_graph_people,
+                                                initargs=(people_by_id,)) as pool:
+        futures = []
+        for label, uids in partitions:
+            stem = re.sub(r"[^\w-]+", "_", label) or "unknown"
+            while stem in used:
+                stem += "_"
+            used.add(stem)
+            filename = os.path.join(directory, stem + ".gv")
+            futures.append(pool.submit(write_graph_part, filename, uids))
+            index_lines.append("%s\t%d\t%s\n" % (os.path.basename(filename), len(uids), label))
+        written = [future.result() for future in futures]
+    with open(os.path.join(directory, "index.tsv"), 'w') as index:
+        index.write("".join(index_lines))
+    return written
+
+def link_contacts_main(input_file, analyze, graph, output_file,
+                       split=None, part_size=200, workers=None):
 
     """Update the connections between people, in the contacts file.
     Fills in the other direction for any that are given in only
@@ -245,31 +388,34 @@ def link_contacts_main(input_file, analyze, graph, output_file):
     link_contacts(by_id, by_name)
 
     if graph:
-        write_graph(graph, by_id)
+        if split:
+            write_graph_parts(graph, by_id, split, part_size, workers)
+        else:
+            write_graph(graph, by_id)
 
-    # don't do this until after the graph, as this rewrites groups back to strings
     contacts_data.write_contacts(output_file, by_name)
 
     if analyze:
-        analysis = analyze_contacts(by_id)
-        n_people = analysis['n_people']
-        print(n_people, "people")
-        print_summary(analysis['by_nationality'], "nationalities:")
-        print_summary(analysis['by_gender'], "genders:")
-        print_summary(analysis['by_title'], "titles:")
-        print_summary(analysis['by_place_met'], "places met:")
-        ordained = analysis['ordained']
-        print("%d ordained (%d%% of the people you know)" % (ordained, ordained*100 / n_people))
-        doctored = analysis['doctored']
-        print("%d with doctorates (%d%% of the people you know)" % (doctored, doctored * 100 / n_people))
-        return analysis
+        stats = contacts_stats.stats_for(input_file, by_id)
+        contacts_stats.print_report(stats)
+        return stats
     else:
         return None
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--analyze", action='store_true')
-    parser.add_argument("--graph")
+    parser.add_argument("--graph",
+                        help="""File to write a graphviz graph to,
+                        or directory to write the parts to, with --split.""")
+    parser.add_argument("--split", choices=['component', 'surname'],
+                        help="""Write the graph as separate files,
+                        one for each group of linked families or for each surname.""")
+    parser.add_argument("--part-size", type=int, default=200,
+                        help="""With --split component, pack smaller families
+                        into files of up to this many people.""")
+    parser.add_argument("--workers", type=int,
+                        help="""Number of processes to write graph parts with.""")
     parser.add_argument("input_file")
     parser.add_argument("output_file")
     return vars(parser.parse_args())
@@ -1,16 +1,86 @@
 #!/usr/bin/env python3
 
 import argparse
-import re
+import datetime
 import json
 import sys
+from collections import defaultdict
 
 import coimealta.contacts.contacts_data as contacts_data
+import coimealta.contacts.format_address_labels as format_address_labels
 
 def safesearch(flags, text):
     print("Searching", text)
     return flags.search(text)
 
+def contact_indexes(by_id):
+    """Make inverted indexes of people's flags, groups, surnames and given names.
+    Returns a dictionary from the name of each index to a dictionary
+    from each value to the set of IDs of the people with that value."""
+    indexes = {'flag': defaultdict(set),
+               'group': defaultdict(set),
+               'surname': defaultdict(set),
+               'given': defaultdict(set)}
+    for uid, person in by_id.items():
+        for flag in person.get('Flags', "") or "":
+            indexes['flag'][flag].add(uid)
+        for group in person.get('_groups_') or ():
+            indexes['group'][group].add(uid)
+        indexes['surname'][person.get('Surname')].add(uid)
+        indexes['given'][person.get('Given name')].add(uid)
+    return indexes
+
+def add_family(by_id, chosen):
+    """Add the partners of the chosen people, then the offspring of them all.
+    The set of IDs is updated in place, and also returned."""
+    for field in ('Partners', 'Offspring'):
+        pending = list(chosen)
+        while pending:
+            for relative in by_id[pending.pop()].get(field) or ():
+                if relative in by_id and relative not in chosen:
+                    chosen.add(relative)
+                    pending.append(relative)
+    return chosen
+
+def select_contacts(by_id, indexes=None, require_all=False, add_family_members=True,
+                    extra=None, **criteria):
+    """Select people from the contacts by the values in their indexed fields.
+    The criteria are keyword arguments named after the indexes (flag,
+    group, surname, given), each a list of values; a person meets a
+    criterion if they have any of its values.  Extra is a list of sets
+    of IDs that count as further criteria.  People are selected if they
+    meet any criterion, or with require_all, every criterion.
+    Returns a list of people, in the order of by_id."""
+    if indexes is None:
+        indexes = contact_indexes(by_id)
+    matches = []
+    for index_name, values in criteria.items():
+        if values:
+            index = indexes[index_name]
+            matching = set()
+            for value in values:
+                matching |= index.get(value, set())
+            matches.append(matching)
+    matches += extra or []
+    if not matches:
+        chosen = set()
+    elif require_all:
+        chosen = set.intersection(*matches)
+    else:
+        chosen = set.union(*matches)
+    if add_family_members:
+        add_family(by_id, chosen)
+    return [person for uid, person in by_id.items() if uid in chosen]
+
+def address_labels(households):
+    """Yield an address label, as a list of lines, for each household with an address.
+    The households are (address tuple, people) pairs, as from
+    HouseholdIndex.households."""
+    for address, residents in households:
+        lines = [part for part in address if part]
+        if lines:
+            yield [contacts_data.names_string(residents)] + lines
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--flag", action='append')
@@ -18,6 +88,13 @@ def main():
     parser.add_argument("-a", "--all", action='store_true')
     parser.add_argument("-s", "--surname", action='append')
     parser.add_argument("-G", "--given", action='append')
+    parser.add_argument("-b", "--birthdays", type=int, metavar="DAYS",
+                        help="""Select people whose birthdays are in the next DAYS days.""")
+    parser.add_argument("-o", "--overdue", type=int, metavar="DAYS",
+                        help="""Select people I have not been in touch with for more than DAYS days.""")
+    parser.add_argument("-A", "--and", dest='all_criteria', action='store_true',
+                        help="""Select only people who meet all the criteria given,
+                        rather than any of them.""")
     parser.add_argument("-N", "--no-add-family",
                         action='store_true',
                         help="""Without this option, if someone is selected but their partner
@@ -26,6 +103,13 @@ def main():
                         action='store_true',
                         help="""List people by address, grouping together those at the same address.
                         Without this, people are listed individually, with their email addresses.""")
+    parser.add_argument("-l", "--labels", metavar="PATTERN",
+                        help="""Write address labels for the households selected,
+                        as SVG pages named by PATTERN, such as labels-%%d.svg.""")
+    parser.add_argument("--labels-combined", metavar="FILE",
+                        help="""Write address labels for the households selected,
+                        all into one HTML file.""")
+    format_address_labels.add_layout_arguments(parser, short_options=False, output_options=False)
     parser.add_argument("-e", "--email-addresses",
                         action='store_true',
                         help="""List people by email address.""")
@@ -37,51 +121,36 @@ def main():
     if args.all:
         selected = by_id.values()
     else:
-        selected = []
-        if args.flag:
-            flags = re.compile("[" + "".join(args.flag) + "]")
-            selected += [someone for someone in by_id.values()
-                         if flags.search(someone.get('Flags', "") or "")]
-        if args.group:
-            groups = set(args.group)
-            selected += [someone for someone in by_id.values()
-                         if len((groups.intersection(someone['_groups_']))) > 0]
-        if args.surname:
-            surnames = set(args.surname)
-            selected += [someone for someone in by_id.values()
-                         if someone['Surname'] in surnames]
-        if args.given:
-            given_names = set(args.given)
-            selected += [someone for someone in by_id.values()
-                         if someone['Given name'] in given_names]
-        if not args.no_add_family:
-            invited_ids = [whoever['ID'] for whoever in selected]
-            for whoever in selected:
-                print("whoever", whoever)
-                for partner in whoever['Partners']:
-                    if partner not in invited_ids:
-                        # todo: make this only if they are at the same address
-                        selected.append(by_id[partner])
-                        print("  partner", partner)
-            for whoever in selected:
-                for offspring in whoever['Offspring']:
-                    if offspring not in invited_ids:
-                        print(contacts_data.make_name(by_id[offspring]), "  -- maybe add")
-                        # todo: make this only if they are at the same address
-                        selected.append(by_id[offspring])
-    if args.postal_addresses:
-        by_address = {}
-        for contact in selected:
-            address = contacts_data.make_address(contact)
-            if address in by_address:
-                by_address[address].append(contact)
-            else:
-                by_address[address] = [contact]
-        print(len(by_address), "addresses")
+        extra = []
+        if args.birthdays is not None or args.overdue is not None:
+            calendar = contacts_data.ContactCalendar(by_id.values())
+            today = datetime.date.today()
+            if args.birthdays is not None:
+                extra.append({person['ID'] for person in calendar.birthdays_within(today, args.birthdays)})
+            if args.overdue is not None:
+                extra.append({person['ID'] for person in calendar.not_contacted_within(today, args.overdue)})
+        selected = select_contacts(by_id,
+                                   require_all=args.all_criteria,
+                                   add_family_members=not args.no_add_family,
+                                   extra=extra,
+                                   flag="".join(args.flag or []),
+                                   group=args.group,
+                                   surname=args.surname,
+                                   given=args.given)
+    if args.labels or args.labels_combined:
+        households = contacts_data.HouseholdIndex(by_id).households(selected)
+        n_pages = format_address_labels.render_labels(address_labels(households),
+                                                      format_address_labels.layout_from_args(args),
+                                                      output=args.labels or "labels-%d.svg",
+                                                      combined=args.labels_combined)
+        print(n_pages, "pages of labels")
+    elif args.postal_addresses:
+        households = contacts_data.HouseholdIndex(by_id).households(selected)
+        print(len(households), "addresses")
         print("")
-        for addr, residents in by_address.items():
+        for addr, residents in households:
             print(contacts_data.names_string(residents))
-            print("  " + "\n  ".join([a for a in addr if a != ""]))
+            print("  " + "\n  ".join([a for a in addr if a]))
             print("")
     else:
         for contact in selected:
@@ -90,7 +159,7 @@ def main():
                 if email != "":
                     print(email + " <" + contact['_name_'] + ">")
             elif args.json:
-                json.dump(contact, sys.stdout)
+                json.dump(dict(contact), sys.stdout, default=sorted)
             else:
                 print(contact['_name_'])
 
@@ -1,49 +1,105 @@
 #!/usr/bin/env python
 
 import argparse
-from backports import csv
-import io
+import bisect
+import collections
 import sys
 import os
 
-# Fields to split into lists
-multi_fields = ['Parents', 'Offspring', 'Siblings',
-                'Partners', 'Ex-partners',
-                'Knows',
-                'Organizations']
-
-def make_name(person):
-    return ' '.join([person.get('Given name', "")]
-                    + person.get('Middle names', "").split(" ")
-                    + [person.get('Surname', "")])
+import coimealta.contacts.contacts_data as contacts_data
 
 def make_name_list(people):
-    # todo: collect together all the people of the same surname and format that as "Fred, Freddie and Freda Smith and John and Jane Jones"
-    return ", ".join([resi['_name_'] for resi in people])
+    return contacts_data.names_string(people)
 
 def assemble_postal_address(who, spacer="; "):
     """Return a postal address."""
     address = []
-    for key in ['Street', 'City', 'Region', 'Postal Code', 'Country']:
-        value = who[key]
+    for key in contacts_data.ADDRESS_FIELDS:
+        value = who.get(key) or ""
         if value != "":
             address += value.split("; ")
     return spacer.join(address)
 
 def show_person(out, who):
     out.write(who['_name_'] + "\n")
-    email = who['Primary email']
+    email = who.get('Primary email') or ""
     if email != "":
         out.write("    Email: " + email + "\n")
-    phone = who['Primary phone Value']
+    phone = who.get('Primary phone Value') or ""
     if phone != "":
-        phone_type = who['Primary phone Type']
+        phone_type = who.get('Primary phone Type') or ""
         out.write("    " + (phone_type if phone_type != "" else "Phone") + ': ' + phone + "\n")
-    if who['Street'] != "":
+    if (who.get('Street') or "") != "":
         out.write("    Address:\n        "
                   + assemble_postal_address(who, "\n        ")
                   + "\n")
 
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class PeopleIndex:
+
+    """An index of people's names, for finding people by all or part of a name.
+
+    The case-folded names are kept sorted, for finding names by their
+    beginnings, and indexed by the three-letter sequences in them, for
+    finding names containing a string without looking at every name."""
+
+    def __init__(self, by_name):
+        self.by_name = by_name
+        self.folded = {}
+        for name in by_name:
+            self.folded.setdefault(name.casefold(), []).append(name)
+        self.sorted_names = sorted(self.folded)
+        self.by_trigram = collections.defaultdict(set)
+        for folded in self.folded:
+            for trigram in trigrams(folded):
+                self.by_trigram[trigram].add(folded)
+
+    def starting_with(self, prefix):
+        """Return the case-folded names that begin with a prefix."""
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        end = bisect.bisect_left(self.sorted_names, prefix + "\U0010ffff", start)
+        return self.sorted_names[start:end]
+
+    def containing(self, text):
+        """Return the case-folded names that contain some text, in order."""
+        wanted = trigrams(text)
+        if not wanted:          # too short for trigrams
+            return [folded for folded in self.sorted_names if text in folded]
+        candidates = None
+        for trigram in sorted(wanted, key=lambda trigram: len(self.by_trigram.get(trigram, ()))):
+            found = self.by_trigram.get(trigram)
+            if not found:
+                return []
+            candidates = set(found) if candidates is None else candidates & found
+            if not candidates:
+                return []
+        return sorted(folded for folded in candidates if text in folded)
+
+    def lookup(self, text):
+        """Return the people whose names match some text, best matches first.
+        If there is an exact match (ignoring case), that is all; otherwise,
+        names that begin with the text come first, then names that
+        contain it."""
+        text = " ".join(text.split()).casefold()
+        if text in self.folded:
+            return [self.by_name[name] for name in self.folded[text]]
+        matches = {}
+        for folded in self.starting_with(text) + self.containing(text):
+            for name in self.folded[folded]:
+                matches.setdefault(name, self.by_name[name])
+        return list(matches.values())
+
+def flagged_households(by_id, flag, households=None):
+    """Return the households of the people with a flag, as (address tuple, people) pairs.
+    The households are sorted by their addresses."""
+    if households is None:
+        households = contacts_data.HouseholdIndex(by_id)
+    flagged = [who for who in by_id.values() if flag in (who.get('Flags') or "")]
+    return sorted(households.households(flagged),
+                  key=lambda household: [part or "" for part in household[0]])
+
 def main():
     parser = argparse.ArgumentParser()
     org_files = os.environ.get("ORG", "~/org")
@@ -57,38 +113,15 @@ def main():
                         nargs='*',
                         help="""The names to look for.""")
     args = parser.parse_args()
-    by_name = {}
-    by_id = {}
-    with io.open(args.contacts, 'r', encoding='utf-8') as input:
-        contacts_reader = csv.DictReader(input)
-        for row in contacts_reader:
-            for multi in multi_fields:
-                row[multi] = (row.get(multi, "") or "").split(";")
-            n = make_name(row)
-            row['_name_'] = n
-            by_name[n] = row
-            by_id[id] = row.get('ID', "")
-    if args.flag != "":
+    by_id, by_name = contacts_data.read_contacts(os.path.expanduser(args.contacts))
+    if args.flag:
         flag = args.names[0]
-        by_address = {}
-        for n in sorted(by_name.keys()):
-            who = by_name[n]
-            if flag in who['Flags']:
-                addr = assemble_postal_address(who, "\n  ")
-                if addr not in by_address:
-                    by_address[addr] = []
-                by_address[addr].append(who)
-        for addr in sorted(by_address.keys()):
-            sys.stdout.write(make_name_list(by_address[addr])
-                             + "\n  " + addr + "\n\n")
+        for addr, residents in flagged_households(by_id, flag):
+            sys.stdout.write(make_name_list(residents)
+                             + "\n  " + "\n  ".join(part for part in addr if part) + "\n\n")
     else:
-        name = " ".join(args.names)
-        if name in by_name:
-            show_person(sys.stdout, by_name[name])
-        else:
-            for n in sorted(by_name.keys()):
-                if name in n:
-                    show_person(sys.stdout, by_name[n])
+        for who in PeopleIndex(by_name).lookup(" ".join(args.names)):
+            show_person(sys.stdout, who)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""Search the free-text fields of the contacts file.
+
+An inverted index from words to the people whose notes, jobs,
+organizations and so on contain them is kept beside the contacts
+file, and brought up to date, one changed person at a time, when the
+file changes."""
+
+import argparse
+import bisect
+import collections
+import math
+import os
+import pickle
+import re
+import unicodedata
+
+import coimealta.contacts.contacts_data as contacts_data
+
+# The fields searched, and how much a word in each counts for
+SEARCH_FIELDS = {
+    'Jobs': 3,
+    'Organizations': 3,
+    'Universities': 2,
+    'College': 2,
+    'Subjects': 2,
+    'Place met': 2,
+    'City': 1,
+    'Notes': 1,
+}
+
+# Words not worth indexing or looking up
+STOP_WORDS = frozenset(["a", "an", "and", "as", "at", "by", "for", "from", "in", "is",
+                        "of", "on", "or", "the", "to", "with"])
+
+SEARCH_INDEX_VERSION = 3
+
+def words(text):
+    """Split text into normalized words: case-folded, and without accents."""
+    text = unicodedata.normalize('NFKD', text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return [word for word in re.findall(r"\w+", text.casefold())
+            if word not in STOP_WORDS]
+
+def field_text(person, field):
+    value = contacts_data.peek(person, field)
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else " ".join(sorted(value))
+
+def fingerprint(person):
+    """Return a digest of a person's searchable fields, to tell whether they have changed."""
+    return contacts_data.fingerprint(field_text(person, field) for field in SEARCH_FIELDS)
+
+def person_terms(person):
+    """Return the weights of the words in a person's searchable fields."""
+    weights = collections.Counter()
+    for field, weight in SEARCH_FIELDS.items():
+        for word in words(field_text(person, field)):
+            weights[word] += weight
+    return weights
+
+class SearchIndex:
+
+    """An inverted index over the searchable fields of the contacts.
+
+    postings maps each word to a dictionary from the IDs of the
+    people whose fields contain it to how much it counts for them.
+    The words each person contributed, and a fingerprint of their
+    fields, are kept so that refresh only re-indexes people who have
+    changed."""
+
+    def __init__(self):
+        self.postings = collections.defaultdict(dict)
+        self.terms_of = {}
+        self.fingerprints = {}
+        self.signature = None
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self.terms_of)
+
+    def remove(self, person_id):
+        """Take a person out of the index."""
+        for term in self.terms_of.pop(person_id, ()):
+            posting = self.postings[term]
+            posting.pop(person_id, None)
+            if not posting:
+                del self.postings[term]
+                self._vocabulary = None
+        self.fingerprints.pop(person_id, None)
+
+    def add(self, person):
+        """Put a person in the index, replacing anything already there for them."""
+        person_id = person['ID']
+        self.remove(person_id)
+        terms = person_terms(person)
+        for term, weight in terms.items():
+            if term not in self.postings:
+                self._vocabulary = None
+            self.postings[term][person_id] = weight
+        self.terms_of[person_id] = tuple(terms)
+        self.fingerprints[person_id] = fingerprint(person)
+
+    def refresh(self, by_id):
+        """Bring the index up to date with the people given.
+        Returns how many people were re-indexed or removed."""
+        changed = 0
+        for person_id in [person_id for person_id in self.terms_of if person_id not in by_id]:
+            self.remove(person_id)
+            changed += 1
+        for person_id, person in by_id.items():
+            if self.fingerprints.get(person_id) != fingerprint(person):
+                self.add(person)
+                changed += 1
+        return changed
+
+    def vocabulary(self):
+        """Return the indexed words, sorted, for finding words by prefix."""
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        return self._vocabulary
+
+    def expand(self, term):
+        """Return the indexed words a query term stands for.
+        A term ending in '*' stands for all the words it begins."""
+        if not term.endswith('*'):
+            return [term] if term in self.postings else []
+        prefix = term[:-1]
+        vocabulary = self.vocabulary()
+        start = bisect.bisect_left(vocabulary, prefix)
+        end = bisect.bisect_left(vocabulary, prefix + "\U0010ffff", start)
+        return vocabulary[start:end]
+
+    def search(self, query, limit=None):
+        """Return the IDs of the people matching every word of a query, best first.
+        The result is a list of (score, ID) pairs; words that are rarer
+        among the contacts count for more."""
+        terms = [term + "*" if star else term
+                 for raw in query.split()
+                 for star in [raw.endswith('*')]
+                 for term in words(raw)]
+        if not terms:
+            return []
+        n_people = max(len(self), 1)
+        matches = []
+        for term in terms:
+            scores = collections.Counter()
+            for word in self.expand(term):
+                posting = self.postings[word]
+                idf = math.log(1 + n_people / len(posting))
+                for person_id, weight in posting.items():
+                    scores[person_id] = max(scores[person_id], weight * idf)
+            if not scores:
+                return []
+            matches.append(scores)
+        matches.sort(key=len)
+        candidates = set(matches[0])
+        for scores in matches[1:]:
+            candidates &= scores.keys()
+        ranked = sorted(((sum(scores[person_id] for scores in matches), person_id)
+                         for person_id in candidates),
+                        key=lambda found: (-found[0], found[1]))
+        return ranked[:limit] if limit else ranked
+
+    def save(self, filename):
+        """Save the index, replacing the old one in one step."""
+        contacts_data.write_atomically(
+            filename,
+            lambda outstream: pickle.dump({'version': SEARCH_INDEX_VERSION,
+                                           'signature': self.signature,
+                                           'postings': dict(self.postings),
+                                           'terms_of': self.terms_of,
+                                           'fingerprints': self.fingerprints},
+                                          outstream, protocol=pickle.HIGHEST_PROTOCOL),
+            binary=True)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved index, or return None if there isn't a usable one."""
+        try:
+            with open(filename, 'rb') as instream:
+                saved = pickle.load(instream)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if saved.get('version') != SEARCH_INDEX_VERSION:
+            return None
+        index = cls()
+        index.signature = saved['signature']
+        index.postings.update(saved['postings'])
+        index.terms_of = saved['terms_of']
+        index.fingerprints = saved['fingerprints']
+        return index
+
+def search_index_filename(filename):
+    """Return the name of the file to keep the search index for a contacts file in."""
+    return contacts_data.cache_filename(filename, "search")
+
+def search_index_for(filename, by_id=None, verbose=False):
+    """Return the search index for a contacts file, bringing it up to date if need be.
+    The saved index is used as it is if the file hasn't changed;
+    otherwise only the people whose searchable fields have changed are
+    re-indexed, and the index is saved again."""
+    index_file = search_index_filename(filename)
+    signature = contacts_data.contacts_signature(filename, with_events=False)
+    index = SearchIndex.load(index_file)
+    if index is not None and index.signature == signature:
+        return index
+    if by_id is None:
+        by_id, _ = contacts_data.read_contacts(filename, fold_events=False)
+    if index is None:
+        index = SearchIndex()
+    changed = index.refresh(by_id)
+    if verbose:
+        print("Re-indexed", changed, "people")
+    index.signature = signature
+    try:
+        index.save(index_file)
+    except OSError as problem:
+        print("Could not save search index for", filename, "because of", problem)
+    return index
+
+def search_contacts_main(contacts, limit, verbose, query):
+    index = search_index_for(contacts, verbose=verbose)
+    results = index.search(" ".join(query), limit)
+    if not results:
+        return
+    by_id, _ = contacts_data.read_contacts(contacts, fold_events=False)
+    for score, person_id in results:
+        person = by_id.get(person_id)
+        if person is None:
+            continue
+        details = "; ".join(field_text(person, field)
+                            for field in SEARCH_FIELDS
+                            if field != 'Notes' and field_text(person, field))
+        print("%6.2f  %s  (%s)" % (score, person['_name_'], details))
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contacts", "-c",
+                        default=os.path.expandvars("$ORG/contacts.csv"),
+                        help="""Name of contacts file.""")
+    parser.add_argument("--limit", "-n", type=int,
+                        help="""Show at most this many people.""")
+    parser.add_argument("--verbose", "-v", action='store_true')
+    parser.add_argument("query", nargs='+',
+                        help="""Words to look for; a word ending in * matches any word it begins.""")
+    return vars(parser.parse_args())
+
+if __name__ == "__main__":
+    search_contacts_main(**get_args())
@@ -2,15 +2,26 @@
 import argparse
 import cmd
 import collections
+import contextlib
+import dbm
 import dobishem.storage
 import functools
+import gc
+import io
 import json
 import math
+import multiprocessing
+import multiprocessing.connection
 import operator
 import os
 import re
 import shlex
+import shutil
+import signal
+import socket
 import sys
+import tempfile
+import threading
 
 from typing import List, Optional
 
@@ -64,8 +75,9 @@ BOOKSHELF_AREA = 10 * 2 * 1.5
 
 class Storer:
 
-    def __init__(self, locations, items, books, initial_type='book', verbose=False):
+    def __init__(self, locations, items, books, initial_type='book', tree=None, verbose=False):
         self.locations = locations
+        self.tree = tree
         self.items = items
         self.books = books
         self.current_type = initial_type[0:4]
@@ -101,6 +113,11 @@ class Storer:
                     this_location = token - STORAGE_BASE
                     outer = self.locations.get(self.current_location)
                     if (inner := self.locations.get(this_location)):
+                        if self.tree and (this_location == self.current_location
+                                          or self.tree.within(self.current_location, this_location)):
+                            print("Warning: not nesting %s within %s, as that would put it inside itself" % (
+                                inner['Description'], outer['Description']))
+                            return False, False, False
                         if HIERARCHY.get(inner['Type'], 0) < HIERARCHY.get(outer['Type'], 0):
                             # boxes go on shelves, etc
                             if self.verbose:
@@ -108,6 +125,8 @@ class Storer:
                             self.last_enclosing_previous_location = inner['ContainedWithin']
                             self.last_enclosed = inner
                             inner['ContainedWithin'] = self.current_location
+                            if self.tree:
+                                self.tree.rebuild()
                             return False, False, True
                         else:
                             # typically, move on to the next shelf
@@ -138,6 +157,8 @@ class Storer:
                         print("Undoing nesting of", self.last_enclosed['Description'])
                     self.last_enclosed['ContainedWithin'] = self.last_enclosing_previous_location
                     self.last_enclosing_previous_location = None
+                    if self.tree:
+                        self.tree.rebuild()
                 if self.current_type == 'book':
                     if token not in self.books:
                         print("Warning: No book with identity", token)
@@ -168,17 +189,30 @@ class StorageShell(cmd.Cmd):
                  items_file, items,
                  books_file, books,
                  stock_file, stock,
+                 tree=None,
+                 persister=None,
+                 saved_items=None,
+                 read_stdin=True,
                  verbose=False):
+        """If items includes things from other files than items_file,
+        saved_items gives those that belong in items_file.  Servers
+        should pass read_stdin=False, so that store with nothing to
+        store doesn't wait for input that will never come."""
         super().__init__()
         self.outstream = outstream
         self.locations_file = locations_file
         self.locations = locations
         self.items_file = items_file
         self.items = items
+        self.saved_items = items if saved_items is None else saved_items
+        self.read_stdin = read_stdin
         self.books_file = books_file
         self.books = books
         self.stock_file = stock_file
         self.stock = stock
+        self.tree = tree or LocationTree(locations)
+        self.query_index = None
+        self.persister = persister
         self.verbose = verbose
 
     def postcmd(self, stop, _line):
@@ -192,7 +226,7 @@ class StorageShell(cmd.Cmd):
                 by_location[book['Location']].append(idx)
         for loc in sorted(by_location.keys()):
             contents = by_location[loc]
-            self.outstream.write(describe_nested_location(self.locations, loc) + ":\n")
+            self.outstream.write(describe_nested_location(self.locations, loc, self.tree) + ":\n")
             for title in sorted([self.books[idx]['Title'] for idx in contents ]):
                 self.outstream.write("    " + title + "\n")
         return False
@@ -256,7 +290,7 @@ class StorageShell(cmd.Cmd):
                 by_location[item['Normal location']].append(idx)
         for loc in sorted(by_location.keys()):
             contents = by_location[loc]
-            self.outstream.write(describe_nested_location(self.locations, loc) + ":\n")
+            self.outstream.write(describe_nested_location(self.locations, loc, self.tree) + ":\n")
             for title in sorted([self.items[idx]['Item'] for idx in contents ]):
                 self.outstream.write("    " + title + "\n")
         return False
@@ -294,7 +328,7 @@ class StorageShell(cmd.Cmd):
     def do_list_locations(self, *things):
         """List everything that is in the matching locations."""
         for where in sorted(locations_matching_patterns(self.locations, things)):
-            list_location(self.outstream, where, "", self.locations, self.items, self.books)
+            list_location(self.outstream, where, "", self.locations, self.items, self.books, self.tree)
         return False
 
     def do_find_things(self, *args):
@@ -303,17 +337,41 @@ class StorageShell(cmd.Cmd):
         findings = {}
         for thing in args:
             if re.match("[0-9]+", thing):
-                as_location = describe_nested_location(self.locations, thing)
+                as_location = describe_nested_location(self.locations, thing, self.tree)
                 if as_location != []:
                     findings[thing] = as_location
             for book in books_matching(self.books, thing):
-                findings[book['Title']] = describe_nested_location(self.locations, book['Location'])
+                findings[book['Title']] = describe_nested_location(self.locations, book['Location'], self.tree)
             for item in items_matching(self.items, thing):
-                findings[item['Item']] = describe_nested_location(self.locations, item['Normal location'])
+                findings[item['Item']] = describe_nested_location(self.locations, item['Normal location'], self.tree)
         for finding in sorted(findings.keys()):
             self.outstream.write(finding + " is " + findings[finding] + "\n")
         return False
 
+    def do_query(self, *args):
+        """Show the books and items matching a query, and where they are.
+        For example:
+            query type:tools brand:bosch in:garage
+            query is:book (subject:history or subject:politics) -lent:yes
+        A column name followed by a colon looks for words in that column;
+        in: looks for things anywhere inside the locations described;
+        is:book and is:item restrict the kind of thing."""
+        if self.query_index is None:
+            self.query_index = StorageQuery(self.items, self.books, self.locations, self.tree)
+        try:
+            matches = self.query_index.query(" ".join(args))
+        except ValueError as problem:
+            self.outstream.write("Could not understand query: " + str(problem) + "\n")
+            return False
+        for finding in sorted(self.query_index.name(key)
+                              + " is "
+                              + describe_nested_location(self.locations,
+                                                         self.query_index.place(key),
+                                                         self.tree)
+                              for key in matches):
+            self.outstream.write(finding + "\n")
+        return False
+
     def do_store(self, *args):
         """Put things into locations.
 
@@ -327,49 +385,53 @@ class StorageShell(cmd.Cmd):
         storing of containers within containers (e.g. boxes on a
         shelf).
         """
-        items_stored = False
-        books_stored = False
+        items_stored = 0
+        books_stored = 0
         locations_nested = False
         thing_type="books"
         storer = Storer(self.locations,
                         self.items, self.books,
                         initial_type=thing_type,
+                        tree=self.tree,
                         verbose=self.verbose)
         if args and any(args):  # ignore empty args
-            for arg in args:
-                for word in arg.split(' '):
-                    item_stored, book_stored, location_nested = storer.store(word)
-                    items_stored |= item_stored
-                    books_stored |= book_stored
-                    locations_nested = location_nested
+            tokens = [word for arg in args for word in arg.split(' ')]
+        elif not self.read_stdin:
+            self.outstream.write("Nothing to store\n")
+            return False
         else:
-            done = False
+            tokens = []
             for line in sys.stdin.readlines():
-                for token in line.split():
-                    if token == 'quit':
-                        done = True
-                        break
-                    item_stored, book_stored, location_nested = storer.store(token)
-                    items_stored |= item_stored
-                    books_stored |= book_stored
-                    locations_nested = location_nested
-                if done:
+                line_tokens = line.split()
+                if 'quit' in line_tokens:
+                    tokens += line_tokens[:line_tokens.index('quit')]
                     break
-        if items_stored:
-            with dobishem.storage.FileProtection(self.items_file):
-                dobishem.storage.write_csv(self.items_file,
-                                           self.items,
-                                           sort_columns=INVENTORY_COLUMNS)
-        if books_stored:
-            with dobishem.storage.FileProtection(self.books_file):
-                dobishem.storage.write_csv(self.books_file,
-                                           self.books,
-                                           sort_columns=BOOK_COLUMNS)
-        if locations_nested:
-            with dobishem.storage.FileProtection(self.locations_file):
-                dobishem.storage.write_csv(self.locations_file,
-                                           self.locations,
-                                           sort_columns=LOCATION_COLUMNS)
+                tokens += line_tokens
+        with self.persister.lock if self.persister else contextlib.nullcontext():
+            for token in tokens:
+                try:
+                    item_stored, book_stored, location_nested = storer.store(token)
+                except (ValueError, KeyError):
+                    self.outstream.write("Not a label number: " + token + "\n")
+                    continue
+                items_stored += item_stored
+                books_stored += book_stored
+                locations_nested |= location_nested
+            if items_stored or books_stored or locations_nested:
+                self.query_index = None
+            if items_stored:
+                self.save(self.items_file, self.saved_items, INVENTORY_COLUMNS, items_stored)
+            if books_stored:
+                self.save(self.books_file, self.books, BOOK_COLUMNS, books_stored)
+            if locations_nested:
+                self.save(self.locations_file, self.locations, LOCATION_COLUMNS)
+
+    def save(self, filename, data, sort_columns, changed_rows=1):
+        """Write some data back to its file, now or when the persister decides."""
+        if self.persister:
+            self.persister.mark_dirty(filename, data, sort_columns, changed_rows)
+        else:
+            write_csv_atomically(filename, data, sort_columns)
 
 def normalize_book_entry(row):
     """Put the entry describing a book into our standard form."""
@@ -542,13 +604,125 @@ def describe_location(where):
     description = ("on " if storage_type in ("shelf", "bookshelf") else "in ") + description
     return description
 
-def nested_location(locations, location):
+class LocationTree:
+
+    """An index of which locations are inside which.
+
+    This is built in one pass over the locations, numbering each
+    location on entry and exit in a depth-first tour of the
+    containment forest, so that questions about whether one location
+    is inside another don't need to follow the ContainedWithin chain.
+
+    Any cycles in the ContainedWithin links are reported when the
+    tree is built, and broken at their lowest-numbered location, which
+    is then treated as being at the top level.
+    """
+
+    def __init__(self, locations, verbose=True):
+        self.locations = locations
+        self.verbose = verbose
+        self.rebuild()
+
+    def rebuild(self):
+        """Index the locations afresh, after their nesting has changed."""
+        self.parent = {}
+        self.children = collections.defaultdict(list)
+        self.entry = {}
+        self.exit = {}
+        self.depth = {}
+        self.order = []
+        self.cycles = []
+        roots = []
+        for number, location in self.locations.items():
+            container = location.get('ContainedWithin')
+            if container in self.locations and container != number:
+                self.parent[number] = container
+                self.children[container].append(number)
+            else:
+                roots.append(number)
+        for root in roots:
+            self._tour(root, 0)
+        if len(self.order) < len(self.locations):
+            self._break_cycles()
+
+    def _tour(self, root, depth):
+        """Number the locations under root, without recursion."""
+        stack = [(root, depth, False)]
+        while stack:
+            number, depth, leaving = stack.pop()
+            if leaving:
+                self.exit[number] = len(self.order)
+                continue
+            self.entry[number] = len(self.order)
+            self.depth[number] = depth
+            self.order.append(number)
+            stack.append((number, depth, True))
+            for child in reversed(self.children[number]):
+                if child not in self.entry:
+                    stack.append((child, depth + 1, False))
+
+    def _break_cycles(self):
+        """Find the locations that are not under any top-level location.
+        Each of these is in, or under, a cycle of ContainedWithin links."""
+        for start in self.locations:
+            if start in self.entry:
+                continue
+            walk = []
+            on_walk = set()
+            number = start
+            while number not in on_walk:
+                on_walk.add(number)
+                walk.append(number)
+                number = self.parent[number]
+            cycle = walk[walk.index(number):]
+            self.cycles.append(cycle)
+            if self.verbose:
+                print("Warning: locations contain each other in a cycle:",
+                      " -> ".join(str(member) for member in cycle + [cycle[0]]))
+            breaking_point = min(cycle)
+            container = self.parent.pop(breaking_point)
+            self.children[container].remove(breaking_point)
+            self._tour(breaking_point, 0)
+
+    def within(self, inner, outer):
+        """Return whether location inner is inside location outer, at any depth.
+        A location is not counted as being within itself."""
+        return (inner != outer
+                and inner in self.entry
+                and outer in self.entry
+                and self.entry[outer] < self.entry[inner]
+                and self.exit[inner] <= self.exit[outer])
+
+    def depth_of(self, location):
+        """Return how many containers a location is inside."""
+        return self.depth.get(location)
+
+    def containers(self, location):
+        """Return the location and all the locations that it is inside, innermost first."""
+        result = []
+        while location in self.locations:
+            result.append(location)
+            location = self.parent.get(location)
+        return result
+
+    def sublocations(self, location):
+        """Return all the locations inside a location, at any depth."""
+        if location not in self.entry:
+            return []
+        return self.order[self.entry[location] + 1:self.exit[location]]
+
+def nested_location(locations, location, tree=None):
     result = []
     try:
         location = int(location)
+        if tree is not None:
+            return [describe_location(locations[where])
+                    for where in tree.containers(location)]
+        seen = set()
         while location:
-            if location not in locations:
+            if location not in locations or location in seen:
                 break
+            seen.add(location)
             where = locations[location]
             description = describe_location(where)
             result.append(description)
@@ -557,12 +731,184 @@ def nested_location(locations, location):
     except:
         return ["Could not follow location %s" % location]
 
-def describe_nested_location(locations, location):
+def describe_nested_location(locations, location, tree=None):
     """Return a description of a location, along with any surrounding locations."""
-    return (" which is ".join(nested_location(locations, location))
+    return (" which is ".join(nested_location(locations, location, tree))
             if location != ""
             else "unknown")
 
+def column_key(column):
+    """Return the form of a column name used in queries, e.g. "serialnumber"."""
+    return re.sub("[^a-z0-9]", "", column.lower())
+
+def value_words(value):
+    """Return the indexable words of a cell value."""
+    return re.findall(r"\w+", str(value).casefold())
+
+class StorageQuery:
+
+    """Hash indexes on the columns of the items and books, for answering queries.
+
+    A query is a sequence of terms, all of which must match unless they
+    are separated by "or"; a term may be negated with "not" or a
+    leading "-", and terms may be grouped with parentheses.  Each term
+    is one of:
+
+      column:words    the words all occur in that column, e.g. brand:bosch
+      in:words        stored in a location described by the words, at any depth
+      is:book         only books (or is:item for only other items)
+      words           the words all occur in some column
+
+    Each term is answered from an index rather than by scanning the
+    records, so a query takes time proportional to the sizes of the
+    sets of records it combines.  The index for a column is only built
+    when a query first uses that column, so a one-off query costs no
+    more than a scan of the columns it mentions.
+    """
+
+    NAME_COLUMNS = {'item': 'Item', 'book': 'Title'}
+    PLACE_COLUMNS = {'item': 'Normal location', 'book': 'Location'}
+
+    def __init__(self, items, books, locations, tree):
+        self.locations = locations
+        self.tree = tree
+        self.records = {}
+        self.columns = {}
+        self.column_names = {}  # column key -> the names of the columns it stands for
+        self.by_kind = collections.defaultdict(set)
+        self.by_place = collections.defaultdict(set)
+        self.location_words = collections.defaultdict(set)
+        columns = set()
+        for kind, table in (('item', items), ('book', books)):
+            for number, record in table.items():
+                key = (kind, number)
+                self.records[key] = record
+                self.by_kind[kind].add(key)
+                self.by_place[record.get(self.PLACE_COLUMNS[kind])].add(key)
+                columns.update(record.keys())
+        for column in columns:
+            self.column_names.setdefault(column_key(column), set()).add(column)
+        for number, location in locations.items():
+            for word in value_words(location.get('Description', "")):
+                self.location_words[word].add(number)
+
+    def name(self, key):
+        """Return the name of the record with a given key."""
+        return self.records[key][self.NAME_COLUMNS[key[0]]]
+
+    def place(self, key):
+        """Return the location number of the record with a given key."""
+        return self.records[key][self.PLACE_COLUMNS[key[0]]]
+
+    def query(self, text):
+        """Return the keys of the records matching a query."""
+        tokens = []
+        for token in shlex.split(text):
+            while token.startswith("("):
+                tokens.append("(")
+                token = token[1:]
+            closing = len(token) - len(token.rstrip(")"))
+            if token[:len(token) - closing]:
+                tokens.append(token[:len(token) - closing])
+            tokens.extend(")" * closing)
+        self.tokens = tokens
+        result = self._disjunction()
+        if self.tokens:
+            raise ValueError("Unexpected %s in query" % self.tokens[0])
+        return result
+
+    def _disjunction(self):
+        result = self._conjunction()
+        while self.tokens and self.tokens[0].lower() == "or":
+            self.tokens.pop(0)
+            result = result | self._conjunction()
+        return result
+
+    def _conjunction(self):
+        wanted = []
+        unwanted = []
+        while self.tokens and self.tokens[0] != ")" and self.tokens[0].lower() != "or":
+            if self.tokens[0].lower() == "and":
+                self.tokens.pop(0)
+                continue
+            negated = False
+            if self.tokens[0].lower() == "not":
+                self.tokens.pop(0)
+                negated = True
+            elif self.tokens[0].startswith("-") and len(self.tokens[0]) > 1:
+                self.tokens[0] = self.tokens[0][1:]
+                negated = True
+            (unwanted if negated else wanted).append(self._factor())
+        if not wanted and not unwanted:
+            raise ValueError("Missing term in query")
+        if wanted:
+            # intersect the smallest sets first
+            wanted.sort(key=len)
+            result = set(wanted[0])
+            for matches in wanted[1:]:
+                result &= matches
+        else:
+            result = set(self.records.keys())
+        for matches in unwanted:
+            result -= matches
+        return result
+
+    def _factor(self):
+        if not self.tokens:
+            raise ValueError("Missing term in query")
+        token = self.tokens.pop(0)
+        if token == "(":
+            result = self._disjunction()
+            if not self.tokens or self.tokens.pop(0) != ")":
+                raise ValueError("Missing ) in query")
+            return result
+        if token == ")":
+            raise ValueError("Unexpected ) in query")
+        field, _, value = token.rpartition(":")
+        return self._term(column_key(field), value_words(value))
+
+    def _term(self, field, words):
+        if not words:
+            raise ValueError("Empty term in query")
+        if field == "in":
+            places = self._words_match(self.location_words, words)
+            result = set()
+            for place in places:
+                result |= self.by_place.get(place, set())
+                for sublocation in self.tree.sublocations(place):
+                    result |= self.by_place.get(sublocation, set())
+            return result
+        if field == "is":
+            return set().union(*(self.by_kind.get(word.rstrip("s"), set()) for word in words))
+        return self._words_match(self._column_index(field), words)
+
+    def _column_index(self, field):
+        """Return the index from words to records for a column key,
+        building it if this is the first query to use it.  The empty key
+        indexes all the columns."""
+        if field in self.columns:
+            return self.columns[field]
+        if field and field not in self.column_names:
+            raise ValueError("There is no column called %s" % field)
+        columns = self.column_names.get(field)
+        index = collections.defaultdict(set)
+        for key, record in self.records.items():
+            for column, value in record.items():
+                if value is None or value == "" or (columns is not None and column not in columns):
+                    continue
+                for word in value_words(value):
+                    index[word].add(key)
+        self.columns[field] = index
+        return index
+
+    @staticmethod
+    def _words_match(index, words):
+        matches = sorted((index.get(word, set()) for word in words), key=len)
+        result = set(matches[0])
+        for more in matches[1:]:
+            result &= more
+        return result
+
 def sum_capacities(all_data, types):
     return math.ceil(functools.reduce(operator.add,
                                       [all_data.get(loctype, 0)
@@ -583,7 +929,7 @@ def calculate_capacities(locations):
     area = sum_capacities(capacity_by_type, ('louvre panel', 'pegboard'))
     return capacity_by_type, volume, bookshelf_length, other_length, area
 
-def list_location(outstream, location, prefix, locations, items, books):
+def list_location(outstream, location, prefix, locations, items, books, tree=None):
     """List everything that is in the given location."""
     if type(location) == dict:
         location = location['Number']
@@ -593,9 +939,10 @@ def list_location(outstream, location, prefix, locations, items, books):
     directly_contained_books = [
         book for book in books.values()
         if book['Location'] == location ]
-    sub_locations = [
-        subloc for subloc in locations.values()
-        if subloc['ContainedWithin'] == location ]
+    sub_locations = ([locations[subloc] for subloc in tree.children[location]]
+                     if tree
+                     else [subloc for subloc in locations.values()
+                           if subloc['ContainedWithin'] == location ])
     description = describe_location(locations[location])
     next_prefix = prefix + "    "
     if len(directly_contained_items) > 0:
@@ -610,16 +957,176 @@ def list_location(outstream, location, prefix, locations, items, books):
         outstream.write(prefix + "Locations " + description + ":\n")
         for subloc in sub_locations:
             outstream.write(next_prefix + subloc['Description'] + "\n")
-            list_location(outstream, subloc, next_prefix, locations, items, books)
+            list_location(outstream, subloc, next_prefix, locations, items, books, tree)
+
+def write_csv_atomically(filename, data, sort_columns, max_reduction=0.1):
+    """Write a CSV file by writing a new file and renaming it over the old one.
+
+    The new file is synced to disk before the rename, so the file is
+    always either the old version or the new one.  As with
+    dobishem.storage.FileProtection, the old version is kept if the
+    new one is drastically smaller, and ValueError is raised."""
+    filename = os.path.expandvars(filename)
+    handle, new_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                            prefix=".", suffix=".csv")
+    os.close(handle)
+    try:
+        dobishem.storage.write_csv(new_filename, data, sort_columns=sort_columns)
+        with open(new_filename, 'rb+') as written:
+            os.fsync(written.fileno())
+        if os.path.exists(filename):
+            old_size = os.stat(filename).st_size
+            if os.stat(new_filename).st_size < old_size * max_reduction:
+                raise ValueError("Not replacing %s, as the new version is much smaller" % filename)
+            shutil.copymode(filename, new_filename)
+        os.replace(new_filename, filename)
+    finally:
+        if os.path.exists(new_filename):
+            os.unlink(new_filename)
+
+class CSVPersister:
+
+    """Save data sets to their CSV files, coalescing bursts of changes.
+
+    Changed data sets are marked as dirty, and written when there have
+    been no more changes for a given delay, or when a given number of
+    rows have changed since the last write, whichever comes first.
+
+    Anything changing the data while a persister may be writing it
+    should hold the persister's lock.  Call close() before exiting, to
+    write anything outstanding.
+    """
+
+    def __init__(self, delay=5.0, max_dirty=100):
+        self.delay = delay
+        self.max_dirty = max_dirty
+        self.lock = threading.RLock()
+        self.dirty = {}
+        self.dirty_rows = 0
+        self.timer = None
+
+    def mark_dirty(self, filename, data, sort_columns, changed_rows=1):
+        """Note that some data needs writing back to its file."""
+        with self.lock:
+            self.dirty[filename] = (data, sort_columns)
+            self.dirty_rows += changed_rows
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if self.dirty_rows >= self.max_dirty:
+                self.flush()
+            else:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Write all the dirty data sets.
+        Any that write_csv_atomically refuses to write are kept dirty,
+        and their filenames are returned."""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            dirty = self.dirty
+            self.dirty = {}
+            self.dirty_rows = 0
+            refused = []
+            for filename, (data, sort_columns) in dirty.items():
+                try:
+                    write_csv_atomically(filename, data, sort_columns)
+                except ValueError as problem:
+                    print("Warning:", problem)
+                    self.dirty.setdefault(filename, (data, sort_columns))
+                    refused.append(filename)
+            return refused
+
+    def close(self):
+        """Write anything outstanding, for a clean exit.
+        Raises ValueError if any of it could not be written."""
+        if (refused := self.flush()):
+            raise ValueError("Could not write %s, as the new versions are much smaller"
+                             % ", ".join(refused))
+
+INDEX_SOURCES_KEY = "__sources__"
+
+def index_sources_signature(*source_files):
+    """Return a string that changes when any of the source files changes."""
+    return json.dumps([[source_file,
+                        os.stat(source_file).st_mtime_ns
+                        if os.path.exists(source_file)
+                        else None]
+                       for source_file in source_files])
+
+def build_index(index_file, locations_file, inventory_file, books_file):
+    """Write a dbm file mapping label, book and location numbers to their records.
+
+    Each record is stored as JSON along with the description of where
+    it is, so that looking up a number needs no further reading.  The
+    source signature is written last, so that an interrupted rebuild
+    leaves an index that will be rebuilt next time."""
+    locations = read_locations(locations_file)
+    items = read_inventory(inventory_file)
+    books = read_books(books_file)
+    tree = LocationTree(locations)
+    with dbm.open(index_file, 'n') as index:
+        for number, item in items.items():
+            if number > 0:
+                index["item:%d" % number] = json.dumps(
+                    {'name': item['Item'],
+                     'where': describe_nested_location(locations, item['Normal location'], tree),
+                     'record': item})
+        for number, book in books.items():
+            index["book:%d" % number] = json.dumps(
+                {'name': book['Title'],
+                 'where': describe_nested_location(locations, book['Location'], tree),
+                 'record': book})
+        for number, location in locations.items():
+            if number is not None:
+                index["location:%d" % number] = json.dumps(
+                    {'name': location['Description'],
+                     'where': describe_nested_location(locations, number, tree),
+                     'record': location})
+        index[INDEX_SOURCES_KEY] = index_sources_signature(locations_file, inventory_file, books_file)
+
+def open_index(index_file, locations_file, inventory_file, books_file):
+    """Open the lookup index, rebuilding it first if any of its sources have changed."""
+    signature = index_sources_signature(locations_file, inventory_file, books_file)
+    try:
+        with dbm.open(index_file, 'r') as index:
+            current = index.get(INDEX_SOURCES_KEY) == signature.encode()
+    except dbm.error:
+        current = False
+    if not current:
+        build_index(index_file, locations_file, inventory_file, books_file)
+    return dbm.open(index_file, 'r')
+
+def lookup_in_index(index, number):
+    """Return the records that a scanned or typed number could refer to.
+    Numbers from STORAGE_BASE upwards are location labels."""
+    number = int(number)
+    keys = (["location:%d" % (number - STORAGE_BASE)]
+            if number >= STORAGE_BASE
+            else ["item:%d" % number, "book:%d" % number, "location:%d" % number])
+    return [json.loads(index[key])
+            for key in keys
+            if key in index]
 
 filenames = {}
 
+# The full names of the files, for writing them back
+filepaths = {}
+
+persister = None
+
 remembered_items_data = {'combined': None,
                          'inventory': None,
                          'stock': None,
                          'project_parts': None,
                          'books': None,
-                         'locations': None}
+                         'locations': None,
+                         'tree': None,
+                         'query': None}
 
 def storage_server_function(in_string, files_data):
     command_parts = shlex.split(in_string)
@@ -630,31 +1137,215 @@ def storage_server_function(in_string, files_data):
         if (inventory is not remembered_items_data['inventory']
             or stock is not remembered_items_data['stock']
             or project_parts is not remembered_items_data['project_parts']):
-            items_data = inventory
-            items_data.update(stock)
-            items_data.update(project_parts)
+            # a separate dict, so that only the inventory is written back to its file
+            items_data = {**inventory, **stock, **project_parts}
             remembered_items_data['combined'] = items_data
             remembered_items_data['inventory'] = inventory
             remembered_items_data['stock'] = stock
             remembered_items_data['project_parts'] = project_parts
+            remembered_items_data['query'] = None
         else:
             items_data = remembered_items_data['combined']
+        locations = files_data[filenames['locations']]
+        if locations is not remembered_items_data['locations']:
+            remembered_items_data['tree'] = LocationTree(locations)
+            remembered_items_data['locations'] = locations
+            remembered_items_data['query'] = None
+        books = files_data[filenames['books']]
+        if books is not remembered_items_data['books']:
+            remembered_items_data['books'] = books
+            remembered_items_data['query'] = None
         output_catcher = io.StringIO()
-        StorageShell(
+        shell = StorageShell(
             outstream=output_catcher,
-            locations_file=filenames['locations'],
-            locations=files_data[filenames['locations']],
-            items_file=inventory,
+            locations_file=filepaths['locations'],
+            locations=locations,
+            items_file=filepaths['inventory'],
             items=items_data,
-            books_file=filenames['books'],
-            books=files_data[filenames['books']],
-            stock_file=filenames['stock'],
+            saved_items=inventory,
+            read_stdin=False,
+            books_file=filepaths['books'],
+            books=books,
+            stock_file=filepaths['stock'],
             stock=files_data[filenames['stock']],
-        ).onecmd(in_string)
+            tree=remembered_items_data['tree'],
+            persister=persister,
+        )
+        # keep the query index between commands; store drops it
+        shell.query_index = remembered_items_data['query']
+        shell.onecmd(in_string)
+        remembered_items_data['query'] = shell.query_index
         return output_catcher.getvalue()
     else:
         return "Command was empty"
 
+# Commands that change the data, which the prefork workers pass to the
+# writer process:
+MUTATING_COMMANDS = ('store',)
+
+def make_storage_shell(files, data, persister=None, verbose=False):
+    """Make a shell for the prefork server to keep for a generation of the data.
+    This keeps the location tree and query indexes between commands."""
+    return StorageShell(
+        outstream=None,
+        locations_file=files['locations'],
+        locations=data['locations'],
+        items_file=files['inventory'],
+        items=data['items'],
+        books_file=files['books'],
+        books=data['books'],
+        stock_file=files['stock'],
+        stock=data['stock'],
+        tree=LocationTree(data['locations'], verbose=verbose),
+        persister=persister,
+        read_stdin=False,
+        verbose=verbose,
+    )
+
+def run_storage_command(shell, command):
+    """Run a shell command, returning its output as a string."""
+    output_catcher = io.StringIO()
+    shell.outstream = output_catcher
+    shell.onecmd(command)
+    return output_catcher.getvalue()
+
+def answer_command(shell, command):
+    """Run a command for a client of the prefork server, returning its output.
+    Any error is described in the reply, rather than stopping the process."""
+    try:
+        return run_storage_command(shell, command)
+    except Exception as problem:
+        return "Error: %s\n" % problem
+
+def prefork_worker(listener, writer, generation, born_in, shell):
+    """Answer commands arriving on a listening socket shared with the other workers.
+
+    The shell and its data are those inherited from the writer process
+    when it forked this worker, so they are not read or copied again;
+    their pages start out shared with the writer and the other workers,
+    although reference counting copies many of them as they are used.
+    Commands that change the data are
+    passed to the writer, which then forks a new set of workers to
+    share the changed data; a worker whose generation has passed
+    leaves, after passing anything it has already accepted to the
+    writer to answer."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    writer_pid = os.getppid()
+    while generation.value == born_in:
+        try:
+            connection, _address = listener.accept()
+        except TimeoutError:
+            if os.getppid() != writer_pid:
+                return          # the writer has gone, so stop serving stale data
+            continue
+        with connection:
+            try:
+                with connection.makefile('r') as request:
+                    command = request.readline().strip()
+            except (OSError, UnicodeDecodeError):
+                continue
+            try:
+                command_parts = shlex.split(command)
+            except ValueError as problem:
+                command_parts = None
+                reply = "Could not understand command: %s\n" % problem
+            if command_parts is None:
+                pass
+            elif not command_parts:
+                reply = "Command was empty\n"
+            elif ((command_parts[0] in MUTATING_COMMANDS and len(command_parts) > 1)
+                  or generation.value != born_in):
+                try:
+                    writer.send(command)
+                    reply = writer.recv()
+                except (EOFError, OSError):
+                    return      # the writer has gone
+            else:
+                reply = answer_command(shell, command)
+            try:
+                connection.sendall(reply.encode())
+            except OSError:
+                pass            # the client has gone
+
+def prefork_server(host, port, workers, files, persister, verbose=False):
+    """Run a storage server as several worker processes and a writer process.
+
+    The data is read and normalized once, before forking, so the workers
+    start with its pages shared with the writer, and the garbage
+    collector is frozen first so that it doesn't copy them all at its
+    next collection.  The saving is only partial, as reference counting
+    still copies the pages holding whatever each worker reads.  Each command is
+    one line of text on a TCP connection, and the reply is the output of
+    the command.  Commands in MUTATING_COMMANDS are run by the writer
+    (this process), which saves the files through the persister, and
+    then forks a new set of workers to share the changed data, the old
+    ones leaving as they notice.  Workers that die are replaced.
+
+    The connections are neither encrypted nor authenticated, so host
+    should normally be localhost; a warning is given if it isn't."""
+    data = {'locations': read_locations(files['locations']),
+            'items': read_inventory(files['inventory']),
+            'books': read_books(files['books']),
+            'stock': read_stock(files['stock'])}
+    shell = make_storage_shell(files, data, persister=persister, verbose=verbose)
+    context = multiprocessing.get_context('fork')
+    generation = context.Value('L', 0)
+    if host not in ("localhost", "127.0.0.1", "::1"):
+        print("Warning: serving storage data without encryption on", host)
+    listener = socket.create_server((host, port))
+    listener.settimeout(1)      # so that workers notice if the writer has gone
+    signal.signal(signal.SIGTERM, lambda _signal, _frame: sys.exit(0))
+    pipes = {}                  # worker process -> the writer's end of its pipe
+    current = set()             # the workers sharing the latest data
+
+    def start_workers():
+        if len(current) >= workers:
+            return
+        gc.freeze()
+        while len(current) < workers:
+            ours, theirs = context.Pipe()
+            process = context.Process(target=prefork_worker,
+                                      args=(listener, theirs, generation, generation.value, shell),
+                                      daemon=True)
+            process.start()
+            theirs.close()
+            pipes[process] = ours
+            current.add(process)
+
+    start_workers()
+    if verbose:
+        print("Serving storage data on %s:%d with %d workers" % (host, port, workers))
+    try:
+        while True:
+            for ready in multiprocessing.connection.wait(list(pipes.values()), timeout=1):
+                try:
+                    command = ready.recv()
+                except EOFError:
+                    continue    # its worker has gone, which is dealt with below
+                reply = answer_command(shell, command)
+                try:
+                    ready.send(reply)
+                except OSError:
+                    pass
+                if command.split(None, 1)[0] in MUTATING_COMMANDS:
+                    with generation.get_lock():
+                        generation.value += 1
+                    current.clear()
+            for process in [process for process in pipes if not process.is_alive()]:
+                pipes.pop(process).close()
+                if process in current:
+                    current.discard(process)
+                    print("Storage worker %d stopped with exit code %s; starting another"
+                          % (process.pid, process.exitcode))
+            start_workers()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in pipes:
+            process.terminate()
+        listener.close()
+        persister.close()
+
 def get_args():
     parser = argparse.ArgumentParser()
     # parser.add_argument("--config", "-c",
@@ -675,6 +1366,9 @@ def get_args():
     parser.add_argument("--project-parts", "-p",
                         default=os.path.expandvars("$ORG/project-parts.csv"),
                         help="""The CSV file containing the project parts inventory.""")
+    parser.add_argument("--index",
+                        help="""A dbm file to use for looking up label, book and location numbers.
+                        It is rebuilt automatically when the CSV files change.""")
     parser.add_argument("--verbose", "-v",
                         action='store_true',
                         help="""Output explanatory information.""")
@@ -683,8 +1377,27 @@ def get_args():
                         help="""Run a little CLI on a network socket.""")
     actions.add_argument("--cli", action='store_true',
                          help="""Run a little CLI on stdin and stdout.""")
-    if HAS_CLIENT_SERVER:
-        client_server.client_server_add_arguments(parser, 9797, include_keys=False)
+    parser.add_argument("--write-delay",
+                        type=float, default=5.0,
+                        help="""In server and CLI modes, how many seconds to wait after a
+                        change for further changes, before writing the files.""")
+    parser.add_argument("--max-dirty",
+                        type=int, default=100,
+                        help="""In server and CLI modes, how many changed rows to allow
+                        before writing the files regardless of the delay.""")
+    parser.add_argument("--workers", "-w",
+                        type=int, default=0,
+                        help="""With --server, run this many worker processes forked from one
+                        copy of the data, answering plain-text commands one per connection.""")
+    parser.add_argument("--host", "-SH",
+                        default="localhost",
+                        help="""The address for the server to listen on.""")
+    parser.add_argument("--port", "-SP",
+                        type=int, default=9797,
+                        help="""The port for the server to listen on.""")
+    parser.add_argument("--tcp", "-St",
+                        action='store_true',
+                        help="""Use a TCP connection to the server.""")
     parser.add_argument("things",
                         nargs='*',
                         help="""The things to look for.""")
@@ -695,20 +1408,33 @@ def storage(locations,
             inventory,
             stock,
             project_parts,
+            index: Optional[str]=None,
             verbose: bool=False,
             server: bool=False,
+            workers: int=0,
+            write_delay: float=5.0,
+            max_dirty: int=100,
             cli: bool=False,
             host: str=None,
-            port: str=None,
+            port: int=None,
             tcp: bool=True,
             things: Optional[List[str]]=None):
-    if server:
-        global filenames
-        filenames = {'inventory': os.path.basename(inventory),
-                     'books': os.path.basename(books),
-                     'stock': os.path.basename(stock),
-                     'project_parts': os.path.basename(project_parts),
-                     'locations': os.path.basename(locations)}
+    if server and workers:
+        prefork_server(host or "localhost", int(port or 9797), workers,
+                       files={'locations': locations,
+                              'inventory': inventory,
+                              'books': books,
+                              'stock': stock},
+                       persister=CSVPersister(write_delay, max_dirty),
+                       verbose=verbose)
+    elif server:
+        global filenames, filepaths, persister
+        filepaths = {'inventory': inventory,
+                     'books': books,
+                     'stock': stock,
+                     'project_parts': project_parts,
+                     'locations': locations}
+        filenames = {key: os.path.basename(path) for key, path in filepaths.items()}
         if HAS_CLIENT_SERVER:
             query_passphrase = decouple.config('query_passphrase')
             reply_passphrase = decouple.config('reply_passphrase')
@@ -716,20 +1442,36 @@ def storage(locations,
             query_key, reply_key = client_server.read_keys_from_files(args,
                                                                       query_passphrase,
                                                                       reply_passphrase)
-            client_server.run_servers(host, int(port),
-                                      getter=storage_server_function,
-                                      files={inventory: ('Label number',
-                                                              normalize_item_entry),
-                                             books: ('Number',
-                                                          normalize_book_entry),
-                                             stock: ('Label number',
-                                                          normalize_item_entry),
-                                             project_parts: ('Label number',
+            persister = CSVPersister(write_delay, max_dirty)
+            signal.signal(signal.SIGTERM, lambda _signal, _frame: sys.exit(0))
+            try:
+                client_server.run_servers(host, int(port),
+                                          getter=storage_server_function,
+                                          files={inventory: ('Label number',
                                                                   normalize_item_entry),
-                                             locations: ('Number',
-                                                              normalize_location)},
-                                      query_key=query_key,
-                                      reply_key=reply_key)
+                                                 books: ('Number',
+                                                              normalize_book_entry),
+                                                 stock: ('Label number',
+                                                              normalize_item_entry),
+                                                 project_parts: ('Label number',
+                                                                      normalize_item_entry),
+                                                 locations: ('Number',
+                                                                  normalize_location)},
+                                          query_key=query_key,
+                                          reply_key=reply_key)
+            finally:
+                persister.close()
+    elif (index
+          and not cli
+          and things
+          and all(re.fullmatch("[0-9]+", thing) for thing in things)):
+        with open_index(index, locations, inventory, books) as index_data:
+            for thing in things:
+                findings = lookup_in_index(index_data, thing)
+                if not findings:
+                    print("Nothing is labelled", thing)
+                for finding in findings:
+                    print(finding['name'] + " is " + finding['where'])
     else:
         # now we're writing data back, don't merge these in
         # TODO: work out what to do instead for these
@@ -746,7 +1488,11 @@ def storage(locations,
                                        stock=read_stock(stock),
                                        verbose=verbose)
         if cli:
-            command_handler.cmdloop()
+            command_handler.persister = CSVPersister(write_delay, max_dirty)
+            try:
+                command_handler.cmdloop()
+            finally:
+                command_handler.persister.close()
         else:
             if (things[0]
                 # the list of command keywords